@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 import redis
@@ -30,12 +31,68 @@ SECRET_KEY = os.environ.get("SECRET_KEY")
 
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD")
 STATISTIC_REFRESH_THRESHOLD = 10
-running_threads = set()
+# Single-flight lease for cache refreshes, shared by all workers through Redis
+CACHE_LEASE_SECONDS = 300
+CACHE_LEASE_WAIT_SECONDS = 240  # Keep below gunicorn --timeout
+CACHE_FAILURE_SECONDS = 60  # Don't call WB again for a key that has just failed
+# Format of cached payloads, see wb/services/codec.py
+CACHE_CODEC = os.environ.get("CACHE_CODEC", "pickle")  # pickle or msgpack
+# zstd, lz4, zlib or none. Unset means the best one installed, zlib at worst
+CACHE_COMPRESSION = os.environ.get("CACHE_COMPRESSION")
+CACHE_COMPRESSION_MIN_SIZE = 1024
+CACHE_SCHEMA_VERSION = 1  # Bump to drop all cached payloads
+# In-process tier in front of Redis, per gunicorn worker
+CACHE_LOCAL_MAX_BYTES = int(os.environ.get("CACHE_LOCAL_MAX_BYTES", 256 * 1024 * 1024))
+CACHE_LOCAL_FRESH_SECONDS = 5  # Served without asking Redis if data changed
+# HTTP connections to WB API, see wb/services/rest_client/transport.py
+WB_STANDARD_API_URL = "https://suppliers-api.wildberries.ru/"
+WB_STATISTICS_API_URL = "https://statistics-api.wildberries.ru/api/v1/supplier/"
+# Offline stand-in for both, like "rows=20000,latency=0.1,error_rate=0.05",
+# see wb/services/rest_client/fake.py. Never set it in production
+WB_FAKE_API = os.environ.get("WB_FAKE_API")
+WB_HTTP_POOL_SIZE = 16
+WB_HTTP_TIMEOUT = (10, 180)  # Connect, read. Statistics may take a minute
+WB_PAGE_CONCURRENCY = 8  # Parallel skip/take pages per process, callers fetch too
+# Requests, per seconds for every token and endpoint, shared by all workers
+WB_RATE_LIMITS = {
+    "statistics": (3, 60),  # WB allows about one call a minute per method
+    "standard": (10, 1),
+}
+WB_RATE_LIMIT_MAX_WAIT = 120  # Longer queue fails fast, stale cache is served
 
-redis_client: redis.Redis = redis.Redis(
-    host="cache", port=6379, password=REDIS_PASSWORD
+# Rendered pages by ETag, see wb/services/page_cache.py
+PAGE_CACHE_SECONDS = 600
+PAGE_CACHE_LOCAL_MAX_BYTES = int(
+    os.environ.get("PAGE_CACHE_LOCAL_MAX_BYTES", 32 * 1024 * 1024)
 )
 
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 4))
+SCHEDULER_TOKEN_CONCURRENCY = 2  # Refreshes of one token at once, WB limits per token
+SCHEDULER_IDLE_DAYS = 3  # Tokens nobody opened for longer are not refreshed
+SCHEDULER_TICK_SECONDS = 15
+SCHEDULER_JITTER_SECONDS = 5
+
+# Threads per process, see wb/services/executor.py: workers, seconds a task may take
+EXECUTOR_POOLS = {
+    # Blocking calls of async views and their fan-out
+    "foreground": (int(os.environ.get("EXECUTOR_FOREGROUND_WORKERS", 16)), 240),
+    # Stale cache refreshes, snapshot rebuilds and scheduler jobs
+    "background": (SCHEDULER_WORKERS, CACHE_LEASE_SECONDS),
+    # Skip/take pages of WB API, bounded by HTTP timeout already
+    "pages": (WB_PAGE_CONCURRENCY, None),
+}
+
+# manage.py test runs against in-memory Redis, see wb/tests.py
+TESTING = sys.argv[1:2] == ["test"]
+if TESTING:
+    import fakeredis
+
+    redis_client: redis.Redis = fakeredis.FakeRedis()
+else:
+    redis_client: redis.Redis = redis.Redis(
+        host="cache", port=6379, password=REDIS_PASSWORD
+    )
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get("DEBUG") == "1"
 
@@ -165,7 +222,10 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 sentry_sdk.init(
-    dsn="https://5b115d4d279e466ca173bc4cd8f53fd2@o1272655.ingest.sentry.io/6466529",
+    # Tests break things on purpose, they must not report
+    dsn=None
+    if TESTING
+    else "https://5b115d4d279e466ca173bc4cd8f53fd2@o1272655.ingest.sentry.io/6466529",
     integrations=[DjangoIntegration()],
     # Set traces_sample_rate to 1.0 to capture 100%
     # of transactions for performance monitoring.
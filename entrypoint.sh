@@ -13,6 +13,7 @@ fi
 
 python manage.py collectstatic --noinput
 # python manage.py refresh &
-gunicorn _settings.wsgi:application --bind 0.0.0.0:8000 --timeout 240
+# ASGI workers serve other requests while async views wait for WB
+gunicorn _settings.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --timeout 240
 
 exec "$@"
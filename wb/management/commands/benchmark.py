@@ -0,0 +1,257 @@
+import json
+import statistics
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from loguru import logger
+
+from _settings.settings import redis_client
+from wb import views
+from wb.models import ApiKey, OrderRow, SaleRow, StockRow
+from wb.services import codec
+from wb.services.executor import BACKGROUND, get_executor
+from wb.services.json_encoder import iter_products_json
+from wb.services.redis import (
+    get_price_changes_from_redis,
+    local_cache,
+    local_cache_lock,
+)
+from wb.services.rest_client import transport
+from wb.services.rest_client.fake import FakeWbApi
+from wb.services.search import search_warehouse_products
+from wb.services.snapshot import MARKETPLACE, STOCK, get_snapshot
+from wb.services.sorting import get_sort_orders, sort_products, sorting_lambdas
+from wb.services.statistics import get_stock_statistics
+from wb.services.warehouse import (
+    add_weekly_orders,
+    add_weekly_sales,
+    get_orders_window,
+    get_sales_window,
+    get_stock_objects,
+    get_stock_products,
+)
+
+
+def measure(func, repeat) -> list:
+    """Seconds every call of func took."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def get_view_request(path, x64_token, jwt_token):
+    """Request as async_api_key_required passes it to view, nothing is saved."""
+    request = RequestFactory().get(path)
+    request.user = User(username="benchmark")
+    request.api_key = ApiKey(api=x64_token, new_api=jwt_token)
+    return request
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure merges, sorting, search, statistics, cache codec and views "
+        "against fake WB API, nothing goes to network"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            nargs="+",
+            default=[1000, 20000],
+            help="Stock rows of fake WB, 1000 to 200000. Orders are as many, sales half",
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0, help="Seconds per WB request"
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="Share of WB requests failing with 429 or 500",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Runs of every measurement"
+        )
+        parser.add_argument("--search", default="платья", help="Keyword for search")
+        parser.add_argument(
+            "--json", action="store_true", help="Print results as JSON lines"
+        )
+        parser.add_argument(
+            "--verbose", action="store_true", help="Keep logs of measured code"
+        )
+
+    def handle(self, *args, **options):
+        if not options["verbose"]:
+            logger.disable("wb")
+        try:
+            for rows in options["rows"]:
+                api = FakeWbApi(
+                    rows=rows,
+                    latency=options["latency"],
+                    error_rate=options["error_rate"],
+                )
+                transport.use_fake(api)
+                # Fresh tokens, so nothing cached before is reused
+                x64_token = f"benchmark-{uuid.uuid4().hex}"
+                jwt_token = f"benchmark-jwt-{uuid.uuid4().hex}"
+                try:
+                    self.run(api, x64_token, jwt_token, options)
+                finally:
+                    self.cleanup(x64_token, jwt_token)
+        finally:
+            transport.use_fake(None)
+            logger.enable("wb")
+
+    def report(self, name, rows, samples, options):
+        result = {
+            "name": name,
+            "rows": rows,
+            "runs": len(samples),
+            "min_ms": min(samples) * 1000,
+            "median_ms": statistics.median(samples) * 1000,
+            "max_ms": max(samples) * 1000,
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(result))
+            return
+        self.stdout.write(
+            f"{name:<24}{rows:>8} rows {result['min_ms']:>10.1f} "
+            f"{result['median_ms']:>10.1f} {result['max_ms']:>10.1f} ms"
+        )
+
+    def run(self, api: FakeWbApi, x64_token, jwt_token, options):
+        rows = api.rows
+        repeat = options["repeat"]
+        api.data  # Made once, before anything is measured
+        if not options["json"]:
+            self.stdout.write(
+                f"{'':<24}{'':>13} {'min':>10} {'median':>10} {'max':>10}"
+            )
+
+        def report(name, samples):
+            self.report(name, rows, samples, options)
+
+        # Cold build calls fake WB, syncs windows and mirrors them to DB
+        report(
+            "snapshot_cold",
+            measure(lambda: get_snapshot(STOCK, x64_token, jwt_token), 1),
+        )
+        report(
+            "snapshot_warm",
+            measure(lambda: get_snapshot(STOCK, x64_token, jwt_token), repeat),
+        )
+        report(
+            "marketplace_cold",
+            measure(lambda: get_snapshot(MARKETPLACE, x64_token, jwt_token), 1),
+        )
+
+        raw_stock = get_stock_products(x64_token)
+        raw_orders = get_orders_window(x64_token)
+        raw_sales = get_sales_window(x64_token)
+        price_changes = get_price_changes_from_redis(x64_token)
+        report(
+            "get_stock_objects",
+            measure(lambda: get_stock_objects(raw_stock, price_changes), repeat),
+        )
+        # Merges change products in place, every run gets its own
+        objects = [get_stock_objects(raw_stock, price_changes) for _ in range(repeat)]
+        report(
+            "add_weekly_sales",
+            measure(lambda: add_weekly_sales(objects.pop(), raw_sales), repeat),
+        )
+        objects = [get_stock_objects(raw_stock, price_changes) for _ in range(repeat)]
+        report(
+            "add_weekly_orders",
+            measure(lambda: add_weekly_orders(objects.pop(), raw_orders), repeat),
+        )
+
+        snapshot = get_snapshot(STOCK, x64_token, jwt_token)
+        products = snapshot.products
+        report(
+            "sort_products",
+            measure(
+                lambda: sort_products(products, "low_sales", sorting_lambdas), repeat
+            ),
+        )
+        report(
+            "get_sort_orders",
+            measure(
+                lambda: get_sort_orders(products, sorting_lambdas, snapshot.columns),
+                repeat,
+            ),
+        )
+        report(
+            "snapshot_get_sorted",
+            measure(lambda: snapshot.get_sorted("low_sales")[:32], repeat),
+        )
+        keyword = options["search"]
+        report(
+            "search_products",
+            measure(lambda: search_warehouse_products(products, keyword), repeat),
+        )
+        report(
+            "snapshot_search",
+            measure(
+                lambda: snapshot.get_sorted("low_sales", search=keyword)[:32], repeat
+            ),
+        )
+        report(
+            "get_stock_statistics",
+            measure(lambda: get_stock_statistics(products), repeat),
+        )
+
+        blob, _ = codec.encode(snapshot, codec.PickleCodec)
+        report(
+            "codec_encode",
+            measure(lambda: codec.encode(snapshot, codec.PickleCodec), repeat),
+        )
+        report("codec_decode", measure(lambda: codec.decode(blob), repeat))
+        report(
+            "json_products",
+            measure(lambda: b"".join(iter_products_json(products)), repeat),
+        )
+
+        # Raw view assembles and renders the page, decorated one uses page cache
+        for name, view, path in (
+            ("stock", views.stock, "/stock/?sort_by=low_sales&page=2"),
+            ("marketplace", views.marketplace, "/marketplace/?page=2"),
+        ):
+            conditional_view = view.__wrapped__
+            render_view = conditional_view.__wrapped__
+
+            def call(func):
+                return async_to_sync(func)(get_view_request(path, x64_token, jwt_token))
+
+            report(f"view_{name}", measure(lambda: call(render_view), repeat))
+            call(conditional_view)
+            report(
+                f"view_{name}_cached", measure(lambda: call(conditional_view), repeat)
+            )
+        if not options["json"]:
+            self.stdout.write(f"Fake WB requests: {api.get_metrics()}")
+
+    def cleanup(self, x64_token, jwt_token):
+        """Drop everything fake tokens left in Redis, DB and worker memory."""
+        # Rebuilds started by views would write keys back after cleanup
+        background = get_executor(BACKGROUND)
+        while True:
+            metrics = background.get_metrics()
+            if not metrics["active"] and not metrics["queued"]:
+                break
+            time.sleep(0.1)
+        for token in (x64_token, jwt_token):
+            keys = list(redis_client.scan_iter(f"{token}*"))
+            if keys:
+                redis_client.delete(*keys)
+        for model in (OrderRow, SaleRow, StockRow):
+            model.objects.filter(token=x64_token).delete()
+        with local_cache_lock:
+            local_cache.clear()
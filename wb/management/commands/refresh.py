@@ -1,42 +1,26 @@
-import concurrent.futures
-from time import sleep
+import signal
 
 from django.core.management.base import BaseCommand
-from loguru import logger
 
-from _settings.settings import STATISTIC_REFRESH_THRESHOLD
-from wb.models import ApiKey
-from wb.services.warehouse import (
-    get_bought_products,
-    get_bought_sum,
-    get_ordered_products,
-    get_ordered_sum,
-    get_stock_products,
-    get_weekly_payment,
-)
+from wb.services.scheduler import Scheduler
 
 
 class Command(BaseCommand):
     help = "Refresh wb statistics in background"
 
-    def handle(self, *args, **options):
-        funcs = [
-            get_weekly_payment,
-            get_ordered_sum,
-            get_bought_sum,
-            get_ordered_products,
-            get_bought_products,
-            get_stock_products,
-        ]
-
-        while True:
-            tokens = [token.api for token in ApiKey.objects.all()]
-            for token in tokens:
-                logger.info(f"REFRESHING: {token=} cache...")
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    futures = []
-                    for func in funcs:
-                        futures.append(executor.submit(func, token))
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            help="Parallel refreshes, up to SCHEDULER_WORKERS threads",
+        )
 
-                sleep(600)
-            sleep(60 * STATISTIC_REFRESH_THRESHOLD)
+    def handle(self, *args, **options):
+        kwargs = dict()
+        if options.get("workers"):
+            kwargs["workers"] = options["workers"]
+        scheduler = Scheduler(**kwargs)
+        # Finish running refreshes on deploy instead of leaving leases behind
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+        scheduler.run()
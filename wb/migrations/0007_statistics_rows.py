@@ -0,0 +1,151 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wb", "0006_auto_20230325_0000"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderRow",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "token",
+                    models.CharField(
+                        max_length=200, verbose_name="Ключ API для сервиса статистики"
+                    ),
+                ),
+                ("row_key", models.CharField(max_length=200)),
+                ("nm_id", models.BigIntegerField(default=0)),
+                ("barcode", models.CharField(default="", max_length=100)),
+                ("supplier_article", models.CharField(default="", max_length=200)),
+                ("tech_size", models.CharField(default="", max_length=100)),
+                ("last_change_date", models.DateTimeField(null=True)),
+                ("data", models.JSONField(default=dict)),
+                ("date", models.DateTimeField(null=True)),
+                ("quantity", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SaleRow",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "token",
+                    models.CharField(
+                        max_length=200, verbose_name="Ключ API для сервиса статистики"
+                    ),
+                ),
+                ("row_key", models.CharField(max_length=200)),
+                ("nm_id", models.BigIntegerField(default=0)),
+                ("barcode", models.CharField(default="", max_length=100)),
+                ("supplier_article", models.CharField(default="", max_length=200)),
+                ("tech_size", models.CharField(default="", max_length=100)),
+                ("last_change_date", models.DateTimeField(null=True)),
+                ("data", models.JSONField(default=dict)),
+                ("date", models.DateTimeField(null=True)),
+                ("quantity", models.IntegerField(default=0)),
+                ("for_pay", models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="StockRow",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "token",
+                    models.CharField(
+                        max_length=200, verbose_name="Ключ API для сервиса статистики"
+                    ),
+                ),
+                ("row_key", models.CharField(max_length=200)),
+                ("nm_id", models.BigIntegerField(default=0)),
+                ("barcode", models.CharField(default="", max_length=100)),
+                ("supplier_article", models.CharField(default="", max_length=200)),
+                ("tech_size", models.CharField(default="", max_length=100)),
+                ("last_change_date", models.DateTimeField(null=True)),
+                ("data", models.JSONField(default=dict)),
+                ("warehouse_name", models.CharField(default="", max_length=200)),
+                ("quantity_full", models.IntegerField(default=0)),
+                ("in_way_to_client", models.IntegerField(default=0)),
+                ("in_way_from_client", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="stockrow",
+            index=models.Index(
+                fields=["token", "nm_id"], name="wb_stockrow_token_e067de_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stockrow",
+            constraint=models.UniqueConstraint(
+                fields=("token", "row_key"), name="stock_row_key"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="salerow",
+            index=models.Index(
+                fields=["token", "date"], name="wb_salerow_token_c9afb7_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="salerow",
+            index=models.Index(
+                fields=["token", "nm_id"], name="wb_salerow_token_08769b_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="salerow",
+            constraint=models.UniqueConstraint(
+                fields=("token", "row_key"), name="sale_row_key"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="orderrow",
+            index=models.Index(
+                fields=["token", "date"], name="wb_orderrow_token_269b89_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="orderrow",
+            index=models.Index(
+                fields=["token", "nm_id"], name="wb_orderrow_token_a18288_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="orderrow",
+            constraint=models.UniqueConstraint(
+                fields=("token", "row_key"), name="order_row_key"
+            ),
+        ),
+    ]
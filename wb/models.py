@@ -1,8 +1,11 @@
 import json
 from dataclasses import dataclass, field
+from typing import Optional
 
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 User = get_user_model()
 
@@ -18,6 +21,113 @@ class ApiKey(models.Model):
         return self.api
 
 
+def parse_wb_date(value):
+    """WB dates come without timezone and are in Moscow time."""
+    date = parse_datetime(value or "")
+    if date is None:
+        return None
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+class StatisticsRow(models.Model):
+    """Raw row of WB statistics API saved per token."""
+
+    token = models.CharField(
+        max_length=200, verbose_name="Ключ API для сервиса статистики"
+    )
+    row_key = models.CharField(max_length=200)  # See wb.services.sync.sync_keys
+    nm_id = models.BigIntegerField(default=0)
+    barcode = models.CharField(max_length=100, default="")
+    supplier_article = models.CharField(max_length=200, default="")
+    tech_size = models.CharField(max_length=100, default="")
+    last_change_date = models.DateTimeField(null=True)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_row(cls, token, row_key, row: dict):
+        return cls(
+            token=token,
+            row_key=row_key,
+            nm_id=row.get("nmId") or 0,
+            barcode=row.get("barcode") or "",
+            supplier_article=row.get("supplierArticle") or "",
+            tech_size=row.get("techSize") or "",
+            last_change_date=parse_wb_date(row.get("lastChangeDate")),
+            data=row,
+        )
+
+
+class StockRow(StatisticsRow):
+    warehouse_name = models.CharField(max_length=200, default="")
+    quantity_full = models.IntegerField(default=0)
+    in_way_to_client = models.IntegerField(default=0)
+    in_way_from_client = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["token", "row_key"], name="stock_row_key")
+        ]
+        indexes = [models.Index(fields=["token", "nm_id"])]
+
+    @classmethod
+    def from_row(cls, token, row_key, row: dict):
+        stock_row = super().from_row(token, row_key, row)
+        stock_row.warehouse_name = row.get("warehouseName") or ""
+        stock_row.quantity_full = row.get("quantityFull", 0)
+        stock_row.in_way_to_client = row.get("inWayToClient", 0)
+        stock_row.in_way_from_client = row.get("inWayFromClient", 0)
+        return stock_row
+
+
+class OrderRow(StatisticsRow):
+    date = models.DateTimeField(null=True)
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["token", "row_key"], name="order_row_key")
+        ]
+        indexes = [
+            models.Index(fields=["token", "date"]),
+            models.Index(fields=["token", "nm_id"]),
+        ]
+
+    @classmethod
+    def from_row(cls, token, row_key, row: dict):
+        order_row = super().from_row(token, row_key, row)
+        order_row.date = parse_wb_date(row.get("date"))
+        order_row.quantity = row.get("quantity", 0)
+        return order_row
+
+
+class SaleRow(StatisticsRow):
+    date = models.DateTimeField(null=True)
+    quantity = models.IntegerField(default=0)
+    for_pay = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["token", "row_key"], name="sale_row_key")
+        ]
+        indexes = [
+            models.Index(fields=["token", "date"]),
+            models.Index(fields=["token", "nm_id"]),
+        ]
+
+    @classmethod
+    def from_row(cls, token, row_key, row: dict):
+        sale_row = super().from_row(token, row_key, row)
+        sale_row.date = parse_wb_date(row.get("date"))
+        sale_row.quantity = row.get("quantity", 0)
+        sale_row.for_pay = row.get("forPay", 0)
+        return sale_row
+
+
 @dataclass
 class Product:
     """WB product."""
@@ -40,42 +150,72 @@ class Product:
     has_been_updated: dict = field(default_factory=dict)
     name: str = ""
 
+    # Totals of all sizes, maintained by add_sale/add_order
+    sales: int = 0
+    orders: int = 0
+    sales_sum: float = 0
+    orders_sum: float = 0
+
     @property
     def stock(self):
         return sum(size.quantity_full for size in self.sizes.values())
 
-    @property
-    def sales(self):
-        return sum(len(size.sales) for size in self.sizes.values())
-
-    @property
-    def orders(self):
-        return sum(len(size.orders) for size in self.sizes.values())
-
     @property
     def barcodes(self):
         return ", ".join(
             f"{size.tech_size}: {size.barcode}" for size in self.sizes.values()
         )
 
+    def get_size(self, tech_size) -> "Size":
+        size = self.sizes.get(tech_size)
+        if size is None:
+            size = self.sizes[tech_size] = Size(tech_size=tech_size)
+        return size
+
+    def add_sale(self, tech_size, revenue=0, sale: "Sale" = None):
+        self.get_size(tech_size).add_sale(revenue, sale)
+        self.sales += 1
+        self.sales_sum += revenue
+
+    def add_order(self, tech_size, revenue=0, order: "Sale" = None):
+        self.get_size(tech_size).add_order(revenue, order)
+        self.orders += 1
+        self.orders_sum += revenue
+
 
 @dataclass
 class Size:
-    """WB size."""
+    """WB size.
+
+    Sales and orders are counted when added, rows themselves are kept only
+    if passed to add_sale/add_order.
+    """
 
     tech_size: str = 0  # techSize
     quantity_full: int = 0  # quantityFull
-    sales: list = field(default_factory=list)
-    orders: list = field(default_factory=list)
     barcode: str = ""
-
-    @property
-    def total_sales(self):
-        return len(self.sales)
-
-    @property
-    def total_orders(self):
-        return len(self.orders)
+    total_sales: int = 0
+    total_orders: int = 0
+    sales_sum: float = 0
+    orders_sum: float = 0
+    sales: Optional[list] = None
+    orders: Optional[list] = None
+
+    def add_sale(self, revenue=0, sale: "Sale" = None):
+        self.total_sales += 1
+        self.sales_sum += revenue
+        if sale is not None:
+            if self.sales is None:
+                self.sales = []
+            self.sales.append(sale)
+
+    def add_order(self, revenue=0, order: "Sale" = None):
+        self.total_orders += 1
+        self.orders_sum += revenue
+        if order is not None:
+            if self.orders is None:
+                self.orders = []
+            self.orders.append(order)
 
 
 @dataclass
@@ -88,6 +228,7 @@ class Sale:
     finished_price: float = 0
     for_pay: float = 0
 
+
 # @dataclass
 # class Order:
 #     """WB sale with Product attached."""
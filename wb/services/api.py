@@ -0,0 +1,78 @@
+import base64
+from typing import Optional, Tuple
+
+from wb.services.json_encoder import product_fields
+from wb.services.sorting import SortedProducts
+
+API_MAX_LIMIT = 1000  # Products per page of JSON API
+
+
+class QueryError(ValueError):
+    """Bad query parameter of JSON API, message is shown to client."""
+
+
+def parse_limit(value) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise QueryError("limit must be a number")
+    if not 1 <= limit <= API_MAX_LIMIT:
+        raise QueryError(f"limit must be between 1 and {API_MAX_LIMIT}")
+    return limit
+
+
+def parse_fields(value) -> Optional[Tuple[str, ...]]:
+    """Product fields client asked for, None for all of them."""
+    if not value:
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(",") if name))
+    unknown = [name for name in fields if name not in product_fields]
+    if unknown:
+        raise QueryError(
+            f"Unknown fields {', '.join(unknown)}, "
+            f"available are {', '.join(product_fields)}"
+        )
+    return fields
+
+
+def encode_cursor(offset, nm_id) -> str:
+    # Without padding, so it goes into URL as is
+    return base64.urlsafe_b64encode(f"{offset}:{nm_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor) -> Tuple[int, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        offset, nm_id = raw.split(b":")
+        return int(offset), int(nm_id)
+    except ValueError:
+        raise QueryError("cursor is broken, start from the first page")
+
+
+def find_start(products: SortedProducts, offset, nm_id) -> int:
+    """Position right after product the previous page ended with."""
+    if 0 < offset <= len(products) and products[offset - 1].nm_id == nm_id:
+        return offset
+    # Snapshot was rebuilt since previous page, continue after the same product
+    for position, product in enumerate(products):
+        if product.nm_id == nm_id:
+            return position + 1
+    return min(offset, len(products))
+
+
+def get_cursor_page(
+    products: SortedProducts, cursor, limit
+) -> Tuple[list, Optional[str]]:
+    """Products of page and cursor of the next one, None on the last page.
+
+    Cursor remembers the last product, not only offset, so the next page
+    goes on after it even if snapshot was rebuilt in between.
+    """
+    start = find_start(products, *decode_cursor(cursor)) if cursor else 0
+    page = products[start : start + limit]
+    end = start + len(page)
+    if end >= len(products) or not page:
+        return page, None
+    return page, encode_cursor(end, page[-1].nm_id)
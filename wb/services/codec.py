@@ -0,0 +1,254 @@
+"""Binary format of cached payloads: header + (compressed) codec payload.
+
+Schema version in header is derived from fields of our dataclasses, so
+changing Product/Size/Sale turns old blobs into cache misses.
+"""
+import dataclasses
+import datetime
+import pickle
+import struct
+import zlib
+
+from loguru import logger
+
+from _settings.settings import (
+    CACHE_CODEC,
+    CACHE_COMPRESSION,
+    CACHE_COMPRESSION_MIN_SIZE,
+    CACHE_SCHEMA_VERSION,
+)
+from wb.models import Product, Sale, Size
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+MAGIC = b"WB"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">2sBBBI")  # magic, format, codec, compressor, schema
+
+# Cached models, their order is a part of the format
+MODELS = (Product, Size, Sale)
+EXT_DATETIME = len(MODELS)
+EXT_TUPLE = len(MODELS) + 1
+
+
+class CacheFormatError(ValueError):
+    """Blob was written by another version of code and must be recalculated."""
+
+
+def get_schema_version() -> int:
+    signature = [str(CACHE_SCHEMA_VERSION)]
+    for model in MODELS:
+        signature.append(model.__name__)
+        signature.extend(f.name for f in dataclasses.fields(model))
+    return zlib.crc32(":".join(signature).encode())
+
+
+SCHEMA_VERSION = get_schema_version()
+
+
+class PickleCodec:
+    id = 1
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data: bytes):
+        return pickle.loads(data)
+
+
+class MsgpackCodec:
+    """Dataclasses are packed as positional lists headed by ext marker."""
+
+    id = 2
+    model_fields = {
+        model: tuple(f.name for f in dataclasses.fields(model)) for model in MODELS
+    }
+    # Unpacked ext markers, list_hook looks for them in the first item
+    markers = tuple(object() for _ in range(EXT_TUPLE + 1))
+
+    @classmethod
+    def default(cls, obj):
+        for code, model in enumerate(MODELS):
+            if type(obj) is model:
+                marker = msgpack.ExtType(code, b"")
+                fields = cls.model_fields[model]
+                return [marker] + [getattr(obj, name) for name in fields]
+        if isinstance(obj, datetime.datetime):
+            return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+        if isinstance(obj, tuple):
+            return [msgpack.ExtType(EXT_TUPLE, b"")] + list(obj)
+        raise TypeError(f"Can't pack {type(obj)}")
+
+    @classmethod
+    def ext_hook(cls, code, data):
+        if code == EXT_DATETIME:
+            return datetime.datetime.fromisoformat(data.decode())
+        if code < len(cls.markers):
+            return cls.markers[code]
+        return msgpack.ExtType(code, data)
+
+    @classmethod
+    def list_hook(cls, items):
+        if not items or items[0].__class__ is not object:
+            return items
+        code = cls.markers.index(items[0])
+        if code == EXT_TUPLE:
+            return tuple(items[1:])
+        # Skip __init__ with its default factories, fields are all here
+        model = MODELS[code]
+        obj = model.__new__(model)
+        obj.__dict__ = dict(zip(cls.model_fields[model], items[1:]))
+        return obj
+
+    @classmethod
+    def dumps(cls, obj) -> bytes:
+        return msgpack.packb(obj, default=cls.default, strict_types=True)
+
+    @classmethod
+    def loads(cls, data: bytes):
+        return msgpack.unpackb(
+            data,
+            ext_hook=cls.ext_hook,
+            list_hook=cls.list_hook,
+            strict_map_key=False,
+            raw=False,
+        )
+
+
+class NoCompressor:
+    id = 0
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return data
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return data
+
+
+class ZlibCompressor:
+    id = 1
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return zlib.compress(data, 1)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor:
+    id = 2
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Compressor:
+    id = 3
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return lz4_frame.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return lz4_frame.decompress(data)
+
+
+codecs = {"pickle": PickleCodec}
+if msgpack is not None:
+    codecs["msgpack"] = MsgpackCodec
+
+compressors = {"none": NoCompressor, "zlib": ZlibCompressor}
+if zstandard is not None:
+    compressors["zstd"] = ZstdCompressor
+if lz4_frame is not None:
+    compressors["lz4"] = Lz4Compressor
+
+codecs_by_id = {item.id: item for item in codecs.values()}
+compressors_by_id = {item.id: item for item in compressors.values()}
+
+
+def get_codec(name=CACHE_CODEC):
+    if name not in codecs:
+        logger.warning(f"Cache codec {name} is not installed, using pickle")
+        return PickleCodec
+    return codecs[name]
+
+
+def get_compressor(name=CACHE_COMPRESSION):
+    if name is None:
+        # Best installed: zstd packs as tight as zlib several times faster
+        best = next(item for item in ("zstd", "lz4", "zlib") if item in compressors)
+        return compressors[best]
+    if name not in compressors:
+        logger.warning(f"Cache compression {name} is not installed, using zlib")
+        return ZlibCompressor
+    return compressors[name]
+
+
+codec = get_codec()
+compressor = get_compressor()
+
+
+def encode(obj, used_codec=None) -> tuple:
+    """Return blob and size of uncompressed payload."""
+    used_codec = used_codec or codec
+    payload = used_codec.dumps(obj)
+    size = len(payload)
+    used_compressor = NoCompressor
+    if size >= CACHE_COMPRESSION_MIN_SIZE:
+        used_compressor = compressor
+        payload = compressor.compress(payload)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, used_codec.id, used_compressor.id, SCHEMA_VERSION
+    )
+    return header + payload, size
+
+
+def decode(data: bytes) -> tuple:
+    """Return object and size of uncompressed payload."""
+    if len(data) < HEADER.size:
+        raise CacheFormatError("Blob is too short")
+    magic, format_version, codec_id, compressor_id, schema_version = HEADER.unpack_from(
+        data
+    )
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise CacheFormatError("Unknown blob format")
+    if schema_version != SCHEMA_VERSION:
+        raise CacheFormatError("Blob was written for another schema")
+    if codec_id not in codecs_by_id or compressor_id not in compressors_by_id:
+        raise CacheFormatError("Codec of blob is not installed")
+    payload = compressors_by_id[compressor_id].decompress(data[HEADER.size :])
+    return codecs_by_id[codec_id].loads(payload), len(payload)
+
+
+def dumps(obj) -> bytes:
+    return encode(obj)[0]
+
+
+def loads(data: bytes):
+    return decode(data)[0]
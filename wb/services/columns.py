@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+@dataclass
+class ProductColumns:
+    """Catalog of token as arrays, row i is products[i] of the snapshot.
+
+    Sizes of product i are size_*[size_offsets[i]:size_offsets[i + 1]].
+    """
+
+    nm_id: Any
+    price: Any
+    stock: Any
+    in_way_to_client: Any
+    in_way_from_client: Any
+    orders: Any
+    sales: Any
+    size_offsets: Any
+    size_quantity: Any
+    size_orders: Any
+    size_sales: Any
+
+    def __len__(self):
+        return len(self.nm_id)
+
+
+def sum_by_product(values, offsets):
+    """Sums of per-size values for every product, empty products give 0."""
+    totals = np.zeros(len(values) + 1, dtype=values.dtype)
+    np.cumsum(values, out=totals[1:])
+    return totals[offsets[1:]] - totals[offsets[:-1]]
+
+
+def build_columns(products: list) -> Optional[ProductColumns]:
+    """Arrays for vectorized statistics, sorting and filters, if NumPy is installed."""
+    if np is None:
+        return None
+    sizes = [list(product.sizes.values()) for product in products]
+    offsets = np.zeros(len(products) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in sizes], out=offsets[1:])
+    all_sizes = [size for item in sizes for size in item]
+    size_quantity = np.array([s.quantity_full for s in all_sizes], dtype=np.int64)
+    size_orders = np.array([s.total_orders for s in all_sizes], dtype=np.int64)
+    size_sales = np.array([s.total_sales for s in all_sizes], dtype=np.int64)
+    # Prices stay integer when they are, so sums match Product based ones
+    price = np.array([product.price for product in products])
+    if price.dtype.kind not in "if":
+        price = price.astype(np.float64)
+    return ProductColumns(
+        nm_id=np.array([product.nm_id for product in products], dtype=np.int64),
+        price=price,
+        stock=sum_by_product(size_quantity, offsets),
+        in_way_to_client=np.array(
+            [product.in_way_to_client for product in products], dtype=np.int64
+        ),
+        in_way_from_client=np.array(
+            [product.in_way_from_client for product in products], dtype=np.int64
+        ),
+        orders=sum_by_product(size_orders, offsets),
+        sales=sum_by_product(size_sales, offsets),
+        size_offsets=offsets,
+        size_quantity=size_quantity,
+        size_orders=size_orders,
+        size_sales=size_sales,
+    )
+
+
+def divide(numerator, denominator, fallback):
+    """numerator / denominator where denominator is positive, fallback elsewhere."""
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.asarray(fallback, dtype=np.float64).copy(),
+        where=denominator > 0,
+    )
@@ -0,0 +1,280 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from django.db import close_old_connections
+from loguru import logger
+
+from _settings.settings import EXECUTOR_POOLS
+
+FOREGROUND = "foreground"
+BACKGROUND = "background"
+PAGES = "pages"
+
+LATENCY_SAMPLES = 1000  # Recent tasks percentiles are calculated from
+
+
+class TaskTimeout(concurrent.futures.TimeoutError):
+    """Task waited in queue or ran longer than its timeout."""
+
+
+class TaskFuture(concurrent.futures.Future):
+    task: "Task"
+
+
+@dataclass(eq=False)
+class Task:
+    func: Callable
+    args: tuple
+    kwargs: dict
+    key: Optional[Hashable]
+    deadline: Optional[float]
+    submitted_at: float
+    future: TaskFuture = field(default_factory=TaskFuture)
+    claimed: bool = False  # Taken by a worker or by the caller waiting for it
+
+    @property
+    def name(self):
+        return getattr(self.func, "__name__", repr(self.func))
+
+
+def get_latency(samples: list) -> dict:
+    if not samples:
+        return {"avg": 0, "p50": 0, "p95": 0, "max": 0}
+    samples = sorted(samples)
+    return {
+        "avg": sum(samples) / len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[int(len(samples) * 0.95)],
+        "max": samples[-1],
+    }
+
+
+class Executor:
+    """Fixed number of threads with a FIFO queue, shared by the whole process.
+
+    Tasks with the same key are not queued twice: while one is queued or
+    running, submit returns its future. Waiting for a task nobody has taken
+    yet runs it in the caller thread, so pool threads may submit tasks to
+    their own pool and wait for them without deadlocks.
+
+    Threads can't be killed, so timeout drops tasks that waited in queue too
+    long and stops callers from waiting for the rest.
+    """
+
+    def __init__(self, name, workers, timeout=None):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.keys = dict()  # Key -> queued or running task
+        self.threads = []
+        self.idle = 0
+        self.active = 0
+        self.counters = Counter()
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+        self.runs = deque(maxlen=LATENCY_SAMPLES)
+
+    def submit(self, func, args=(), kwargs=None, key=None, timeout=None) -> TaskFuture:
+        timeout = self.timeout if timeout is None else timeout
+        now = time.monotonic()
+        with self.condition:
+            if key is not None and key in self.keys:
+                self.counters["deduplicated"] += 1
+                return self.keys[key].future
+            task = Task(
+                func,
+                tuple(args),
+                kwargs or dict(),
+                key,
+                now + timeout if timeout else None,
+                now,
+            )
+            task.future.task = task
+            if key is not None:
+                self.keys[key] = task
+            self.queue.append(task)
+            self.counters["submitted"] += 1
+            if self.idle < len(self.queue) and len(self.threads) < self.workers:
+                thread = threading.Thread(
+                    target=self.work,
+                    name=f"{self.name}-{len(self.threads)}",
+                    daemon=True,
+                )
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        return task.future
+
+    def claim(self, task: Task) -> bool:
+        """Called under lock. False if task is taken already or cancelled."""
+        if task.claimed:
+            return False
+        task.claimed = True
+        if task.future.set_running_or_notify_cancel():
+            self.active += 1
+            return True
+        self.counters["cancelled"] += 1
+        self.forget(task)
+        return False
+
+    def forget(self, task: Task):
+        if task.key is not None and self.keys.get(task.key) is task:
+            del self.keys[task.key]
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.idle += 1
+                while not self.queue:
+                    self.condition.wait()
+                self.idle -= 1
+                task = self.queue.popleft()
+                if not self.claim(task):
+                    continue
+            try:
+                self.run(task, in_worker=True)
+            finally:
+                # Same as after request, worker threads live long
+                close_old_connections()
+
+    def run(self, task: Task, in_worker=False):
+        started = time.monotonic()
+        waited = started - task.submitted_at
+        result, error = None, None
+        if in_worker and task.deadline is not None and started > task.deadline:
+            error = TaskTimeout(
+                f"{task.name} waited {waited:.1f}s in {self.name} queue"
+            )
+        else:
+            try:
+                result = task.func(*task.args, **task.kwargs)
+            except BaseException as e:
+                error = e
+        finished = time.monotonic()
+
+        with self.condition:
+            self.active -= 1
+            self.forget(task)
+            if isinstance(error, TaskTimeout) and in_worker:
+                self.counters["expired"] += 1
+            else:
+                self.counters["failed" if error is not None else "completed"] += 1
+                self.waits.append(waited)
+                self.runs.append(finished - started)
+                if task.deadline is not None and finished > task.deadline:
+                    self.counters["late"] += 1
+        if error is None:
+            task.future.set_result(result)
+        else:
+            task.future.set_exception(error)
+
+    def run_queued(self, future: TaskFuture) -> bool:
+        """Run task in this thread if no worker has taken it yet."""
+        task = future.task
+        with self.condition:
+            # Workers claim tasks as they pop them, unclaimed one is still queued
+            if not self.claim(task):
+                return False
+            self.counters["inline"] += 1
+            self.queue.remove(task)
+        self.run(task)
+        return True
+
+    def result(self, future: TaskFuture, timeout=None) -> Any:
+        """Wait for task until its deadline, running it here if it is still queued."""
+        task = future.task
+        self.run_queued(future)
+        if timeout is None and task.deadline is not None:
+            timeout = max(task.deadline - time.monotonic(), 0)
+        try:
+            return future.result(timeout)
+        except TaskTimeout:
+            raise
+        except concurrent.futures.TimeoutError:
+            self.on_timeout(task)
+
+    async def async_result(self, future: TaskFuture) -> Any:
+        """Await task until its deadline. Cancelled await drops queued task."""
+        task = future.task
+        timeout = None
+        if task.deadline is not None:
+            timeout = max(task.deadline - time.monotonic(), 0)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except TaskTimeout:
+            raise
+        except asyncio.TimeoutError:
+            self.on_timeout(task)
+
+    def wait_any(self, futures) -> set:
+        """Some of tasks that are done, queued ones are run here instead of waiting."""
+        for future in futures:
+            if self.run_queued(future):
+                return {future}
+        deadlines = [f.task.deadline for f in futures if f.task.deadline is not None]
+        timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+        done, _ = concurrent.futures.wait(
+            futures, timeout, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        if not done:
+            self.on_timeout(
+                min(futures, key=lambda f: f.task.deadline or float("inf")).task
+            )
+        return done
+
+    def on_timeout(self, task: Task):
+        with self.condition:
+            self.counters["timed_out"] += 1
+        logger.info(f"Gave up waiting for {task.name} in {self.name} executor")
+        raise TaskTimeout(f"{task.name} took longer than its timeout")
+
+    def map(self, func, items: Iterable, timeout=None) -> list:
+        """Results of func for every item in order, like executor.map."""
+        futures = [self.submit(func, (item,), timeout=timeout) for item in items]
+        try:
+            return [self.result(future) for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def get_metrics(self) -> dict:
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "threads": len(self.threads),
+                "active": self.active,
+                "queued": len(self.queue),
+                **self.counters,
+                "wait_seconds": get_latency(list(self.waits)),
+                "run_seconds": get_latency(list(self.runs)),
+            }
+
+
+executors = dict()
+executors_lock = threading.Lock()
+
+
+def get_executor(name) -> Executor:
+    with executors_lock:
+        executor = executors.get(name)
+        if executor is None:
+            workers, timeout = EXECUTOR_POOLS[name]
+            executor = executors[name] = Executor(name, workers, timeout)
+        return executor
+
+
+def get_executor_metrics() -> dict:
+    """Threads, queue depth and latencies of executors of this process."""
+    with executors_lock:
+        return {name: executor.get_metrics() for name, executor in executors.items()}
+
+
+# Threads don't survive fork, child process starts with its own executors
+os.register_at_fork(after_in_child=executors.clear)
@@ -1,10 +1,15 @@
+from wb.services.columns import np
+
+# "columns" is the same filter as a mask over ProductColumns
 filtering_lambdas = {
     "all": {
         "func": lambda x: True,
+        "columns": lambda c: np.ones(len(c), dtype=bool),
         "desc": "Отобразить все",
     },
     "sales": {
         "func": lambda product: product.sales > 0,
+        "columns": lambda c: c.sales > 0,
         "desc": "Были продажи за 14 дней",
     },
 }
@@ -12,6 +17,7 @@ filtering_lambdas = {
 filtering_lambdas_marketplace = filtering_lambdas | {
     "orders": {
         "func": lambda product: product.orders > 0,
+        "columns": lambda c: c.orders > 0,
         "desc": "Еще не собраны",
     },
 }
@@ -19,6 +25,7 @@ filtering_lambdas_marketplace = filtering_lambdas | {
 filtering_lambdas_warehouse = filtering_lambdas | {
     "orders": {
         "func": lambda product: product.orders > 0,
+        "columns": lambda c: c.orders > 0,
         "desc": "Заказы за 14 дней",
     },
 }
@@ -0,0 +1,51 @@
+from django.db import DatabaseError, transaction
+from loguru import logger
+
+from wb.models import OrderRow, SaleRow, StockRow, parse_wb_date
+
+INGEST_CHUNK_SIZE = 2000
+
+row_models = {
+    "orders": OrderRow,
+    "sales": SaleRow,
+    "stocks": StockRow,
+}
+
+
+def ingest_rows(token, endpoint, rows: dict):
+    """Upsert rows by (token, row_key) in chunks.
+
+    Django 3.2 has no bulk upsert, so every chunk replaces existing rows
+    with the same keys inside a transaction.
+    """
+    model = row_models[endpoint]
+    items = list(rows.items())
+    for start in range(0, len(items), INGEST_CHUNK_SIZE):
+        objects = [
+            model.from_row(token, str(key), row)
+            for key, row in items[start : start + INGEST_CHUNK_SIZE]
+        ]
+        with transaction.atomic():
+            model.objects.filter(
+                token=token, row_key__in=[obj.row_key for obj in objects]
+            ).delete()
+            model.objects.bulk_create(objects)
+
+
+def expire_rows(token, endpoint, window_start):
+    row_models[endpoint].objects.filter(
+        token=token, last_change_date__lt=parse_wb_date(window_start)
+    ).delete()
+
+
+def store_synced_rows(token, endpoint, state: dict, changed_rows: dict, window_start):
+    """Mirror sync window to DB. Whole window goes in until it succeeded once."""
+    rows = changed_rows if state.get("stored") else state["rows"]
+    try:
+        ingest_rows(token, endpoint, rows)
+        expire_rows(token, endpoint, window_start)
+        state["stored"] = True
+    except DatabaseError:
+        # Redis window is still fine, DB will get everything next time
+        logger.exception(f"Failed to store {endpoint} rows")
+        state["stored"] = False
@@ -1,9 +1,173 @@
+import datetime
 from json import JSONEncoder
+from operator import attrgetter
+from typing import Callable, Iterable, Iterator
 
+from wb.models import Product, Sale, Size
+
+CHUNK_SIZE = 64 * 1024  # Bytes per chunk of streamed response
+
+
+class ProductEncoder(JSONEncoder):
+    """Dates of price changes as ISO strings, the rest is plain already."""
 
-class ObjectDict(JSONEncoder):
     def default(self, o):
-        try:
-            return o.__dict__
-        except AttributeError:
-            return {}
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def serialize_sale(sale: Sale) -> dict:
+    return {
+        "date": sale.date,
+        "quantity": sale.quantity,
+        "price_with_disc": sale.price_with_disc,
+        "finished_price": sale.finished_price,
+        "for_pay": sale.for_pay,
+    }
+
+
+def serialize_size(size: Size) -> dict:
+    return {
+        "tech_size": size.tech_size,
+        "quantity_full": size.quantity_full,
+        "barcode": size.barcode,
+        "total_sales": size.total_sales,
+        "total_orders": size.total_orders,
+        "sales_sum": size.sales_sum,
+        "orders_sum": size.orders_sum,
+        "sales": None
+        if size.sales is None
+        else [serialize_sale(sale) for sale in size.sales],
+        "orders": None
+        if size.orders is None
+        else [serialize_sale(order) for order in size.orders],
+    }
+
+
+def serialize_product(product: Product) -> dict:
+    """Fields of Product with aggregates, so clients don't sum sizes again."""
+    return {
+        "nm_id": product.nm_id,
+        "supplier_article": product.supplier_article,
+        "full_price": product.full_price,
+        "price": product.price,
+        "discount": product.discount,
+        "sizes": {
+            tech_size: serialize_size(size) for tech_size, size in product.sizes.items()
+        },
+        "in_way_to_client": product.in_way_to_client,
+        "in_way_from_client": product.in_way_from_client,
+        "subject": product.subject,
+        "category": product.category,
+        "brand": product.brand,
+        "image": product.image,
+        "object": product.object,
+        "days_on_site": product.days_on_site,
+        "has_been_updated": product.has_been_updated,
+        "name": product.name,
+        "stock": product.stock,
+        "sales": product.sales,
+        "orders": product.orders,
+        "sales_sum": product.sales_sum,
+        "orders_sum": product.orders_sum,
+    }
+
+
+# Field -> how to get it, for clients asking only for some fields
+product_fields = {
+    name: attrgetter(name)
+    for name in (
+        "nm_id",
+        "supplier_article",
+        "full_price",
+        "price",
+        "discount",
+        "in_way_to_client",
+        "in_way_from_client",
+        "subject",
+        "category",
+        "brand",
+        "image",
+        "object",
+        "days_on_site",
+        "has_been_updated",
+        "name",
+        "stock",
+        "sales",
+        "orders",
+        "sales_sum",
+        "orders_sum",
+    )
+}
+product_fields["sizes"] = lambda product: {
+    tech_size: serialize_size(size) for tech_size, size in product.sizes.items()
+}
+
+
+def get_product_serializer(fields=None) -> Callable[[Product], dict]:
+    if fields is None:
+        return serialize_product
+    getters = [(name, product_fields[name]) for name in fields]
+    return lambda product: {name: getter(product) for name, getter in getters}
+
+
+def iter_chunks(parts: Iterable[str]) -> Iterator[bytes]:
+    """Join small strings into chunks of about CHUNK_SIZE bytes."""
+    chunk, size = [], 0
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk).encode()
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+def get_encoder(indent=None) -> Callable:
+    separators = (",", ":") if indent is None else (",", ": ")
+    return ProductEncoder(indent=indent, separators=separators).encode
+
+
+def iter_products_json(
+    products: Iterable[Product], indent=None, serialize=serialize_product
+) -> Iterator[bytes]:
+    """JSON object nm_id -> product in chunks, whole document is never built.
+
+    Compact output goes through C encoder, indent is for humans only.
+    """
+    encode = get_encoder(indent)
+
+    def iter_parts():
+        yield "{"
+        for number, product in enumerate(products):
+            if number:
+                yield ","
+            yield f'"{product.nm_id}":{encode(serialize(product))}'
+        yield "}"
+
+    return iter_chunks(iter_parts())
+
+
+def iter_page_json(
+    products: Iterable[Product],
+    meta: dict,
+    indent=None,
+    serialize=serialize_product,
+) -> Iterator[bytes]:
+    """JSON object with `meta` keys and products as "results" list, in chunks."""
+    encode = get_encoder(indent)
+
+    def iter_parts():
+        yield "{"
+        for key, value in meta.items():
+            yield f"{encode(key)}:{encode(value)},"
+        yield '"results":['
+        for number, product in enumerate(products):
+            if number:
+                yield ","
+            yield encode(serialize(product))
+        yield "]}"
+
+    return iter_chunks(iter_parts())
@@ -1,33 +1,16 @@
-from django.http import HttpResponse
 from loguru import logger
 
-from wb.models import ApiKey, Product, Sale, Size
-from wb.services.redis import get_price_change_from_redis, redis_cache_decorator
+from wb.models import Product
+from wb.services.redis import apply_price_changes, redis_cache_decorator
 from wb.services.rest_client.standard_client import StandardApiClient
 
 
-def get_marketplace_objects(token):
-    """Proper way to deal with products."""
+def get_marketplace_objects(raw_stock: list, price_changes: dict):
+    """Proper way to deal with products.
+    Rows come from get_marketplace_stock, see wb.services.snapshot."""
     logger.info("Getting marketplace as objects")
-
-    # Okay, for people with several accounts we must get latest
-    tokens = ApiKey.objects.filter(api=token)
-    tokens = tokens.last()
-    jwt_token = tokens.new_api
-    x64_token = tokens.api
-
-    if not jwt_token:
-        return HttpResponse("Нужно указать API-ключ!")
-
-    new_client = StandardApiClient(jwt_token)
-
-    raw_stock = new_client.get_stock()
     stock_products = dict()
 
-    # For some reason WB don't use wb_id in marketplace sales
-    # So to increase speed of access we create barcode -> wb_id hash
-    barcode_hashmap = dict()
-
     for item in raw_stock:
         # Get or create new product:
         product = stock_products.get(item["nmId"], None)
@@ -43,35 +26,29 @@ def get_marketplace_objects(token):
         product.brand = item.get("brand", "")
         product.category = item.get("category", "")
 
-        product = get_price_change_from_redis(product, x64_token)
-
         # Get or create new size
-        size = item.get("size", 0)
-        product.sizes[size] = product.sizes.get(
-            size, Size(tech_size=size)  # Create generic size
-        )
+        size = product.get_size(item.get("size", 0))
 
         # Update size values
-        product.sizes[size].quantity_full = item.get("stock", 0)
-        product.sizes[size].barcode = item.get("barcode", 0)
-        barcode_hashmap[item.get("barcode", 0)] = (
-            product.nm_id,
-            item.get("size", 0),
-        )
-
-    return stock_products, barcode_hashmap
+        size.quantity_full = item.get("stock", 0)
+        size.barcode = item.get("barcode", 0)
 
+    return apply_price_changes(stock_products, price_changes)
 
-def update_prices(token, stock_products):
-    tokens = ApiKey.objects.get(api=token)
-    new_token = tokens.new_api
-    if not new_token:
-        return HttpResponse("Нужно указать API-ключ!")
 
-    new_client = StandardApiClient(new_token)
+def get_barcode_hashmap(raw_stock: list) -> dict:
+    # For some reason WB don't use wb_id in marketplace sales
+    # So to increase speed of access we create barcode -> wb_id hash
+    barcode_hashmap = dict()
+    for item in raw_stock:
+        barcode_hashmap[item.get("barcode", 0)] = (
+            item["nmId"],
+            item.get("size", 0),
+        )
+    return barcode_hashmap
 
-    prices = new_client.get_prices()
 
+def update_prices(stock_products: dict, prices: list):
     for price in prices:
         product = stock_products.get(price["nmId"])
 
@@ -82,22 +59,24 @@ def update_prices(token, stock_products):
     return stock_products
 
 
-@redis_cache_decorator(minutes=1)
-def update_marketplace_prices(token, stock_products):
-    """We use proxy function to cache results."""
-    return update_prices(token, stock_products)
+# Raw WB answers are cached, products are merged from them. Products can't be
+# part of cache key, so caching merged products would return somebody's old graph.
+@redis_cache_decorator(minutes=1, local=True, default=list)
+def get_marketplace_stock(jwt_token):
+    return StandardApiClient(jwt_token).get_stock()
 
 
-@redis_cache_decorator(minutes=1)
-def update_warehouse_prices(token, stock_products):
-    return update_prices(token, stock_products)
+@redis_cache_decorator(minutes=1, local=True, default=list)
+def get_price_list(jwt_token):
+    return StandardApiClient(jwt_token).get_prices()
 
 
-@redis_cache_decorator(minutes=1)
-def update_marketplace_sales(token, stock_products, barcode_hashmap):
-    jwt_client = StandardApiClient(token)
-    orders = jwt_client.get_orders(days=14)
+@redis_cache_decorator(minutes=1, local=True, default=list)
+def get_marketplace_orders(jwt_token):
+    return StandardApiClient(jwt_token).get_orders(days=14)
 
+
+def update_marketplace_sales(stock_products: dict, barcode_hashmap: dict, orders: list):
     for order in orders:
         wm_id, size_id = barcode_hashmap.get(
             order["barcode"],
@@ -112,17 +91,12 @@ def update_marketplace_sales(token, stock_products, barcode_hashmap):
         product = stock_products.get(wm_id)
         if not product:
             continue
-        size: Size = product.sizes.get(size_id, Size(size_id))
         status = int(order.get("status"))
-        sale = Sale(
-            date=order.get("dateCreated"),
-            quantity=1,
-            finished_price=float(order.get("totalPrice") / 100),
-        )
+        revenue = float(order.get("totalPrice") / 100)
         if status == 0:
             # Fresh new orders, must be processed immediately!
-            size.orders.append(sale)
+            product.add_order(size_id, revenue)
         else:
-            size.sales.append(sale)
+            product.add_sale(size_id, revenue)
 
     return stock_products
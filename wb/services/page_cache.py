@@ -0,0 +1,86 @@
+from collections import Counter
+from threading import Lock
+from typing import Optional
+
+from cachetools import LRUCache
+from django.http import HttpResponse
+from loguru import logger
+
+from _settings.settings import (
+    PAGE_CACHE_LOCAL_MAX_BYTES,
+    PAGE_CACHE_SECONDS,
+    redis_client,
+)
+from wb.services import codec
+
+# ETag -> (content type, body). ETag is made of data versions and query, so
+# refresh or price change gives pages new keys and old ones just expire
+local_pages = LRUCache(
+    maxsize=PAGE_CACHE_LOCAL_MAX_BYTES, getsizeof=lambda page: len(page[1])
+)
+local_pages_lock = Lock()
+counters = Counter()
+
+
+def get_page_key(etag) -> str:
+    return "page:" + etag.strip('"')
+
+
+def count(name):
+    with local_pages_lock:
+        counters[name] += 1
+
+
+def get_cached_page(etag) -> Optional[HttpResponse]:
+    """Rendered page from worker memory or Redis, None if it was not rendered yet."""
+    key = get_page_key(etag)
+    with local_pages_lock:
+        page = local_pages.get(key)
+    if page is None:
+        blob = redis_client.get(key)
+        if blob is None:
+            count("misses")
+            return None
+        try:
+            page = codec.loads(blob)
+        except codec.CacheFormatError:
+            logger.info(f"Dropping page {key} of another format")
+            redis_client.delete(key)
+            count("misses")
+            return None
+        set_local_page(key, page)
+        count("redis_hits")
+    else:
+        count("local_hits")
+    content_type, content = page
+    return HttpResponse(content, content_type=content_type)
+
+
+def set_local_page(key, page):
+    with local_pages_lock:
+        try:
+            local_pages[key] = page
+        except ValueError:
+            # Bigger than the whole budget, keep it in Redis only
+            pass
+
+
+def set_cached_page(etag, response):
+    """Keep rendered page for other requests with the same ETag."""
+    if response.status_code != 200 or response.streaming:
+        return
+    key = get_page_key(etag)
+    page = (response["Content-Type"], response.content)
+    set_local_page(key, page)
+    redis_client.set(key, codec.dumps(page), ex=PAGE_CACHE_SECONDS)
+    count("stored")
+
+
+def get_page_cache_metrics() -> dict:
+    """Hits and misses of page cache in this process."""
+    with local_pages_lock:
+        return {
+            **counters,
+            "local_pages": len(local_pages),
+            "local_bytes": local_pages.currsize,
+        }
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+from loguru import logger
+
+from wb.services.executor import FOREGROUND, get_executor
+
+pipelines = dict()  # Name -> pipeline, for metrics
+
+
+@dataclass(frozen=True)
+class Stage:
+    """Step of pipeline, called with results of its inputs in that order.
+
+    Inputs are names of other stages or of values pipeline is run with.
+    """
+
+    name: str
+    func: Callable
+    inputs: Tuple[str, ...] = ()
+
+
+class Pipeline:
+    """Runs every stage as soon as its inputs are ready.
+
+    Fetches without common inputs go in parallel, so cold build takes about
+    as long as the slowest chain of stages, not the sum of all of them.
+    Stages share results, so merges that mutate the same objects must be
+    chained through inputs.
+    """
+
+    def __init__(self, name, stages: list):
+        self.name = name
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError(f"Stage names of {name} pipeline are not unique")
+        self.runs = Counter()
+        self.timings = defaultdict(lambda: deque(maxlen=100))  # Recent durations
+        self.lock = threading.Lock()
+        pipelines[name] = self
+
+    def check(self, values: dict):
+        known = set(values)
+        pending = dict(self.stages)
+        # Repeatedly take stages whose inputs are known, leftovers are a cycle
+        while pending:
+            ready = [
+                name
+                for name, stage in pending.items()
+                if all(i in known for i in stage.inputs)
+            ]
+            if not ready:
+                raise ValueError(
+                    f"Stages {sorted(pending)} of {self.name} pipeline "
+                    "have unknown inputs or depend on each other"
+                )
+            for name in ready:
+                known.add(name)
+                del pending[name]
+
+    def run(self, executor=FOREGROUND, **values) -> Tuple[dict, dict]:
+        """Results and seconds spent by every stage."""
+        self.check(values)
+        executor = get_executor(executor)
+        results = dict(values)
+        timings = dict()
+        waiting = dict(self.stages)
+        running = dict()  # Future -> stage name
+        started = time.monotonic()
+
+        def timed(stage: Stage, args):
+            stage_started = time.monotonic()
+            try:
+                return stage.func(*args)
+            finally:
+                timings[stage.name] = time.monotonic() - stage_started
+
+        def submit_ready():
+            for name, stage in list(waiting.items()):
+                if all(i in results for i in stage.inputs):
+                    args = [results[i] for i in stage.inputs]
+                    future = executor.submit(timed, (stage, args))
+                    running[future] = name
+                    del waiting[name]
+
+        try:
+            submit_ready()
+            while running:
+                for future in executor.wait_any(list(running)):
+                    results[running.pop(future)] = executor.result(future)
+                submit_ready()
+        finally:
+            for future in running:
+                future.cancel()
+
+        self.record(timings)
+        logger.info(
+            f"{self.name} pipeline took {time.monotonic() - started:.1f}s: "
+            + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        )
+        return results, timings
+
+    def record(self, timings: dict):
+        with self.lock:
+            for name, seconds in timings.items():
+                self.runs[name] += 1
+                self.timings[name].append(seconds)
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {
+                name: {
+                    "runs": self.runs[name],
+                    "avg_seconds": sum(samples) / len(samples),
+                    "max_seconds": max(samples),
+                }
+                for name, samples in self.timings.items()
+            }
+
+
+def get_pipeline_metrics() -> dict:
+    """Stage timings of pipelines run by this process."""
+    return {name: pipeline.get_metrics() for name, pipeline in pipelines.items()}
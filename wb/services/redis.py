@@ -1,103 +1,413 @@
 import datetime
 import functools
 import json
+import os
 import pickle
-from threading import Thread
-from typing import Callable
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, Optional
 
+from cachetools import LRUCache
 from loguru import logger
 
 from _settings.settings import (
+    CACHE_LEASE_SECONDS,
+    CACHE_FAILURE_SECONDS,
+    CACHE_LEASE_WAIT_SECONDS,
+    CACHE_LOCAL_FRESH_SECONDS,
+    CACHE_LOCAL_MAX_BYTES,
     STATISTIC_REFRESH_THRESHOLD,
     redis_client,
-    running_threads,
 )
+from wb.services import codec
+from wb.services.executor import BACKGROUND, get_executor
+from wb.services.rest_client.retry import WbApiError
 
+MISSING = object()  # Sentinel for cache miss, None is a valid cached value
+
+# Delete lease only if we still own it (it may have expired and been taken over)
+_release_lease_script = redis_client.register_script(
+    """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+)
+
+
+def acquire_lease(redis_full_key: str) -> Optional[str]:
+    """Try to become the only process in cluster recalculating this key."""
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    if redis_client.set(
+        f"{redis_full_key}:lease", owner, nx=True, ex=CACHE_LEASE_SECONDS
+    ):
+        return owner
+    return None
+
+
+def release_lease(redis_full_key: str, owner: str):
+    """Release lease and wake up everybody who is waiting for the result."""
+    _release_lease_script(keys=[f"{redis_full_key}:lease"], args=[owner])
+    redis_client.publish(f"{redis_full_key}:done", owner)
+
+
+def wait_for_lease(redis_full_key: str, timeout=CACHE_LEASE_WAIT_SECONDS) -> bool:
+    """Block until lease owner publishes the result, lease expires or timeout.
+
+    False on timeout, lease is still taken then.
+    """
+    lease_key = f"{redis_full_key}:lease"
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"{redis_full_key}:done")
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # Checked after subscribing, so we can't miss release in between
+            if not redis_client.exists(lease_key):
+                return True
+            # Poll once per second in case owner died without publishing
+            if pubsub.get_message(timeout=1):
+                return True
+        logger.info(f"Gave up waiting for {redis_full_key} after {timeout}s")
+        return False
+    finally:
+        pubsub.close()
+
+
+@dataclass
+class LocalEntry:
+    """Decoded value kept in worker memory until Redis has a newer one."""
+
+    value: Any
+    updated_at: bytes  # Raw value of timestamp key the value belongs to
+    size: int
+    checked_at: float
+
+
+local_cache = LRUCache(maxsize=CACHE_LOCAL_MAX_BYTES, getsizeof=lambda e: e.size)
+local_cache_lock = Lock()
+
+
+def get_local_entry(redis_full_key: str) -> Optional[LocalEntry]:
+    with local_cache_lock:
+        return local_cache.get(redis_full_key)
+
+
+def set_local_entry(redis_full_key: str, entry: LocalEntry):
+    with local_cache_lock:
+        try:
+            local_cache[redis_full_key] = entry
+        except ValueError:
+            # Bigger than the whole budget, keep it in Redis only
+            local_cache.pop(redis_full_key, None)
+
+
+def get_cache_key(func_name, token, args, kwargs) -> str:
+    arg_str = ""
+    kwarg_str = ""
+    try:
+        arg_str = json.dumps(args)
+    except Exception:
+        pass
+    try:
+        kwarg_str = json.dumps(kwargs)
+    except Exception:
+        pass
+    return f"{token}:{func_name}:args{arg_str}{kwarg_str}"
+
+
+def redis_cache_decorator(
+    minutes=STATISTIC_REFRESH_THRESHOLD,
+    local=False,
+    default: Callable = None,
+    load: Callable = None,
+):
+    """Cache in Redis, refresh in background after `minutes`.
+
+    With `local=True` decoded values are also kept in worker memory and
+    revalidated against Redis timestamp key. They are shared between
+    requests, so only use it for results nobody mutates.
+
+    When WB fails, last good value is kept and the failure is remembered for
+    CACHE_FAILURE_SECONDS. Without good value callers get `default()`, or
+    WbApiError if there is no default or they call `wrapper.strict`.
+
+    With `load` the function keeps its result in Redis itself and only the
+    timestamp is cached here. `load(token, *args, **kwargs)` reads the result
+    back as `(value, size)`, None if there is none.
+    """
 
-def redis_cache_decorator(minutes=STATISTIC_REFRESH_THRESHOLD):
     def decorator(func: Callable):
-        @functools.wraps(func)
-        def wrapper(token, *args, **kwargs):
-            # logger.info(f"Redis decorator for {func.__name__} with {token=}")
-            api_key = token
-            arg_str = ""
-            kwarg_str = ""
+        def run_and_cache(token, args, kwargs, owner=None):
+            redis_full_key = get_cache_key(func.__name__, token, args, kwargs)
+            started_at = datetime.datetime.now()
             try:
-                arg_str = json.dumps(args)
-            except Exception:
-                pass
+                try:
+                    result = func(token, *args, **kwargs)
+                except WbApiError as e:
+                    redis_client.set(
+                        f"{redis_full_key}:failed", str(e), ex=CACHE_FAILURE_SECONDS
+                    )
+                    raise
+                updated_at = pickle.dumps(started_at)
+                if load is None:
+                    blob, size = codec.encode(result)
+                    redis_client.set(redis_full_key, blob, ex=60 * 60 * 24 * 7)
+                redis_client.set(
+                    f"{redis_full_key}:updated_at", updated_at, ex=60 * 60 * 24 * 7
+                )
+            finally:
+                if owner:
+                    release_lease(redis_full_key, owner)
+            if local and load is None:
+                # Size of loaded value is known when it is read back
+                set_local_entry(
+                    redis_full_key,
+                    LocalEntry(result, updated_at, size, time.monotonic()),
+                )
+            return result
+
+        def refresh(token, *args, **kwargs) -> bool:
+            """Recalculate now, unless somebody else already does."""
+            owner = acquire_lease(get_cache_key(func.__name__, token, args, kwargs))
+            if not owner:
+                return False
             try:
-                kwarg_str = json.dumps(kwargs)
-            except Exception:
-                pass
+                run_and_cache(token, args, kwargs, owner)
+            except WbApiError as e:
+                logger.info(f"{func.__name__} failed, keeping old value: {e}")
+                return False
+            return True
 
-            args_key = "args" + arg_str + kwarg_str
-            redis_full_key = f"{api_key}:{func.__name__}:{args_key}"
+        def get_cached(token, args, kwargs, default):
+            # logger.info(f"Redis decorator for {func.__name__} with {token=}")
+            redis_full_key = get_cache_key(func.__name__, token, args, kwargs)
             redis_timestamp_key = f"{redis_full_key}:updated_at"
+            redis_failure_key = f"{redis_full_key}:failed"
 
-            cached_result = redis_client.get(redis_full_key)
-            timestamp = redis_client.get(redis_timestamp_key)
             current_time = datetime.datetime.now()
 
             threshold = datetime.timedelta(minutes=minutes)
 
-            def run_and_cache():
-                running_threads.add(redis_full_key)
-                result = func(token, *args, **kwargs)
-                redis_client.set(
-                    redis_full_key, pickle.dumps(result), ex=60 * 60 * 24 * 7
-                )
-                redis_client.set(
-                    redis_timestamp_key, pickle.dumps(current_time), ex=60 * 60 * 24 * 7
-                )
-                # logger.info(
-                #     f"Redis decorator for {func.__name__}: finished calc in thread!"
-                # )
-                try:
-                    running_threads.remove(redis_full_key)
-                except KeyError:
-                    pass
-                return result
-
-            if not cached_result:
-                # logger.info(f"Redis decorator for {func.__name__}: not found, calculating")
-                cached_result = run_and_cache()
-            else:
+            def run_or_fallback(owner=None):
                 try:
-                    cached_result = pickle.loads(cached_result)
-                except Exception:
-                    cached_result = json.loads(cached_result)
-                if redis_full_key not in running_threads:
-                    if not timestamp:
-                        timestamp = current_time - datetime.timedelta(minutes=11)
-                        redis_client.set(
-                            redis_timestamp_key, pickle.dumps(current_time)
+                    return run_and_cache(token, args, kwargs, owner)
+                except WbApiError as e:
+                    return fallback(e)
+
+            def fallback(error: WbApiError):
+                if default is None:
+                    raise error
+                logger.info(f"{func.__name__} failed, nothing cached yet: {error}")
+                return default()
+
+            def read_cache():
+                if load is not None:
+                    # Timestamp first, so value is at least that fresh
+                    updated_at = redis_client.get(redis_timestamp_key)
+                    loaded = load(token, *args, **kwargs)
+                    if loaded is None:
+                        return MISSING, updated_at
+                    result, size = loaded
+                else:
+                    cached, updated_at = redis_client.mget(
+                        redis_full_key, redis_timestamp_key
+                    )
+                    if cached is None:
+                        return MISSING, updated_at
+                    try:
+                        result, size = codec.decode(cached)
+                    except codec.CacheFormatError:
+                        logger.info(f"Outdated cache format for {func.__name__}")
+                        return MISSING, updated_at
+                if local and updated_at is not None:
+                    set_local_entry(
+                        redis_full_key,
+                        LocalEntry(result, updated_at, size, time.monotonic()),
+                    )
+                return result, updated_at
+
+            def revalidate_local(entry: LocalEntry):
+                # Small GET of timestamp instead of the whole payload
+                updated_at = redis_client.get(redis_timestamp_key)
+                if updated_at != entry.updated_at:
+                    return MISSING, None
+                entry.checked_at = time.monotonic()
+                return entry.value, entry.updated_at
+
+            cached_result, timestamp = MISSING, None
+            if local:
+                entry = get_local_entry(redis_full_key)
+                if entry is not None:
+                    if time.monotonic() - entry.checked_at < CACHE_LOCAL_FRESH_SECONDS:
+                        return entry.value
+                    cached_result, timestamp = revalidate_local(entry)
+            if cached_result is MISSING:
+                cached_result, timestamp = read_cache()
+            while cached_result is MISSING:
+                failure = redis_client.get(redis_failure_key)
+                if failure is not None:
+                    # WB has just failed us, don't hammer it
+                    return fallback(WbApiError(failure.decode()))
+                owner = acquire_lease(redis_full_key)
+                if owner:
+                    # Previous owner could finish right before we got the lease
+                    cached_result, timestamp = read_cache()
+                    if cached_result is MISSING:
+                        return run_or_fallback(owner)
+                    release_lease(redis_full_key, owner)
+                else:
+                    # Somebody else is already calculating, wait for its result
+                    logger.info(f"Waiting for {func.__name__} calculated elsewhere")
+                    released = wait_for_lease(redis_full_key)
+                    cached_result, timestamp = read_cache()
+                    if cached_result is MISSING and not released:
+                        # Owner is still at it, don't keep user waiting longer
+                        return fallback(
+                            WbApiError(f"{func.__name__} takes too long elsewhere")
                         )
-                    else:
-                        timestamp = pickle.loads(timestamp)
-                    if current_time - timestamp > threshold:
-                        # logger.info(
-                        # f"Redis decorator for {func.__name__}: found! Running update in thread..."
-                        # )
-                        thread = Thread(target=run_and_cache)
-                        thread.start()
-                    # else:
-                    #     logger.info(
-                    #         f"Less than {minutes} minutes passed since previous check for {func.__name__}"
-                    #     )
-                # else:
-                # logger.info(f"Redis decorator for {func.__name__}: is already running")
+                # Owner gave up without result, take the lease again
+
+            if not timestamp:
+                timestamp = current_time - datetime.timedelta(minutes=11)
+                redis_client.set(redis_timestamp_key, pickle.dumps(current_time))
+            else:
+                timestamp = pickle.loads(timestamp)
+            if current_time - timestamp > threshold and not redis_client.exists(
+                redis_failure_key
+            ):
+                # Lease is taken when the task starts, queued one waits only once
+                get_executor(BACKGROUND).submit(
+                    refresh, (token, *args), kwargs, key=redis_full_key
+                )
             return cached_result
 
+        @functools.wraps(func)
+        def wrapper(token, *args, **kwargs):
+            return get_cached(token, args, kwargs, default)
+
+        def strict(token, *args, **kwargs):
+            """Same as wrapper, but WbApiError instead of `default()`.
+
+            For callers that cache something derived from the value, so a
+            fallback is not taken for real data.
+            """
+            return get_cached(token, args, kwargs, None)
+
+        def refresh_if_stale(token, updated_at, failure, *args, **kwargs) -> bool:
+            """Refresh in background if raw timestamp is missing or older than
+            `minutes`, unless WB failure is remembered for the key.
+
+            For callers that read timestamps and failures of many keys at once.
+            """
+            if failure is not None:
+                return False
+            if updated_at is not None:
+                age = datetime.datetime.now() - pickle.loads(updated_at)
+                if age <= datetime.timedelta(minutes=minutes):
+                    return False
+            get_executor(BACKGROUND).submit(
+                refresh,
+                (token, *args),
+                kwargs,
+                key=get_cache_key(func.__name__, token, args, kwargs),
+            )
+            return True
+
+        def get_version(token, *args, **kwargs) -> Optional[bytes]:
+            """Raw timestamp of cached value, None if there is none yet.
+
+            Stale value is refreshed in background, like reading it would do.
+            """
+            redis_full_key = get_cache_key(func.__name__, token, args, kwargs)
+            updated_at, failure = redis_client.mget(
+                f"{redis_full_key}:updated_at", f"{redis_full_key}:failed"
+            )
+            if updated_at is None:
+                return None
+            refresh_if_stale(token, updated_at, failure, *args, **kwargs)
+            return updated_at
+
+        # Used by background scheduler to find and refresh stale keys
+        wrapper.refresh = refresh
+        wrapper.strict = strict
+        # Used by views to answer 304 without loading the value
+        wrapper.get_version = get_version
+        wrapper.refresh_if_stale = refresh_if_stale
+        wrapper.get_cache_key = lambda token, *args, **kwargs: get_cache_key(
+            func.__name__, token, args, kwargs
+        )
+        wrapper.minutes = minutes
         return wrapper
 
     return decorator
 
 
-def get_price_change_from_redis(product, x64_token):
-    redis_key = f"{x64_token}:update_discount:{product.nm_id}"
-    has_been_updated = redis_client.get(redis_key)
-    if has_been_updated is not None:
-        logger.info(f"Found update info for {product.nm_id}")
-        product.has_been_updated = pickle.loads(has_been_updated)
-    return product
+LAST_ACCESS_KEY = "scheduler:last_access"
+
+
+def record_access(token):
+    """Remember when somebody looked at token data, see wb.services.scheduler."""
+    redis_client.zadd(LAST_ACCESS_KEY, {token: time.time()})
+
+
+def get_active_tokens(idle_seconds) -> dict:
+    """Token -> last access time for tokens opened within idle_seconds."""
+    oldest = time.time() - idle_seconds
+    redis_client.zremrangebyscore(LAST_ACCESS_KEY, "-inf", oldest)
+    return {
+        token.decode(): last_access
+        for token, last_access in redis_client.zrangebyscore(
+            LAST_ACCESS_KEY, oldest, "+inf", withscores=True
+        )
+    }
+
+
+PRICE_CHANGE_TTL = datetime.timedelta(days=14)  # Keep info about price change
+
+
+def set_price_change_to_redis(x64_token, wb_id, price_change: dict):
+    """All price changes of token live in one hash keyed by nm_id."""
+    redis_key = f"{x64_token}:update_discount"
+    pipe = redis_client.pipeline()
+    pipe.hset(redis_key, int(wb_id), pickle.dumps(price_change))
+    pipe.expire(redis_key, PRICE_CHANGE_TTL)
+    # Snapshots built before this change are outdated now
+    pipe.incr(get_price_version_key(x64_token))
+    pipe.execute()
+
+
+def get_price_version_key(x64_token):
+    return f"{x64_token}:update_discount:version"
+
+
+def get_price_changes_from_redis(x64_token) -> dict:
+    """Load all price changes with one round trip, drop ones older than 14 days."""
+    redis_key = f"{x64_token}:update_discount"
+    now = datetime.datetime.now(datetime.timezone.utc)
+    price_changes = dict()
+    expired = []
+    for nm_id, value in redis_client.hgetall(redis_key).items():
+        price_change = pickle.loads(value)
+        # Hash fields can't expire on their own, so we check age here
+        if now - price_change["modified_at"] > PRICE_CHANGE_TTL:
+            expired.append(nm_id)
+            continue
+        price_changes[int(nm_id)] = price_change
+    if expired:
+        redis_client.hdel(redis_key, *expired)
+    return price_changes
+
+
+def apply_price_changes(products: dict, price_changes: dict) -> dict:
+    for nm_id, price_change in price_changes.items():
+        product = products.get(nm_id)
+        if product is not None:
+            product.has_been_updated = price_change
+    if price_changes:
+        logger.info(f"Found update info for {len(price_changes)} products")
+    return products
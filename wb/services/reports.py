@@ -0,0 +1,75 @@
+from django.db.models import F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from wb.models import OrderRow, StockRow
+
+
+def get_today_rows(model, token):
+    """Today's orders or sales, newest first, as raw WB rows."""
+    today = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+    return (
+        model.objects.filter(token=token, date__gte=today)
+        .order_by("-date")
+        .values_list("data", flat=True)
+    )
+
+
+def get_orders_summary(token, to_order=False):
+    """Orders of sync window per product with stock, most ordered first."""
+    stock = (
+        StockRow.objects.filter(token=token, nm_id=OuterRef("nm_id"))
+        .values("nm_id")
+        .annotate(total=Sum("quantity_full"))
+        .values("total")
+    )
+    summary = (
+        OrderRow.objects.filter(token=token)
+        .values("nm_id")
+        .annotate(
+            total=Sum("quantity"),
+            sku=Max("supplier_article"),
+            stock=Coalesce(Subquery(stock), 0),
+        )
+        .order_by("-total", "nm_id")
+    )
+    if to_order:
+        summary = summary.filter(total__gt=F("stock"))
+    return summary
+
+
+def get_summary_sizes(token, summary_rows) -> list:
+    """Add per size orders and stock to one page of get_orders_summary."""
+    nm_ids = [row["nm_id"] for row in summary_rows]
+    ordered_sizes = OrderRow.objects.filter(token=token, nm_id__in=nm_ids)
+    stock_sizes = StockRow.objects.filter(token=token, nm_id__in=nm_ids)
+
+    sizes = dict()
+    for row in (
+        ordered_sizes.values("nm_id", "tech_size")
+        .annotate(qty=Sum("quantity"))
+        .order_by()
+    ):
+        sizes.setdefault(row["nm_id"], dict())[row["tech_size"]] = row["qty"]
+    stock = dict()
+    for row in (
+        stock_sizes.values("nm_id", "tech_size")
+        .annotate(qty=Sum("quantity_full"))
+        .order_by()
+    ):
+        stock.setdefault(row["nm_id"], dict())[row["tech_size"]] = row["qty"]
+
+    return [
+        (
+            row["nm_id"],
+            {
+                "sizes": sizes.get(row["nm_id"], dict()),
+                "total": row["total"],
+                "sku": row["sku"],
+                "stock": row["stock"],
+                # get_size_stock template tag expects it wrapped in tuple
+                "stock_sizes": (stock.get(row["nm_id"], dict()),),
+            },
+        )
+        for row in summary_rows
+    ]
@@ -0,0 +1,310 @@
+import datetime
+import functools
+import io
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+STATISTICS_PAGE_LIMIT = 80000  # Same cut as WB, see wb.services.sync
+SIZES = ("S", "M")
+WAREHOUSES = ("Коледино", "Подольск")
+SUBJECTS = ("Платья", "Футболки", "Джинсы", "Куртки", "Рубашки", "Свитеры")
+BRANDS = ("Zarina", "Befree", "Gloria Jeans", "Sela", "O'stin")
+
+
+class FakeWbApi:
+    """Synthetic WB statistics and suppliers API, same data for the same seed.
+
+    `rows` is amount of stock rows, every product has a row per size and
+    warehouse. Orders are as many as stock rows, sales are half of that,
+    all within the last 14 days. `error_rate` of requests get 429 or 500,
+    every answer takes `latency` seconds.
+    """
+
+    def __init__(self, rows=1000, latency=0.0, error_rate=0.0, seed=0):
+        self.rows = rows
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()  # Endpoint -> calls, failed ones included
+        self.routes = {
+            ("GET", "/api/v1/supplier/stocks"): self.get_statistics_stocks,
+            ("GET", "/api/v1/supplier/orders"): self.get_statistics_orders,
+            ("GET", "/api/v1/supplier/sales"): self.get_statistics_sales,
+            ("GET", "/api/v2/stocks"): self.get_stocks,
+            ("GET", "/api/v2/orders"): self.get_orders,
+            ("GET", "/public/api/v1/info"): self.get_prices,
+            ("POST", "/public/api/v1/updateDiscounts"): self.update_discounts,
+            ("POST", "/content/v1/cards/cursor/list"): self.get_cards,
+        }
+
+    @classmethod
+    def from_spec(cls, spec):
+        """FakeWbApi from string like "rows=20000,latency=0.1,error_rate=0.05"."""
+        types = {"rows": int, "latency": float, "error_rate": float, "seed": int}
+        kwargs = dict()
+        for item in filter(None, spec.split(",")):
+            name, _, value = item.partition("=")
+            if name.strip() not in types:
+                raise ValueError(f"Unknown fake WB option {name}")
+            kwargs[name.strip()] = types[name.strip()](value)
+        return cls(**kwargs)
+
+    @property
+    def products(self):
+        return max(self.rows // (len(SIZES) * len(WAREHOUSES)), 1)
+
+    @functools.cached_property
+    def data(self) -> dict:
+        """Rows of every endpoint, made on first request."""
+        rnd = random.Random(self.seed)
+        now = datetime.datetime.now().replace(microsecond=0)
+
+        def get_date(days):
+            return now - datetime.timedelta(seconds=rnd.randrange(days * 24 * 3600))
+
+        cards = []
+        for number in range(self.products):
+            nm_id = 10_000_000 + number
+            cards.append(
+                {
+                    "nmID": nm_id,
+                    "vendorCode": f"ART-{number}",
+                    "object": rnd.choice(SUBJECTS),
+                    "brand": rnd.choice(BRANDS),
+                    "price": rnd.randrange(500, 10000, 10),
+                    "discount": rnd.choice((0, 10, 15, 20, 30, 50)),
+                    "updateAt": get_date(60).strftime(DATE_FORMAT),
+                    "mediaFiles": [f"https://images.wbstatic.net/big/{nm_id}.jpg"],
+                }
+            )
+
+        stocks = []
+        for card in cards:
+            for size in SIZES:
+                barcode = f"{card['nmID']}{SIZES.index(size)}"
+                for warehouse in WAREHOUSES:
+                    stocks.append(
+                        {
+                            "lastChangeDate": get_date(10).strftime(DATE_FORMAT),
+                            "supplierArticle": card["vendorCode"],
+                            "techSize": size,
+                            "barcode": barcode,
+                            "quantity": rnd.randrange(30),
+                            "isSupply": True,
+                            "isRealization": False,
+                            "quantityFull": rnd.randrange(40),
+                            "inWayToClient": rnd.randrange(5),
+                            "inWayFromClient": rnd.randrange(3),
+                            "warehouseName": warehouse,
+                            "nmId": card["nmID"],
+                            "subject": card["object"],
+                            "category": "Одежда",
+                            "daysOnSite": rnd.randrange(400),
+                            "brand": card["brand"],
+                            "Price": card["price"],
+                            "Discount": card["discount"],
+                        }
+                    )
+
+        def make_rows(amount, prefix):
+            rows = []
+            for number in range(amount):
+                stock = rnd.choice(stocks)
+                date = get_date(14)
+                changed_at = min(
+                    date + datetime.timedelta(hours=rnd.randrange(48)), now
+                )
+                price = stock["Price"] * (100 - stock["Discount"]) / 100
+                rows.append(
+                    {
+                        "date": date.strftime(DATE_FORMAT),
+                        "lastChangeDate": changed_at.strftime(DATE_FORMAT),
+                        "supplierArticle": stock["supplierArticle"],
+                        "techSize": stock["techSize"],
+                        "barcode": stock["barcode"],
+                        "quantity": 1,
+                        "totalPrice": stock["Price"],
+                        "discountPercent": stock["Discount"],
+                        "warehouseName": stock["warehouseName"],
+                        "nmId": stock["nmId"],
+                        "subject": stock["subject"],
+                        "category": stock["category"],
+                        "brand": stock["brand"],
+                        "priceWithDisc": price,
+                        "finishedPrice": price,
+                        "forPay": round(price * 0.85, 2),
+                        "odid": number,
+                        "srid": f"{prefix}{number}",
+                    }
+                )
+                if prefix == "s":
+                    rows[-1]["saleID"] = f"S{number}"
+            return rows
+
+        orders = make_rows(self.rows, "o")
+        sales = make_rows(self.rows // 2, "s")
+        for rows in (stocks, orders, sales):
+            rows.sort(key=lambda row: row["lastChangeDate"])
+
+        # Suppliers API shows the same goods, stock of one warehouse
+        marketplace_stocks = [
+            {
+                "nmId": row["nmId"],
+                "article": row["supplierArticle"],
+                "size": row["techSize"],
+                "barcode": row["barcode"],
+                "stock": row["quantity"],
+                "subject": row["subject"],
+                "brand": row["brand"],
+                "category": row["category"],
+                "name": f"{row['subject']} {row['brand']}",
+            }
+            for row in stocks
+            if row["warehouseName"] == WAREHOUSES[0]
+        ]
+        marketplace_orders = [
+            {
+                "orderId": row["odid"],
+                "dateCreated": row["date"],
+                "barcode": row["barcode"],
+                "status": row["odid"] % 4,
+                "totalPrice": int(row["priceWithDisc"] * 100),  # Kopecks
+            }
+            for row in orders
+        ]
+        return {
+            "cards": cards,
+            "stocks": stocks,
+            "orders": orders,
+            "sales": sales,
+            "marketplace_stocks": marketplace_stocks,
+            "marketplace_orders": marketplace_orders,
+        }
+
+    def handle(self, request: requests.PreparedRequest):
+        """Status, JSON body and headers of answer."""
+        url = urllib.parse.urlsplit(request.url)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        route = self.routes.get((request.method, url.path))
+        with self.lock:
+            self.requests[url.path] += 1
+            failed = self.random.random() < self.error_rate
+            throttled = self.random.random() < 0.5
+        time.sleep(self.latency)
+        if route is None:
+            return 404, {"errors": [f"No {request.method} {url.path}"]}, {}
+        if failed and throttled:
+            return 429, {"errors": ["Too many requests"]}, {"X-Ratelimit-Retry": "0.1"}
+        if failed:
+            return 500, {"errors": ["Internal error"]}, {}
+        body = json.loads(request.body) if request.body else None
+        return 200, route(params, body), {}
+
+    # Statistics API, flag=0 is rows changed since dateFrom, flag=1 rows of that day
+    def get_statistics_rows(self, endpoint, params):
+        date_from = params["dateFrom"][:19]
+        if endpoint != "stocks" and params.get("flag") == "1":
+            day = date_from[:10]
+            return [row for row in self.data[endpoint] if row["date"][:10] == day]
+        rows = [
+            row for row in self.data[endpoint] if row["lastChangeDate"] >= date_from
+        ]
+        return rows[:STATISTICS_PAGE_LIMIT]
+
+    def get_statistics_stocks(self, params, body):
+        return self.get_statistics_rows("stocks", params)
+
+    def get_statistics_orders(self, params, body):
+        return self.get_statistics_rows("orders", params)
+
+    def get_statistics_sales(self, params, body):
+        return self.get_statistics_rows("sales", params)
+
+    # Suppliers API, lists are paginated with skip and take
+    @staticmethod
+    def get_page(items, params):
+        skip, take = int(params.get("skip", 0)), int(params.get("take", 1000))
+        return items[skip : skip + take]
+
+    def get_stocks(self, params, body):
+        stocks = self.data["marketplace_stocks"]
+        return {"total": len(stocks), "stocks": self.get_page(stocks, params)}
+
+    def get_orders(self, params, body):
+        orders = self.data["marketplace_orders"]
+        return {"total": len(orders), "orders": self.get_page(orders, params)}
+
+    def get_prices(self, params, body):
+        return [
+            {"nmId": card["nmID"], "price": card["price"], "discount": card["discount"]}
+            for card in self.data["cards"]
+        ]
+
+    def update_discounts(self, params, body):
+        return {}
+
+    def get_cards(self, params, body):
+        cursor = body["sort"]["cursor"]
+        cards = sorted(self.data["cards"], key=lambda card: card["nmID"])
+        start = 0
+        if "nmID" in cursor:
+            start = next(
+                (i for i, card in enumerate(cards) if card["nmID"] > cursor["nmID"]),
+                len(cards),
+            )
+        page = cards[start : start + cursor["limit"]]
+        last = page[-1] if page else {"updateAt": "", "nmID": cursor.get("nmID", 0)}
+        return {
+            "data": {
+                "cards": page,
+                "cursor": {
+                    "updatedAt": last["updateAt"],
+                    "nmID": last["nmID"],
+                    "total": len(page),
+                },
+            },
+            "error": False,
+        }
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return dict(self.requests)
+
+
+class FakeWbAdapter(BaseAdapter):
+    """Answers requests of session from FakeWbApi, nothing goes to network."""
+
+    def __init__(self, api: FakeWbApi):
+        super().__init__()
+        self.api = api
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        status, body, headers = self.api.handle(request)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(
+            {"Content-Type": "application/json; charset=utf-8", **headers}
+        )
+        response.raw = io.BytesIO(json.dumps(body, ensure_ascii=False).encode())
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.reason = "OK" if status == 200 else "Error"
+        return response
+
+    def close(self):
+        pass
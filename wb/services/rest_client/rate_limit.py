@@ -0,0 +1,94 @@
+import hashlib
+import time
+
+from loguru import logger
+
+from _settings.settings import WB_RATE_LIMIT_MAX_WAIT, WB_RATE_LIMITS, redis_client
+from wb.services.rest_client.retry import RetryableError
+
+# Token bucket which may go below zero: negative balance is the queue of
+# callers that already reserved their turn and sleep until it comes.
+_reserve_script = redis_client.register_script(
+    """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local max_wait = tonumber(ARGV[4])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+    local wait = 0
+    if tokens < 1 then
+        wait = (1 - tokens) / rate
+    end
+    if wait > max_wait then
+        return tostring(-wait)
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens - 1, "ts", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate + wait) + 60)
+    return tostring(wait)
+    """
+)
+
+
+class RateLimited(RetryableError):
+    """Our own queue for this token is too long, WB would answer 429 anyway."""
+
+
+def get_bucket_id(token, group, endpoint):
+    # Tokens are secrets, they must not show up in metrics
+    digest = hashlib.sha1(token.encode()).hexdigest()[:12]
+    return f"{digest}:{group}:{endpoint}"
+
+
+def acquire(token, group, endpoint, max_wait=WB_RATE_LIMIT_MAX_WAIT):
+    """Wait for our turn to call WB endpoint with this token, cluster-wide."""
+    capacity, per_seconds = WB_RATE_LIMITS[group]
+    bucket_id = get_bucket_id(token, group, endpoint)
+    wait = float(
+        _reserve_script(
+            keys=[f"ratelimit:{bucket_id}"],
+            args=[capacity, capacity / per_seconds, time.time(), max_wait],
+        )
+    )
+    metrics_key = f"ratelimit:{bucket_id}:metrics"
+    if wait < 0:
+        redis_client.hincrby(metrics_key, "rejected", 1)
+        raise RateLimited(f"{group} {endpoint} queue is {-wait:.1f}s long")
+
+    pipe = redis_client.pipeline()
+    pipe.sadd("ratelimit:buckets", bucket_id)
+    pipe.hincrby(metrics_key, "calls", 1)
+    if wait > 0:
+        pipe.hincrby(metrics_key, "waiting", 1)
+        pipe.hincrby(metrics_key, "waited_calls", 1)
+        pipe.hincrbyfloat(metrics_key, "wait_seconds", wait)
+    pipe.execute()
+
+    if wait > 0:
+        logger.info(f"Rate limit: waiting {wait:.1f}s for {group} {endpoint}")
+        try:
+            time.sleep(wait)
+        finally:
+            redis_client.hincrby(metrics_key, "waiting", -1)
+
+
+def get_rate_limit_metrics() -> dict:
+    """Queue depth and wait times per token bucket."""
+    metrics = dict()
+    for bucket_id in sorted(redis_client.smembers("ratelimit:buckets")):
+        bucket_id = bucket_id.decode()
+        raw = redis_client.hgetall(f"ratelimit:{bucket_id}:metrics")
+        values = {key.decode(): float(value) for key, value in raw.items()}
+        waited_calls = values.get("waited_calls", 0)
+        metrics[bucket_id] = {
+            "calls": int(values.get("calls", 0)),
+            "rejected": int(values.get("rejected", 0)),
+            "waiting": int(values.get("waiting", 0)),
+            "waited_calls": int(waited_calls),
+            "avg_wait_seconds": values.get("wait_seconds", 0) / waited_calls
+            if waited_calls
+            else 0,
+        }
+    return metrics
@@ -0,0 +1,103 @@
+import email.utils
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import requests
+from loguru import logger
+
+# Worth asking again: throttling, timeouts and WB side failures
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class WbApiError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RetryableError(WbApiError):
+    """Request may succeed later."""
+
+
+class FatalError(WbApiError):
+    """Wrong token, bad request etc. Retrying only burns quota."""
+
+
+def get_retry_after(response: Optional[requests.Response]) -> Optional[float]:
+    """Seconds WB asked us to wait, if it did."""
+    if response is None:
+        return None
+    headers = response.headers
+    for header in ("X-Ratelimit-Retry", "Retry-After"):
+        value = headers.get(header)
+        if not value:
+            continue
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        # Retry-After may also be an HTTP date
+        date = email.utils.parsedate_to_datetime(value)
+        if date is not None:
+            return max(date.timestamp() - time.time(), 0)
+    if headers.get("X-Ratelimit-Remaining") == "0":
+        try:
+            return max(float(headers.get("X-Ratelimit-Reset", "")), 0)
+        except ValueError:
+            pass
+    return None
+
+
+def get_error(response: requests.Response) -> WbApiError:
+    message = f"{response.status_code}, Message: {response.text[:200]}"
+    if response.status_code in RETRYABLE_STATUSES:
+        return RetryableError(message, response.status_code)
+    return FatalError(message, response.status_code)
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter, WB hints take precedence."""
+
+    max_attempts: int = 6
+    base_delay: float = 1
+    max_delay: float = 30
+    max_total_delay: float = 90  # Don't keep a request hanging longer than that
+
+    def get_delay(self, attempt, response=None) -> float:
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, send: Callable[[], requests.Response]) -> requests.Response:
+        total_delay = 0
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = send()
+            except requests.RequestException as e:
+                error = RetryableError(f"{type(e).__name__}: {e}")
+            else:
+                if response.status_code < 400:
+                    return response
+                error = get_error(response)
+                if isinstance(error, FatalError):
+                    raise error
+
+            delay = self.get_delay(attempt, response)
+            attempt += 1
+            if (
+                attempt >= self.max_attempts
+                or total_delay + delay > self.max_total_delay
+            ):
+                raise error
+            logger.info(f"WB error {error}, retry in {delay:.1f}s")
+            time.sleep(delay)
+            total_delay += delay
+
+
+default_policy = RetryPolicy()
@@ -1,8 +1,11 @@
 import json
 
-import requests
 from loguru import logger
 
+from _settings.settings import WB_STANDARD_API_URL
+from wb.services.executor import PAGES, get_executor
+from wb.services.rest_client import rate_limit, transport
+from wb.services.rest_client.retry import WbApiError, default_policy, get_error
 from wb.services.tools import get_date
 
 
@@ -11,7 +14,7 @@ class StandardApiClient:
 
     def __init__(self, new_api_key: str):
         self.token = new_api_key
-        self.base = "https://suppliers-api.wildberries.ru/"
+        self.base = WB_STANDARD_API_URL
 
     def build_headers(self):
         return {
@@ -20,11 +23,26 @@ class StandardApiClient:
             "Content-Type": "application/json",
         }
 
+    def request(self, endpoint, method, url, **kwargs):
+        """Rate limited and retried request, raises WbApiError."""
+
+        def send():
+            rate_limit.acquire(self.token, "standard", endpoint)
+            return transport.request(
+                method, url, headers=self.build_headers(), **kwargs
+            )
+
+        return default_policy.call(send)
+
     def update_discount(self, wb_id, new_discount):
         url = self.base + "public/api/v1/updateDiscounts"
         data = [{"discount": int(new_discount), "nm": int(wb_id)}]
 
-        response = requests.post(
+        try:
+            rate_limit.acquire(self.token, "standard", "discounts")
+        except WbApiError as e:
+            return False, str(e)
+        response = transport.post(
             url, data=json.dumps(data), headers=self.build_headers()
         )
         logger.info(f"{response.status_code}, message: {response.json()}")
@@ -34,14 +52,20 @@ class StandardApiClient:
         error = errors[0] if errors else "Неизвестная ошибка"
         return False, error
 
+    # Fetches below raise WbApiError, even if only one page failed. Results
+    # are cached, so partial list would replace the last good one.
     def get_prices(self):
         url = self.base + "public/api/v1/info"
 
-        response = requests.get(url, headers=self.build_headers())
+        return self.request("prices", "GET", url).json()
 
-        if response.status_code == 200:
-            return response.json()
-        return []
+    def get_remaining_pages(self, get_page, total, offset, key):
+        """First page tells total, the rest are fetched concurrently."""
+        skips = range(offset, total, offset)
+        items = []
+        for response in get_executor(PAGES).map(get_page, skips):
+            items += response.json().get(key, [])
+        return items
 
     def get_stock(self):
         url = self.base + "api/v2/stocks"
@@ -53,19 +77,9 @@ class StandardApiClient:
                 "skip": skip,
                 "take": offset,
             }
-            try:
-                response = requests.get(url, get_params, headers=self.build_headers())
-            except ConnectionError as e:
-                logger.info(f"ConnectionError {e}")
-                return None
-            return response
+            return self.request("stocks", "GET", url, params=get_params)
 
         response = get_page()
-        if not response:
-            return []
-        if response.status_code != 200:
-            logger.info(f"{response.status_code}, {response.text}")
-            return []
 
         stock = []
         batch = response.json()
@@ -73,12 +87,9 @@ class StandardApiClient:
         if total == 0:
             return []
         logger.info(f"Total {total} products")
-        attempt = 1
 
-        stock += batch.get("stocks", 0)
-        while total > offset * attempt:
-            stock += get_page(offset * attempt).json().get("stocks", 0)
-            attempt += 1
+        stock += batch.get("stocks", [])
+        stock += self.get_remaining_pages(get_page, total, offset, "stocks")
         logger.info(f"Got stocks from marketplace {len(stock)} pcs.")
         return stock
 
@@ -93,23 +104,17 @@ class StandardApiClient:
                 "take": offset,
                 "date_start": get_date(days=14),
             }
-            return requests.get(url, get_params, headers=self.build_headers())
+            return self.request("orders", "GET", url, params=get_params)
 
         response = get_page()
-        if response.status_code != 200:
-            logger.info(f"{response.status_code}, {response.text}")
-            return []
 
         orders = []
         batch = response.json()
         total = int(batch.get("total"))
         logger.info(f"Total {total} products")
-        attempt = 1
 
         orders += batch["orders"]
-        while total > offset * attempt:
-            orders += get_page(offset * attempt).json()["orders"]
-            attempt += 1
+        orders += self.get_remaining_pages(get_page, total, offset, "orders")
         logger.info(f"Got orders from marketplace {len(orders)} pcs.")
         return orders
 
@@ -137,7 +142,9 @@ class StandardApiClient:
         total = 1000  # Any number above 1000 will do
         limit = 1000
         while total >= limit:
-            response = requests.post(url, headers=self.build_headers(), data=json.dumps(first_payload))
+            response = self.request(
+                "content", "POST", url, data=json.dumps(first_payload)
+            )
             logger.info(f"Entering loop")
             if response.status_code == 200:
 
@@ -157,6 +164,6 @@ class StandardApiClient:
                     }
             else:
                 logger.info(response.text)
-                break
+                raise get_error(response)
         logger.info("Exit loop")
         return content
@@ -1,45 +1,83 @@
+from contextlib import closing
+
 import requests
 from loguru import logger
 
+from _settings.settings import WB_STATISTICS_API_URL
+from wb.services.rest_client import rate_limit, transport
+from wb.services.rest_client.retry import RetryableError, RetryPolicy, default_policy
+from wb.services.rest_client.streaming import iter_json_array
 from wb.services.tools import get_date
 
-RETRY_DELAY = 0.1
-
 
 class StatisticsApiClient:
     """Get WB stock statistics."""
 
-    def __init__(self, token):
+    def __init__(self, token, retry_policy: RetryPolicy = default_policy):
         self.token = token
+        self.retry_policy = retry_policy
 
-        self.base_url = "https://statistics-api.wildberries.ru/api/v1/supplier/"
+        self.base_url = WB_STATISTICS_API_URL
 
 
-    def connect(self, params, server):
+    def connect(self, params, server, stream=False):
         # redis_client.get_date
 
         headers = {
             "Authorization": self.token,
         }
-        response = requests.get(url=server, params=params, headers=headers)
+        endpoint = server.rsplit("/", 1)[-1]
+
+        def send():
+            rate_limit.acquire(self.token, "statistics", endpoint)
+            return transport.get(server, params=params, headers=headers, stream=stream)
+
+        response = self.retry_policy.call(send)
         logger.info(f"URL WAS: {response.url}")
         return response
 
-    def get_stock(self):
-        logger.info("Preparing url params for stocks...")
+    def iter_rows(self, params, server):
+        """Rows of statistics response one by one, without holding the body.
+
+        Statistics answers are tens of megabytes, parsing them as they come
+        saves holding raw body next to parsed rows. Memory stays flat only
+        if the caller doesn't collect rows itself, sync and get_wider_rows
+        do. Only the request is retried: broken download raises
+        RetryableError after rows before the break are consumed, so sync
+        keeps rows it has and asks again on next refresh.
+        """
+        response = self.connect(params, server, stream=True)
+        with closing(response):
+            try:
+                yield from iter_json_array(response)
+            except (requests.RequestException, ValueError) as e:
+                raise RetryableError(f"Broken {server} response: {e}")
+
+    def get_ordered(self, url, week=False, flag=1, days=None):
         params = {
-            "dateFrom": get_date(days=15),
+            "dateFrom": get_date(week, days),
             "key": self.token,
+            "flag": flag,
         }
-        return self.connect(params, self.base_url + "stocks")
+        return self.connect(params, self.base_url + url)
 
-    def get_ordered(self, url, week=False, flag=1, days=None):
+    def iter_ordered(self, url, week=False, flag=1, days=None):
+        """Same as get_ordered, but rows are streamed."""
         params = {
             "dateFrom": get_date(week, days),
             "key": self.token,
             "flag": flag,
         }
-        return self.connect(params, self.base_url + url)
+        return self.iter_rows(params, self.base_url + url)
+
+    def iter_changes(self, url, date_from):
+        """Rows with lastChangeDate >= date_from, used for incremental sync."""
+        params = {
+            "dateFrom": date_from,
+            "key": self.token,
+            "flag": 0,
+        }
+        return self.iter_rows(params, self.base_url + url)
 
     def get_report(self, url, week=False):
         params = {
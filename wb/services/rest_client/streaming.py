@@ -0,0 +1,74 @@
+import codecs
+import json
+from typing import Iterator
+
+import requests
+
+CHUNK_SIZE = 64 * 1024
+SEPARATORS = " \t\n\r,"
+
+
+class JsonArrayParser:
+    """Incremental parser of a top-level JSON array.
+
+    Feed it chunks of text, it returns items that are complete so far and
+    keeps only the unfinished tail.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, text, final=False) -> list:
+        self.buffer += text
+        buffer = self.buffer
+        position = 0
+        items = []
+        while not self.finished:
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+            if position == len(buffer):
+                break
+            if not self.started:
+                if buffer[position] != "[":
+                    raise ValueError(f"Expected JSON array, got {buffer[:100]!r}")
+                self.started = True
+                position += 1
+            elif buffer[position] == "]":
+                self.finished = True
+            else:
+                try:
+                    item, end = self.decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break  # Item is not complete yet
+                if end == len(buffer) and not final:
+                    break  # Number or literal may continue in next chunk
+                if end < len(buffer) and buffer[end] not in SEPARATORS + "]":
+                    if final:
+                        raise ValueError(f"Unexpected {buffer[end:end + 20]!r}")
+                    break  # Number cut inside, like "34." of "34.5"
+                items.append(item)
+                position = end
+        self.buffer = buffer[position:]
+        if final and not self.finished:
+            raise ValueError("JSON array is not complete")
+        return items
+
+
+def iter_json_array(response: requests.Response, chunk_size=CHUNK_SIZE) -> Iterator:
+    """Yield items of JSON array response while the body is still downloading.
+
+    Response must be opened with stream=True. Only current chunk and one
+    unfinished item are kept in memory, whatever size the response is.
+    """
+    parser = JsonArrayParser()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        yield from parser.feed(text_decoder.decode(chunk))
+        if parser.finished:
+            return
+    yield from parser.feed(text_decoder.decode(b"", final=True), final=True)
@@ -0,0 +1,63 @@
+import os
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from _settings.settings import (
+    WB_FAKE_API,
+    WB_HTTP_POOL_SIZE,
+    WB_HTTP_TIMEOUT,
+    WB_STANDARD_API_URL,
+    WB_STATISTICS_API_URL,
+)
+from wb.services.rest_client.fake import FakeWbAdapter, FakeWbApi
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_fake = FakeWbApi.from_spec(WB_FAKE_API) if WB_FAKE_API else None
+
+
+def get_session() -> requests.Session:
+    """Keep-alive session shared by all threads of the process.
+
+    Recreated after fork, sockets of parent must not be reused.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4, pool_maxsize=WB_HTTP_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                if _fake is not None:
+                    fake_adapter = FakeWbAdapter(_fake)
+                    session.mount(WB_STANDARD_API_URL, fake_adapter)
+                    session.mount(WB_STATISTICS_API_URL, fake_adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def use_fake(api: Optional[FakeWbApi]):
+    """Answer WB requests from fake API instead of network, None to stop."""
+    global _fake, _session
+    with _session_lock:
+        _fake, _session = api, None
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", WB_HTTP_TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs) -> requests.Response:
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, **kwargs) -> requests.Response:
+    return request("POST", url, data=data, **kwargs)
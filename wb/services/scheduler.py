@@ -0,0 +1,196 @@
+import concurrent.futures
+import heapq
+import pickle
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable
+
+from loguru import logger
+
+from _settings.settings import (
+    SCHEDULER_IDLE_DAYS,
+    SCHEDULER_JITTER_SECONDS,
+    SCHEDULER_TICK_SECONDS,
+    SCHEDULER_TOKEN_CONCURRENCY,
+    SCHEDULER_WORKERS,
+    redis_client,
+)
+from wb.models import ApiKey
+from wb.services.executor import BACKGROUND, get_executor
+from wb.services.redis import get_active_tokens
+from wb.services.warehouse import (
+    get_bought_sum,
+    get_orders_window,
+    get_ordered_sum,
+    get_sales_window,
+    get_stock_products,
+    get_weekly_payment,
+)
+
+
+@dataclass(frozen=True)
+class RefreshJob:
+    """Cached function called exactly like views call it, so keys match."""
+
+    func: Callable
+    kwargs: dict = field(default_factory=dict, hash=False)
+
+    @property
+    def name(self):
+        return f"{self.func.__name__}{self.kwargs or ''}"
+
+    def get_cache_key(self, token):
+        return self.func.get_cache_key(token, **self.kwargs)
+
+    def refresh(self, token) -> bool:
+        return self.func.refresh(token, **self.kwargs)
+
+
+# Order matters on equal priority: rows first, sums are calculated from them
+refresh_jobs = [
+    RefreshJob(get_stock_products),
+    RefreshJob(get_orders_window),
+    RefreshJob(get_sales_window),
+    RefreshJob(get_weekly_payment),
+    RefreshJob(get_ordered_sum),
+    RefreshJob(get_bought_sum),
+]
+
+MISSING_STALENESS = 100  # Never calculated, as urgent as very stale
+
+
+@dataclass(order=True)
+class Task:
+    priority: float
+    order: int
+    token: str = field(compare=False)
+    job: RefreshJob = field(compare=False)
+
+
+def get_priority(staleness, last_access, now) -> float:
+    """Lower is more urgent. Stale data of active tenant goes first."""
+    idle_hours = max(now - last_access, 0) / 3600
+    return -staleness / (1 + idle_hours)
+
+
+def get_queue(jobs=refresh_jobs) -> list:
+    """Heap of due refreshes of tokens somebody has opened lately."""
+    now = time.time()
+    active_tokens = get_active_tokens(SCHEDULER_IDLE_DAYS * 24 * 60 * 60)
+    known_tokens = set(
+        ApiKey.objects.filter(api__in=list(active_tokens)).values_list("api", flat=True)
+    )
+    candidates = [
+        (token, job) for token in active_tokens if token in known_tokens for job in jobs
+    ]
+    if not candidates:
+        return []
+    timestamps = redis_client.mget(
+        [f"{job.get_cache_key(token)}:updated_at" for token, job in candidates]
+    )
+
+    queue = []
+    for order, ((token, job), timestamp) in enumerate(zip(candidates, timestamps)):
+        if timestamp is None:
+            staleness = MISSING_STALENESS
+        else:
+            age = now - pickle.loads(timestamp).timestamp()
+            staleness = age / (job.func.minutes * 60)
+            if staleness < 1:
+                continue
+        priority = get_priority(staleness, active_tokens[token], now)
+        queue.append(Task(priority, order, token, job))
+    heapq.heapify(queue)
+    return queue
+
+
+class Scheduler:
+    """Refresh stale caches of active tokens with bounded concurrency.
+
+    Every tick due refreshes are ranked by staleness and last access, then
+    started while there are free workers and the token is under its cap.
+    Whatever didn't fit is ranked again on the next tick.
+    """
+
+    def __init__(
+        self,
+        workers=SCHEDULER_WORKERS,
+        token_concurrency=SCHEDULER_TOKEN_CONCURRENCY,
+        tick=SCHEDULER_TICK_SECONDS,
+        jitter=SCHEDULER_JITTER_SECONDS,
+    ):
+        self.workers = workers
+        self.token_concurrency = token_concurrency
+        self.tick = tick
+        self.jitter = jitter
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.running = dict()  # (token, job) -> future
+        self.running_per_token = Counter()
+        # Shared with stale reads, the same refresh is never queued twice
+        self.executor = get_executor(BACKGROUND)
+
+    def stop(self, *args):
+        if not self.stopping.is_set():
+            logger.info("Scheduler is stopping, waiting for running refreshes...")
+        self.stopping.set()
+
+    def dispatch(self, queue: list):
+        while queue and not self.stopping.is_set():
+            task = heapq.heappop(queue)
+            key = (task.token, task.job)
+            with self.lock:
+                if len(self.running) >= self.workers:
+                    return
+                if (
+                    key in self.running
+                    or self.running_per_token[task.token] >= self.token_concurrency
+                ):
+                    continue
+                self.running_per_token[task.token] += 1
+                future = self.executor.submit(
+                    self.run_task, (task,), key=task.job.get_cache_key(task.token)
+                )
+                self.running[key] = future
+            # Also called when task expires in queue and never runs
+            future.add_done_callback(lambda _, task=task: self.finish(task))
+
+    def run_task(self, task: Task):
+        try:
+            # Spread calls, so tokens refreshed together don't hit WB at once
+            if self.stopping.wait(random.uniform(0, self.jitter)):
+                return
+            started = time.monotonic()
+            refreshed = task.job.refresh(task.token)
+            if refreshed:
+                logger.info(
+                    f"Refreshed {task.job.name} in {time.monotonic() - started:.1f}s"
+                )
+        except Exception:
+            logger.exception(f"Refresh of {task.job.name} failed")
+
+    def finish(self, task: Task):
+        with self.lock:
+            self.running.pop((task.token, task.job), None)
+            self.running_per_token[task.token] -= 1
+            if not self.running_per_token[task.token]:
+                del self.running_per_token[task.token]
+
+    def run(self):
+        logger.info(f"Scheduler started with {self.workers} workers")
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.dispatch(get_queue())
+                except Exception:
+                    # Redis or DB hiccup, try again on the next tick
+                    logger.exception("Scheduler tick failed")
+                self.stopping.wait(self.tick + random.uniform(0, self.jitter))
+        finally:
+            with self.lock:
+                futures = list(self.running.values())
+            concurrent.futures.wait(futures)
+            logger.info("Scheduler stopped")
@@ -1,7 +1,14 @@
-from typing import List
+from array import array
+from collections import defaultdict
+from typing import Iterable, List
 
 from wb.models import Product
 
+SEARCH_FIELDS = ("name", "supplier_article", "nm_id", "subject", "brand", "category")
+SEPARATOR = "\x00"  # Between fields, so matches never span two of them
+
+EXACT, PREFIX, SUBSTRING = 0, 1, 2  # Ranks, better matches go first
+
 
 def search_warehouse_products(products: List[Product], keyword):
     found = []
@@ -17,3 +24,72 @@ def search_warehouse_products(products: List[Product], keyword):
         ):
             found.append(product)
     return found
+
+
+def get_trigrams(text) -> set:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Trigram index over normalized product fields, built once per snapshot.
+
+    Finds the same products as search_warehouse_products, but only
+    products sharing the rarest trigrams of keyword are checked.
+    """
+
+    def __init__(self, products: List[Product]):
+        # Separators around fields turn prefix and exact checks into substring ones
+        self.texts = [
+            SEPARATOR
+            + SEPARATOR.join(
+                str(getattr(product, field)).lower() for field in SEARCH_FIELDS
+            )
+            + SEPARATOR
+            for product in products
+        ]
+        postings = defaultdict(list)
+        for index, text in enumerate(self.texts):
+            for trigram in get_trigrams(text):
+                postings[trigram].append(index)
+        self.postings = {
+            trigram: array("I", indexes) for trigram, indexes in postings.items()
+        }
+
+    def get_candidates(self, keyword) -> Iterable[int]:
+        if len(keyword) < 3:
+            # Too short for trigrams, texts are normalized already at least
+            return range(len(self.texts))
+        postings = []
+        for trigram in get_trigrams(keyword):
+            indexes = self.postings.get(trigram)
+            if indexes is None:
+                return []
+            postings.append(indexes)
+        postings.sort(key=len)
+        if len(postings) == 1:
+            return postings[0]
+        # Two rarest trigrams narrow it down enough, substring check does the rest
+        second = set(postings[1])
+        return [index for index in postings[0] if index in second]
+
+    def search(self, keyword) -> dict:
+        """Product index -> rank of match."""
+        keyword = str(keyword).lower()
+        if SEPARATOR in keyword:
+            # Would match across fields, plain search never does
+            return dict()
+        prefix = SEPARATOR + keyword
+        exact = prefix + SEPARATOR
+        texts = self.texts
+        ranks = dict()
+        for index in self.get_candidates(keyword):
+            text = texts[index]
+            if keyword not in text:
+                continue
+            if prefix not in text:
+                ranks[index] = SUBSTRING
+            elif exact not in text:
+                ranks[index] = PREFIX
+            else:
+                ranks[index] = EXACT
+        return ranks
@@ -0,0 +1,384 @@
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+from loguru import logger
+
+from _settings.settings import redis_client
+from wb.services import codec
+from wb.services.columns import ProductColumns, build_columns, np
+from wb.services.executor import BACKGROUND, get_executor
+from wb.services.marketplace import (
+    get_barcode_hashmap,
+    get_marketplace_objects,
+    get_marketplace_orders,
+    get_marketplace_stock,
+    get_price_list,
+    update_marketplace_sales,
+    update_prices,
+)
+from wb.services.pipeline import Pipeline, Stage
+from wb.services.redis import (
+    LocalEntry,
+    acquire_lease,
+    get_local_entry,
+    get_price_changes_from_redis,
+    get_price_version_key,
+    release_lease,
+    set_local_entry,
+    wait_for_lease,
+)
+from wb.services.search import SearchIndex
+from wb.services.sorting import (
+    SortedProducts,
+    get_sort_key,
+    get_sort_orders,
+    marketplace_sorting_lambdas,
+    sorting_lambdas,
+)
+from wb.services.statistics import (
+    get_columns_statistics,
+    get_stock_statistics,
+    sales_statistics_stages,
+)
+from wb.services.warehouse import (
+    add_weekly_orders,
+    add_weekly_sales,
+    attach_images,
+    get_bought_sum,
+    get_images,
+    get_ordered_sum,
+    get_orders_window,
+    get_sales_window,
+    get_stock_objects,
+    get_stock_products,
+    get_weekly_payment,
+)
+
+SNAPSHOT_FORMAT = 6  # Bump when Snapshot or the way it is built changes
+SNAPSHOT_TTL = 60 * 60 * 24 * 7
+
+NOT_FOUND = 255  # Rank of products search didn't find
+
+STOCK = "stock"
+MARKETPLACE = "marketplace"
+
+
+class SnapshotNotReady(Exception):
+    """First build of snapshot takes longer than a request may wait for it."""
+
+
+@dataclass
+class Snapshot:
+    """Enriched products of token, ready to be filtered and paginated.
+
+    Shared by all requests of worker, must not be mutated.
+    """
+
+    kind: str
+    version: str
+    built_at: float
+    products: list
+    statistics: dict  # get_stock_statistics of all products
+    sales_statistics: dict = field(default_factory=dict)
+    sort_orders: dict = field(default_factory=dict)  # Sort key -> product indexes
+    columns: Optional[ProductColumns] = None  # Only when NumPy is installed
+    search_index: Optional[SearchIndex] = None
+    timings: dict = field(default_factory=dict)  # Pipeline stage -> seconds
+
+    def get_sorted(
+        self, sort_by, filter_by=None, filtering=None, search=None
+    ) -> SortedProducts:
+        """Any page of any order is a slice, nothing is sorted per request.
+
+        Found products go by rank of match, then in the chosen order.
+        """
+        sort_by = get_sort_key(sort_by, sorting[self.kind])
+        order = self.sort_orders[sort_by]
+        if filter_by in (filtering or {}):
+            if self.columns is not None:
+                mask = filtering[filter_by]["columns"](self.columns)
+                order = order[mask[order]]
+            else:
+                func = filtering[filter_by]["func"]
+                order = [i for i in order if func(self.products[i])]
+        if search:
+            ranks = self.search_index.search(search)
+            if self.columns is not None:
+                rank = np.full(len(self.products), NOT_FOUND, dtype=np.uint8)
+                rank[list(ranks)] = list(ranks.values())
+                order = order[rank[order] != NOT_FOUND]
+                order = order[np.argsort(rank[order], kind="stable")]
+            else:
+                order = sorted((i for i in order if i in ranks), key=ranks.__getitem__)
+        return SortedProducts(self.products, order)
+
+    def get_statistics(self, products: SortedProducts) -> dict:
+        if len(products) == len(self.products):
+            return self.statistics
+        if self.columns is not None:
+            return get_columns_statistics(self.columns, products.order)
+        return get_stock_statistics(products)
+
+
+def get_snapshot_key(kind, x64_token, jwt_token):
+    # Snapshot is built with jwt too, API callers may pass a different one
+    jwt_digest = hashlib.sha1((jwt_token or "").encode()).hexdigest()[:12]
+    return f"{x64_token}:snapshot:{kind}:{jwt_digest}"
+
+
+def get_sources(kind, x64_token, jwt_token) -> list:
+    """Cached functions snapshot is built from, with their tokens."""
+    sources = [
+        (get_weekly_payment, x64_token),
+        (get_ordered_sum, x64_token),
+        (get_bought_sum, x64_token),
+    ]
+    if kind == STOCK:
+        sources += [
+            (get_stock_products, x64_token),
+            (get_orders_window, x64_token),
+            (get_sales_window, x64_token),
+        ]
+    else:
+        sources += [
+            (get_marketplace_stock, jwt_token),
+            (get_marketplace_orders, jwt_token),
+        ]
+    if jwt_token:
+        sources += [
+            (get_price_list, jwt_token),
+            (get_images, jwt_token),
+        ]
+    return sources
+
+
+def read_versions(kind, x64_token, jwt_token, refresh_sources=True) -> tuple:
+    """Timestamps of sources, price version and tag of stored snapshot.
+
+    One round trip. Once a snapshot is stored, stale or missing sources are
+    refreshed in background, their new timestamps change the version and
+    the snapshot is rebuilt then.
+    """
+    sources = get_sources(kind, x64_token, jwt_token)
+    keys = []
+    for func, token in sources:
+        key = func.get_cache_key(token)
+        keys += [f"{key}:updated_at", f"{key}:failed"]
+    keys.append(get_price_version_key(x64_token))
+    keys.append(f"{get_snapshot_key(kind, x64_token, jwt_token)}:tag")
+    *values, price_version, tag = redis_client.mget(keys)
+    timestamps = values[::2]
+    if refresh_sources and tag is not None:
+        for (func, token), updated_at, failure in zip(
+            sources, timestamps, values[1::2]
+        ):
+            func.refresh_if_stale(token, updated_at, failure)
+    return timestamps, price_version, tag
+
+
+def get_digest(kind, jwt_token, timestamps, price_version) -> str:
+    digest = hashlib.sha1(f"{SNAPSHOT_FORMAT}:{kind}:{jwt_token}".encode())
+    for value in (*timestamps, price_version):
+        digest.update(b"|" + (value or b""))
+    return digest.hexdigest()
+
+
+def get_version(kind, x64_token, jwt_token) -> Tuple[str, Optional[bytes]]:
+    """Version of sources and tag of snapshot stored in Redis.
+
+    Version changes whenever any source is refreshed or price is changed
+    by user, and only then. Tag tells which build is stored, see get_tag.
+    """
+    timestamps, price_version, tag = read_versions(kind, x64_token, jwt_token)
+    return get_digest(kind, jwt_token, timestamps, price_version), tag
+
+
+def with_jwt(func, default):
+    """Fetch that needs the new API key, without it products stay as they are."""
+
+    def fetch(jwt_token):
+        return func(jwt_token) if jwt_token else default()
+
+    return fetch
+
+
+# Fetches only depend on tokens and go in parallel. Merges change the same
+# products, so they are chained and each starts once its fetch is done.
+pipelines = {
+    STOCK: Pipeline(
+        STOCK,
+        [
+            Stage("stock", get_stock_products, ("x64_token",)),
+            Stage("price_changes", get_price_changes_from_redis, ("x64_token",)),
+            Stage("sales", get_sales_window, ("x64_token",)),
+            Stage("orders", get_orders_window, ("x64_token",)),
+            Stage("prices", with_jwt(get_price_list, list), ("jwt_token",)),
+            Stage("images", with_jwt(get_images, dict), ("jwt_token",)),
+            Stage("objects", get_stock_objects, ("stock", "price_changes")),
+            Stage("with_sales", add_weekly_sales, ("objects", "sales")),
+            Stage("with_orders", add_weekly_orders, ("with_sales", "orders")),
+            Stage("with_prices", update_prices, ("with_orders", "prices")),
+            Stage("products", attach_images, ("with_prices", "images")),
+            *sales_statistics_stages,
+        ],
+    ),
+    MARKETPLACE: Pipeline(
+        MARKETPLACE,
+        [
+            Stage("stock", with_jwt(get_marketplace_stock, list), ("jwt_token",)),
+            Stage("price_changes", get_price_changes_from_redis, ("x64_token",)),
+            Stage("prices", with_jwt(get_price_list, list), ("jwt_token",)),
+            Stage("orders", with_jwt(get_marketplace_orders, list), ("jwt_token",)),
+            Stage("images", with_jwt(get_images, dict), ("jwt_token",)),
+            Stage("objects", get_marketplace_objects, ("stock", "price_changes")),
+            Stage("barcodes", get_barcode_hashmap, ("stock",)),
+            Stage("with_prices", update_prices, ("objects", "prices")),
+            Stage(
+                "with_orders",
+                update_marketplace_sales,
+                ("with_prices", "barcodes", "orders"),
+            ),
+            Stage("products", attach_images, ("with_orders", "images")),
+            *sales_statistics_stages,
+        ],
+    ),
+}
+
+sorting = {
+    STOCK: sorting_lambdas,
+    MARKETPLACE: marketplace_sorting_lambdas,
+}
+
+
+def build_snapshot(kind, x64_token, jwt_token, owner=None) -> Snapshot:
+    redis_key = get_snapshot_key(kind, x64_token, jwt_token)
+    try:
+        started = time.monotonic()
+        # Pipeline reads sources itself, they are not refreshed twice
+        before, price_version, _ = read_versions(kind, x64_token, jwt_token, False)
+        results, timings = pipelines[kind].run(x64_token=x64_token, jwt_token=jwt_token)
+        products = list(results["products"].values())
+        columns = build_columns(products)
+        snapshot = Snapshot(
+            kind=kind,
+            version="",
+            built_at=time.time(),
+            products=products,
+            statistics=get_columns_statistics(columns)
+            if columns is not None
+            else get_stock_statistics(products),
+            sales_statistics=results["sales_statistics"],
+            sort_orders=get_sort_orders(products, sorting[kind], columns),
+            columns=columns,
+            search_index=SearchIndex(products),
+            timings=timings,
+        )
+        after, after_price_version, _ = read_versions(kind, x64_token, jwt_token, False)
+        # Pipeline calculates missing sources itself. Any other change means
+        # source was refreshed while we were building, version stays empty then
+        if after_price_version == price_version and all(
+            old in (None, new) for old, new in zip(before, after)
+        ):
+            snapshot.version = get_digest(kind, jwt_token, after, price_version)
+        # Snapshot holds arrays and its own classes, msgpack can't pack them
+        blob, size = codec.encode(snapshot, codec.PickleCodec)
+        tag = get_tag(snapshot)
+        pipe = redis_client.pipeline()
+        pipe.set(redis_key, blob, ex=SNAPSHOT_TTL)
+        pipe.set(f"{redis_key}:tag", tag, ex=SNAPSHOT_TTL)
+        pipe.execute()
+        set_local_entry(redis_key, LocalEntry(snapshot, tag, size, time.monotonic()))
+        logger.info(
+            f"Built {kind} snapshot of {len(products)} products "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+        return snapshot
+    finally:
+        if owner:
+            release_lease(redis_key, owner)
+
+
+def rebuild(kind, x64_token, jwt_token):
+    owner = acquire_lease(get_snapshot_key(kind, x64_token, jwt_token))
+    if owner:
+        build_snapshot(kind, x64_token, jwt_token, owner)
+
+
+def rebuild_in_background(kind, x64_token, jwt_token):
+    get_executor(BACKGROUND).submit(
+        rebuild,
+        (kind, x64_token, jwt_token),
+        key=get_snapshot_key(kind, x64_token, jwt_token),
+    )
+
+
+def get_tag(snapshot: Snapshot) -> bytes:
+    """Same for snapshots of the same data, so ETags and pages outlive rebuilds."""
+    if snapshot.version:
+        return snapshot.version.encode()
+    # Sources changed while it was built, no other build has the same data
+    return f"outdated:{snapshot.built_at}".encode()
+
+
+def get_current_tag(kind, x64_token, jwt_token=None) -> Optional[bytes]:
+    """Tag of snapshot get_snapshot would serve now, without loading it.
+
+    Outdated snapshot is rebuilt in background, like get_snapshot does.
+    """
+    version, tag = get_version(kind, x64_token, jwt_token)
+    if tag is None:
+        return None
+    if tag != version.encode():
+        rebuild_in_background(kind, x64_token, jwt_token)
+    return tag
+
+
+def load_snapshot(kind, x64_token, jwt_token, tag) -> Optional[Snapshot]:
+    """Worker memory first, Redis if another build is stored there."""
+    if tag is None:
+        return None
+    redis_key = get_snapshot_key(kind, x64_token, jwt_token)
+    entry = get_local_entry(redis_key)
+    if entry is not None and entry.updated_at == tag:
+        return entry.value
+    blob = redis_client.get(redis_key)
+    if blob is None:
+        return None
+    try:
+        snapshot, size = codec.decode(blob)
+    except codec.CacheFormatError:
+        return None
+    set_local_entry(
+        redis_key, LocalEntry(snapshot, get_tag(snapshot), size, time.monotonic())
+    )
+    return snapshot
+
+
+def get_snapshot(kind, x64_token, jwt_token=None) -> Snapshot:
+    """Current snapshot, outdated one is served while new is being built.
+
+    SnapshotNotReady if there is none yet and waiting for the build timed out.
+    """
+    version, tag = get_version(kind, x64_token, jwt_token)
+    snapshot = load_snapshot(kind, x64_token, jwt_token, tag)
+    if snapshot is not None and getattr(snapshot, "kind", None) == kind:
+        if snapshot.version != version:
+            rebuild_in_background(kind, x64_token, jwt_token)
+        return snapshot
+
+    redis_key = get_snapshot_key(kind, x64_token, jwt_token)
+    while True:
+        owner = acquire_lease(redis_key)
+        if owner:
+            return build_snapshot(kind, x64_token, jwt_token, owner)
+        # Somebody else is building, never build without the lease
+        released = wait_for_lease(redis_key)
+        tag = redis_client.get(f"{redis_key}:tag")
+        snapshot = load_snapshot(kind, x64_token, jwt_token, tag)
+        if snapshot is not None:
+            return snapshot
+        if not released:
+            raise SnapshotNotReady(f"{kind} snapshot takes too long elsewhere")
+        # Owner gave up without snapshot, take the lease again
@@ -1,31 +1,49 @@
+from collections.abc import Sequence
 from copy import deepcopy
 
 from wb.models import Product
+from wb.services.columns import divide, np
 
+# "columns" is the same key over ProductColumns, see wb.services.columns
 sorting_lambdas = {
-    "qty": {"func": lambda product: product.stock, "desc": "Остатки"},
-    "sales": {"func": lambda product: product.sales, "desc": "Продажи"},
-    "orders": {"func": lambda product: product.orders, "desc": "Заказы"},
+    "qty": {
+        "func": lambda product: product.stock,
+        "columns": lambda c: c.stock,
+        "desc": "Остатки",
+    },
+    "sales": {
+        "func": lambda product: product.sales,
+        "columns": lambda c: c.sales,
+        "desc": "Продажи",
+    },
+    "orders": {
+        "func": lambda product: product.orders,
+        "columns": lambda c: c.orders,
+        "desc": "Заказы",
+    },
     "order_now": {
         "func": lambda product: product.orders / product.stock
         if product.stock > 0
         else product.orders / 0.7,
+        "columns": lambda c: divide(c.orders, c.stock, c.orders / 0.7),
         "desc": "Срочно заказывать",
     },
     "out_of_stock_soon": {
         "func": lambda product: product.orders if product.stock < product.orders else 0,
+        "columns": lambda c: np.where(c.stock < c.orders, c.orders, 0),
         "desc": "Скоро закончится",
     },
     "low_sales": {
         "func": lambda product: product.stock / product.orders
         if product.orders > 0
         else product.stock / 0.7,
+        "columns": lambda c: divide(c.stock, c.orders, c.stock / 0.7),
         "desc": "Плохо продаются",
     },
 }
 
 
-def get_marketplaces_sorting():
+def make_marketplaces_sorting():
     """Orders in marketplace are unprocessed entities, and after processing they disappear.
     So we have to use sales instead in lambdas."""
     marketplace_sorting_lambdas = deepcopy(sorting_lambdas)
@@ -35,14 +53,30 @@ def get_marketplaces_sorting():
         if product.stock > 0
         else product.orders / 0.7
     )
+    marketplace_sorting_lambdas["order_now"]["columns"] = lambda c: divide(
+        c.sales, c.stock, c.orders / 0.7
+    )
     marketplace_sorting_lambdas["out_of_stock_soon"]["func"] = (
         lambda product: product.sales if product.stock < product.sales else 0
     )
+    marketplace_sorting_lambdas["out_of_stock_soon"]["columns"] = lambda c: np.where(
+        c.stock < c.sales, c.sales, 0
+    )
     marketplace_sorting_lambdas["low_sales"]["func"] = (
         lambda product: product.stock / product.sales
         if product.sales > 0
         else product.stock / 0.7
     )
+    marketplace_sorting_lambdas["low_sales"]["columns"] = lambda c: divide(
+        c.stock, c.sales, c.stock / 0.7
+    )
+    return marketplace_sorting_lambdas
+
+
+marketplace_sorting_lambdas = make_marketplaces_sorting()
+
+
+def get_marketplaces_sorting():
     return marketplace_sorting_lambdas
 
 
@@ -57,7 +91,45 @@ def sort_products(
 ) -> list[Product]:
     if lambdas is None:
         lambdas = sorting_lambdas
-    if filter_by not in lambdas:
-        filter_by = "low_sales"
+    filter_by = get_sort_key(filter_by, lambdas)
 
     return sorted(products, key=lambdas[filter_by]["func"], reverse=True)
+
+
+def get_sort_key(sort_by, lambdas):
+    return sort_by if sort_by in lambdas else "low_sales"
+
+
+def get_sort_orders(products: list[Product], lambdas, columns=None) -> dict:
+    """Indexes of products in every sort order, same as sort_products gives.
+
+    Key is calculated once per product, sorting is stable like sorted().
+    """
+    orders = dict()
+    for sort_by, sorting in lambdas.items():
+        if columns is not None:
+            # Stable ascending sort of negated keys keeps ties in original order
+            values = sorting["columns"](columns)
+            orders[sort_by] = np.argsort(-values, kind="stable")
+            continue
+        values = [sorting["func"](product) for product in products]
+        orders[sort_by] = sorted(
+            range(len(products)), key=values.__getitem__, reverse=True
+        )
+    return orders
+
+
+class SortedProducts(Sequence):
+    """Products in precomputed order. Paginator slices it without copying all."""
+
+    def __init__(self, products: list[Product], order: list[int]):
+        self.products = products
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.products[i] for i in self.order[index]]
+        return self.products[self.order[index]]
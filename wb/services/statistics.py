@@ -1,8 +1,8 @@
-import concurrent.futures
-
 from loguru import logger
 
 from wb.models import Product
+from wb.services.columns import ProductColumns
+from wb.services.pipeline import Pipeline, Stage
 from wb.services.warehouse import get_bought_sum, get_ordered_sum, get_weekly_payment
 
 
@@ -32,22 +32,55 @@ def get_stock_statistics(products: list[Product]) -> dict:
     return stat
 
 
+def get_columns_statistics(columns: ProductColumns, index=None) -> dict:
+    """Same as get_stock_statistics, vectorized. `index` selects products."""
+    stock, price = columns.stock, columns.price
+    in_the_way = columns.in_way_to_client + columns.in_way_from_client
+    if index is not None:
+        stock, price, in_the_way = stock[index], price[index], in_the_way[index]
+    if not len(stock):
+        return {}
+    in_stock = stock - in_the_way
+    stat = {
+        "total_sku": len(stock),
+        "total": int(stock.sum()),
+        "total_in_stock": int(in_stock.sum()),
+        "in_the_way": int(in_the_way.sum()),
+        "total_value": (stock * price).sum().item(),
+    }
+    can_be_ordered = int((in_stock > 0).sum())
+    if can_be_ordered:
+        stat["can_be_ordered_qty"] = can_be_ordered
+    if len(stock) - can_be_ordered:
+        stat["sku_on_the_way"] = len(stock) - can_be_ordered
+    return stat
+
+
+def make_sales_statistics(payment, ordered, bought) -> dict:
+    return {
+        "payment": payment,
+        "ordered": ordered,
+        "bought": bought,
+    }
+
+
+# Also part of snapshot pipelines, see wb.services.snapshot
+sales_statistics_stages = [
+    Stage("payment", get_weekly_payment, ("x64_token",)),
+    Stage("ordered_sum", get_ordered_sum, ("x64_token",)),
+    Stage("bought_sum", get_bought_sum, ("x64_token",)),
+    Stage(
+        "sales_statistics",
+        make_sales_statistics,
+        ("payment", "ordered_sum", "bought_sum"),
+    ),
+]
+
+sales_statistics_pipeline = Pipeline("sales_statistics", sales_statistics_stages)
+
+
 def get_sales_statistics(token):
     """Concurrent request for common data."""
     logger.info("Concurrent request for statistics...")
-    target_functions = [
-        get_weekly_payment,
-        get_ordered_sum,
-        get_bought_sum,
-    ]
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for target_function in target_functions:
-            futures.append(executor.submit(target_function, token))
-        result = {
-            "payment": futures[0].result(),
-            "ordered": futures[1].result(),
-            "bought": futures[2].result(),
-        }
-
-    return result
+    results, _ = sales_statistics_pipeline.run(x64_token=token)
+    return results["sales_statistics"]
@@ -0,0 +1,166 @@
+import datetime
+from typing import Callable, Optional
+
+from loguru import logger
+
+from _settings.settings import redis_client
+from wb.services import codec
+from wb.services.ingestion import store_synced_rows
+from wb.services.redis import acquire_lease, release_lease, wait_for_lease
+from wb.services.rest_client.retry import RetryableError, WbApiError
+from wb.services.rest_client.statistics_client import StatisticsApiClient
+from wb.services.tools import get_date
+
+# WB cuts flag=0 responses at this amount of rows, so we ask again from the last row
+STATISTICS_PAGE_LIMIT = 80000
+SYNC_STATE_TTL = 60 * 60 * 24 * 7
+SYNC_STATE_VERSION = 2  # Bump when keys of rows change
+
+
+def get_order_key(row):
+    return row.get("srid") or row.get("odid")
+
+
+def get_sale_key(row):
+    # Sale and its return share srid, but not saleID
+    return row.get("saleID") or get_order_key(row)
+
+
+def get_stock_key(row):
+    return f"{row.get('barcode')}:{row.get('warehouseName')}"
+
+
+# Endpoint -> how to tell that two rows are the same order/sale/stock position
+sync_keys = {
+    "orders": get_order_key,
+    "sales": get_sale_key,
+    "stocks": get_stock_key,
+}
+
+
+def get_window_start(days):
+    """Same day boundary as get_date, but comparable with lastChangeDate."""
+    date = datetime.datetime.today() - datetime.timedelta(days=days)
+    return date.strftime("%Y-%m-%dT00:00:00")
+
+
+def get_row_filter(week=False, flag=1, days=None, window_days=14) -> Optional[Callable]:
+    """Which rows of synced window WB would return for these params.
+
+    flag=0 means changed since dateFrom, flag=1 means made on that day.
+    None if window doesn't go back that far.
+    """
+    day = get_date(week, days)[:10]
+    if day < get_window_start(window_days)[:10]:
+        return None
+    if flag == 0:
+        start = f"{day}T00:00:00"
+        return lambda row: row.get("lastChangeDate", "") >= start
+    return lambda row: row.get("date", "")[:10] == day
+
+
+def sync_statistics(token, endpoint, days) -> list:
+    """Keep `days` window of endpoint rows in Redis, pulling only changed rows.
+
+    Cursor is the latest lastChangeDate we have seen. Rows are merged by
+    sync_keys and dropped once their lastChangeDate leaves the window.
+    Window is mirrored to DB, see wb.services.ingestion.
+    """
+    redis_key = f"{token}:sync:{endpoint}"
+    owner = acquire_lease(redis_key)
+    if not owner:
+        # Another worker is syncing right now, its result is good enough
+        wait_for_lease(redis_key)
+        state = load_sync_state(redis_key, days)
+        if state is None:
+            # Its full sync failed or still runs, empty window is not a result
+            raise RetryableError(f"{endpoint} sync is not done elsewhere yet")
+        return list(state["rows"].values())
+
+    try:
+        state = load_sync_state(redis_key, days)
+        is_full_sync = state is None
+        if is_full_sync:
+            logger.info(f"Full {endpoint} sync for {days} days")
+            state = {
+                "version": SYNC_STATE_VERSION,
+                "days": days,
+                "cursor": get_window_start(days),
+                "rows": dict(),
+            }
+        rows = state["rows"]
+        get_key = sync_keys[endpoint]
+        client = StatisticsApiClient(token)
+        changed_rows = dict()
+
+        while True:
+            batch_size = 0
+            cursor = state["cursor"]
+            try:
+                # Rows are merged as they arrive, the body is never held whole
+                for row in client.iter_changes(endpoint, state["cursor"]):
+                    key = get_key(row)
+                    # Re-insert to keep rows ordered by lastChangeDate
+                    rows.pop(key, None)
+                    rows[key] = row
+                    changed_rows[key] = row
+                    cursor = max(cursor, row.get("lastChangeDate", ""))
+                    batch_size += 1
+            except WbApiError:
+                if is_full_sync:
+                    raise
+                # Keep what we have, cursor stays so next refresh asks again
+                logger.exception(f"Sync of {endpoint} failed, using stored rows")
+                return list(rows.values())
+            advanced = cursor > state["cursor"]
+            state["cursor"] = cursor
+            if batch_size < STATISTICS_PAGE_LIMIT or not advanced:
+                break
+        logger.info(
+            f"Synced {endpoint}: {len(changed_rows)} changed, {len(rows)} total"
+        )
+
+        window_start = get_window_start(days)
+        for key in [
+            key
+            for key, row in rows.items()
+            if row.get("lastChangeDate", "") < window_start
+        ]:
+            del rows[key]
+
+        store_synced_rows(token, endpoint, state, changed_rows, window_start)
+        redis_client.set(redis_key, codec.dumps(state), ex=SYNC_STATE_TTL)
+        return list(rows.values())
+    finally:
+        release_lease(redis_key, owner)
+
+
+def load_synced_rows(token, endpoint, days) -> Optional[tuple]:
+    """Rows of synced window and size of its payload, None before first sync.
+
+    Window is stored once, callers cache only when it was synced.
+    """
+    loaded = decode_sync_state(f"{token}:sync:{endpoint}", days)
+    if loaded is None:
+        return None
+    state, size = loaded
+    return list(state["rows"].values()), size
+
+
+def load_sync_state(redis_key, days):
+    loaded = decode_sync_state(redis_key, days)
+    return None if loaded is None else loaded[0]
+
+
+def decode_sync_state(redis_key, days) -> Optional[tuple]:
+    raw_state = redis_client.get(redis_key)
+    if raw_state is None:
+        return None
+    try:
+        state, size = codec.decode(raw_state)
+    except codec.CacheFormatError:
+        return None
+    if state.get("version") != SYNC_STATE_VERSION or state["days"] != days:
+        # Window has changed, start over with full pull
+        return None
+    return state, size
@@ -1,10 +1,18 @@
+import asyncio
 import datetime
 import functools
+import hashlib
 import urllib.parse
 
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
 from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response, patch_cache_control
 
 from wb.models import ApiKey
+from wb.services.executor import FOREGROUND, get_executor
+from wb.services.page_cache import get_cached_page, set_cached_page
+from wb.services.redis import record_access
 
 
 def get_date(week=None, days=None):
@@ -19,9 +27,131 @@ def get_date(week=None, days=None):
 def api_key_required(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        if ApiKey.objects.filter(user=args[0].user.id).exists():
+        token = (
+            ApiKey.objects.filter(user=args[0].user.id)
+            .values_list("api", flat=True)
+            .first()
+        )
+        if token is not None:
+            record_access(token)
             return func(*args, **kwargs)
         else:
             return redirect("api")
 
     return wrapper
+
+
+def get_api_key(request):
+    """ApiKey of logged in user, None for anonymous, False if there is no key."""
+    if not request.user.is_authenticated:
+        return None
+    api_key = ApiKey.objects.filter(user=request.user.id).first()
+    if api_key is None:
+        return False
+    record_access(api_key.api)
+    return api_key
+
+
+def async_api_key_required(func):
+    """login_required and api_key_required for async views.
+
+    Django 3.2 decorators can't wrap coroutines, and user can't be loaded
+    inside event loop. ApiKey is passed to view as request.api_key.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(request, *args, **kwargs):
+        api_key = await sync_to_async(get_api_key)(request)
+        if api_key is None:
+            return redirect_to_login(request.get_full_path())
+        if api_key is False:
+            return redirect("api")
+        request.api_key = api_key
+        return await func(request, *args, **kwargs)
+
+    return wrapper
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run blocking WB, Redis or DB call in thread, so other requests go on."""
+    executor = get_executor(FOREGROUND)
+    return await executor.async_result(executor.submit(func, args, kwargs))
+
+
+ETAG_VERSION = 1  # Bump when templates or API output change
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1(str(ETAG_VERSION).encode())
+    for part in parts:
+        digest.update(b"|" + (part if isinstance(part, bytes) else str(part).encode()))
+    return f'"{digest.hexdigest()}"'
+
+
+def set_etag(response, etag):
+    if etag and response.status_code in (200, 304):
+        response["ETag"] = etag
+        # Browser asks every time, but with If-None-Match
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def get_query_key(request) -> str:
+    """Path with query in stable order and without empty parameters."""
+    params = sorted(
+        (name, value)
+        for name, values in request.GET.lists()
+        for value in values
+        if value
+    )
+    return f"{request.path}?{urllib.parse.urlencode(params)}"
+
+
+def conditional(get_etag, cache_pages=False):
+    """Answer 304 without running the view if client has the same data.
+
+    `get_etag(request)` tells version of data behind the response, None if
+    it can't. It is blocking and must be cheap: versions, not the data.
+    With `cache_pages` rendered response is kept by its ETag, so the next
+    request for the same data and query skips the view too.
+    Works for sync and async views.
+    """
+
+    def check(request):
+        """ETag and response to send instead of running the view, if any."""
+        etag = get_etag(request)
+        if not etag:
+            return None, None
+        response = get_conditional_response(request, etag=etag)
+        if response is None and cache_pages:
+            response = get_cached_page(etag)
+        return etag, response
+
+    def store(etag, response):
+        if etag and cache_pages:
+            set_cached_page(etag, response)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(request, *args, **kwargs):
+                etag, response = await run_sync(check, request)
+                if response is None:
+                    response = await func(request, *args, **kwargs)
+                    await run_sync(store, etag, response)
+                return set_etag(response, etag)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(request, *args, **kwargs):
+                etag, response = check(request)
+                if response is None:
+                    response = func(request, *args, **kwargs)
+                    store(etag, response)
+                return set_etag(response, etag)
+
+        return wrapper
+
+    return decorator
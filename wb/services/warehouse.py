@@ -1,17 +1,19 @@
-import time
-
 from loguru import logger
 
-from wb.models import Product, Sale, Size
-from wb.services.redis import get_price_change_from_redis, redis_cache_decorator
+from wb.models import Product, Sale
+from wb.services.redis import apply_price_changes, redis_cache_decorator
 from wb.services.rest_client.standard_client import StandardApiClient
-from wb.services.rest_client.statistics_client import RETRY_DELAY, StatisticsApiClient
+from wb.services.rest_client.statistics_client import StatisticsApiClient
+from wb.services.sync import get_row_filter, load_synced_rows, sync_statistics
+
+STOCK_WINDOW_DAYS = 15  # Stock rows changed during this period
+WINDOW_DAYS = 14  # Orders and sales changed during this period, widest pages need
 
 
-def get_stock_objects(x64_token):
-    """Proper way to deal with products."""
+def get_stock_objects(raw_stock: list, price_changes: dict):
+    """Proper way to deal with products.
+    Rows come from get_stock_products, see wb.services.snapshot."""
     logger.info("Getting stock as objects")
-    raw_stock = get_stock_products(x64_token)
     stock_products = dict()
 
     for item in raw_stock:
@@ -37,28 +39,21 @@ def get_stock_objects(x64_token):
 
         product.days_on_site = item.get("daysOnSite", 0)
 
-        product = get_price_change_from_redis(product, x64_token)
-
         # Get or create new size
-        size = item.get("techSize", 0)
-        product.sizes[size] = product.sizes.get(
-            size, Size(tech_size=size)  # Create generic size
-        )
+        size = product.get_size(item.get("techSize", 0))
 
         # Update size values
-        product.sizes[size].quantity_full = item.get("quantityFull", 0)
-        product.sizes[size].barcode = item.get("barcode", 0)
+        size.quantity_full = item.get("quantityFull", 0)
+        size.barcode = item.get("barcode", 0)
 
-    return stock_products
+    return apply_price_changes(stock_products, price_changes)
 
 
-def add_weekly_sales(token, stock_products: dict):
-    """Add sales to stock products.
-    Actually not sales but orders!"""
+def add_weekly_sales(stock_products: dict, raw_sales: list, keep_rows=False):
+    """Add 14 days sales to stock products.
+    Actually not sales but orders!
+    Only counts and sums are kept unless `keep_rows`."""
     logger.info("Applying 14 days sales to stock...")
-    # Get sales endpoint
-    raw_sales = get_bought_products(token=token, week=False, flag=0, days=14)
-
     for raw_sale in raw_sales:
         product: Product = stock_products.get(raw_sale["nmId"])
         if product is None:
@@ -68,29 +63,24 @@ def add_weekly_sales(token, stock_products: dict):
                 supplier_article=raw_sale.get("supplierArticle"),
             )
             stock_products[product.nm_id] = product
-        size = raw_sale["techSize"]
-        product.sizes[size] = product.sizes.get(
-            size,
-            Size(tech_size=raw_sale.get("techSize", 0)),  # Create generic size
+        sale = None
+        if keep_rows:
+            sale = Sale(quantity=raw_sale.get("quantity", 0))
+            sale.date = raw_sale.get("date")
+            sale.price_with_disc = float(raw_sale.get("priceWithDisc", 0))
+            sale.finished_price = float(raw_sale.get("finishedPrice", 0))
+            sale.for_pay = float(raw_sale.get("forPay", 0))
+
+        product.add_sale(
+            raw_sale.get("techSize", 0), float(raw_sale.get("forPay", 0)), sale
         )
 
-        sale = Sale(quantity=raw_sale.get("quantity", 0))
-
-        sale.date = raw_sale.get("date")
-        sale.price_with_disc = float(raw_sale.get("priceWithDisc", 0))
-        sale.finished_price = float(raw_sale.get("finishedPrice", 0))
-        sale.for_pay = float(raw_sale.get("forPay", 0))
-
-        product.sizes[size].sales.append(sale)
-
     return stock_products
 
 
-def add_weekly_orders(token, stock_products: dict):
-    """Weekly orders."""
+def add_weekly_orders(stock_products: dict, raw_orders: list, keep_rows=False):
+    """14 days orders. Only counts and sums are kept unless `keep_rows`."""
     logger.info("Applying 14 days orders to stock...")
-    raw_orders = get_ordered_products(token=token, week=False, flag=0, days=14)
-
     for raw_order in raw_orders:
         product: Product = stock_products.get(raw_order["nmId"])
         if product is None:
@@ -100,37 +90,36 @@ def add_weekly_orders(token, stock_products: dict):
                 supplier_article=raw_order.get("supplierArticle"),
             )
             stock_products[product.nm_id] = product
-        size = raw_order["techSize"]
-        product.sizes[size] = product.sizes.get(
-            size,
-            Size(tech_size=raw_order.get("techSize", 0)),  # Create generic size
+        order = None
+        if keep_rows:
+            order = Sale(quantity=raw_order.get("quantity", 0))
+            order.date = raw_order.get("date")
+            order.price_with_disc = float(raw_order.get("priceWithDisc", 0))
+            order.finished_price = float(raw_order.get("finishedPrice", 0))
+            order.for_pay = float(raw_order.get("forPay", 0))
+
+        revenue = raw_order.get("totalPrice", 0) * (
+            1 - raw_order.get("discountPercent", 0) / 100
         )
-
-        sale = Sale(quantity=raw_order.get("quantity", 0))
-
-        sale.date = raw_order.get("date")
-        sale.price_with_disc = float(raw_order.get("priceWithDisc", 0))
-        sale.finished_price = float(raw_order.get("finishedPrice", 0))
-        sale.for_pay = float(raw_order.get("forPay", 0))
-
-        product.sizes[size].orders.append(sale)
+        product.add_order(raw_order.get("techSize", 0), revenue, order)
     return stock_products
 
 
-@redis_cache_decorator()
+# Sums see WB failures, so the last good sum is kept instead of 0
+@redis_cache_decorator(local=True, default=int)
 def get_weekly_payment(token):
     logger.info("Getting weekly payment...")
-    data = get_bought_products(token, week=True, flag=0)
+    data = get_bought_products(token, week=True, flag=0, strict=True)
     if data:
         payment = sum((x.get("forPay", 0)) for x in data)
         return int(payment)
     return 0
 
 
-@redis_cache_decorator()
+@redis_cache_decorator(local=True, default=int)
 def get_ordered_sum(token):
     logger.info("Getting ordered payment...")
-    data = get_ordered_products(token)
+    data = get_ordered_products(token, strict=True)
     if data:
         return int(
             sum(
@@ -141,69 +130,84 @@ def get_ordered_sum(token):
     return 0
 
 
-@redis_cache_decorator()
+@redis_cache_decorator(local=True, default=int)
 def get_bought_sum(token):
     logger.info("Getting bought payment...")
-    data = get_bought_products(token)
+    data = get_bought_products(token, strict=True)
     if data:
         return int(sum((x.get("forPay", 0)) for x in data))
     return 0
 
 
-@redis_cache_decorator()
-def get_ordered_products(token, week=False, flag=1, days=None):
-    client = StatisticsApiClient(token)
-    data = client.get_ordered(url="orders", week=week, flag=flag, days=days)
-    attempt = 0
-    while data.status_code != 200:
-        attempt += 1
-        if attempt > 10:
-            return {}
-        logger.info(f"Orders error {data.status_code}, Message: {data.text}")
-        time.sleep(RETRY_DELAY)
-        data = client.get_ordered(url="orders", week=week, flag=flag, days=days)
-    return data.json()
-
-
-@redis_cache_decorator()
-def get_bought_products(token, week=False, flag=1, days=None):
+# One window per endpoint is synced, narrower ones are cut from it. Decorator
+# keeps only its timestamp, rows are read back from sync state
+@redis_cache_decorator(
+    local=True,
+    default=list,
+    load=lambda token: load_synced_rows(token, "orders", WINDOW_DAYS),
+)
+def get_orders_window(token):
+    return sync_statistics(token, "orders", WINDOW_DAYS)
+
+
+@redis_cache_decorator(
+    local=True,
+    default=list,
+    load=lambda token: load_synced_rows(token, "sales", WINDOW_DAYS),
+)
+def get_sales_window(token):
+    return sync_statistics(token, "sales", WINDOW_DAYS)
+
+
+@redis_cache_decorator(local=True, default=list)
+def get_wider_rows(token, url, week=False, flag=1, days=None):
+    """Rows are cached and paginated, so they are all in memory here. Only
+    the raw body is not held next to them."""
     client = StatisticsApiClient(token)
-    data = client.get_ordered(url="sales", week=week, flag=flag, days=days)
-    attempt = 0
-    while data.status_code != 200:
-        attempt += 1
-        if attempt > 10:
-            return {}
-        logger.info(f"Sales error {data.status_code}, Message: {data.text}")
-        time.sleep(RETRY_DELAY)
-        data = client.get_ordered(url="sales", week=week, flag=flag, days=days)
-    return data.json()
-
-
-@redis_cache_decorator()
+    return list(client.iter_ordered(url=url, week=week, flag=flag, days=days))
+
+
+def get_rows(token, url, window, week, flag, days, strict=False):
+    """With `strict` WB failure raises instead of giving empty rows."""
+    wider_rows = get_wider_rows.strict if strict else get_wider_rows
+    window = window.strict if strict else window
+    if flag == 0 and days == WINDOW_DAYS and not week:
+        return window(token)
+    keep = get_row_filter(week, flag, days, WINDOW_DAYS)
+    if keep is None:
+        logger.info(f"{url} for {days} days don't fit into window, asking WB")
+        return wider_rows(token, url, week=week, flag=flag, days=days)
+    return [row for row in window(token) if keep(row)]
+
+
+def get_ordered_products(token, week=False, flag=1, days=None, strict=False):
+    """Orders rows like WB returns them for these params."""
+    return get_rows(token, "orders", get_orders_window, week, flag, days, strict)
+
+
+def get_bought_products(token, week=False, flag=1, days=None, strict=False):
+    """Sales rows like WB returns them for these params."""
+    return get_rows(token, "sales", get_sales_window, week, flag, days, strict)
+
+
+@redis_cache_decorator(
+    local=True,
+    default=list,
+    load=lambda token: load_synced_rows(token, "stocks", STOCK_WINDOW_DAYS),
+)
 def get_stock_products(token):
     """Getting products in stock."""
     logger.info("Getting products in stock.")
-    client = StatisticsApiClient(token)
-    data = client.get_stock()
-    logger.info(data)
-    attempt = 0
-    while data.status_code != 200:
-        attempt += 1
-        if attempt > 10:
-            return {}
-        logger.info(f"Stock error {data.status_code}, Message: {data.text}")
-        time.sleep(RETRY_DELAY)
-        data = client.get_stock()
-    logger.info(data.text[:100])
-    return data.json()
-
-
-@redis_cache_decorator(60)
-def attach_images(standard_token, products: dict):
+    return sync_statistics(token, "stocks", STOCK_WINDOW_DAYS)
+
+
+@redis_cache_decorator(60, local=True, default=dict)
+def get_images(standard_token):
+    return StandardApiClient(standard_token).get_content()
+
+
+def attach_images(products: dict, images: dict):
     logger.info("Attaching images...")
-    client = StandardApiClient(standard_token)
-    images = client.get_content()
     for wb_id, product in products.items():
         if wb_id in images:
             product.image = images[wb_id]["image"]
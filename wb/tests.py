@@ -0,0 +1,615 @@
+import datetime
+import email.utils
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+from loguru import logger
+
+from _settings.settings import redis_client
+from wb import views
+from wb.models import ApiKey, OrderRow, Product, Sale, Size
+from wb.services import codec
+from wb.services.api import (
+    QueryError,
+    decode_cursor,
+    encode_cursor,
+    get_cursor_page,
+)
+from wb.services.columns import build_columns
+from wb.services.executor import BACKGROUND, get_executor
+from wb.services.page_cache import get_page_cache_metrics, local_pages, local_pages_lock
+from wb.services.redis import (
+    acquire_lease,
+    local_cache,
+    local_cache_lock,
+    redis_cache_decorator,
+    release_lease,
+)
+from wb.services.rest_client import rate_limit, transport
+from wb.services.rest_client.fake import FakeWbApi
+from wb.services.rest_client.retry import (
+    FatalError,
+    RetryableError,
+    RetryPolicy,
+    WbApiError,
+    get_retry_after,
+)
+from wb.services.rest_client.streaming import JsonArrayParser
+from wb.services.search import (
+    EXACT,
+    PREFIX,
+    SUBSTRING,
+    SearchIndex,
+    search_warehouse_products,
+)
+from wb.services.snapshot import (
+    STOCK,
+    SnapshotNotReady,
+    get_snapshot,
+    get_snapshot_key,
+    rebuild,
+)
+from wb.services.sorting import (
+    get_sort_orders,
+    marketplace_sorting_lambdas,
+    sort_products,
+    sorting_lambdas,
+)
+from wb.services.sync import (
+    SYNC_STATE_VERSION,
+    get_window_start,
+    load_sync_state,
+    sync_statistics,
+)
+from wb.services.warehouse import get_orders_window, get_stock_products
+
+
+def wait_for_background():
+    """Background refreshes and rebuilds must be done before the next step."""
+    background = get_executor(BACKGROUND)
+    while True:
+        metrics = background.get_metrics()
+        if not metrics["active"] and not metrics["queued"]:
+            return
+        time.sleep(0.01)
+
+
+class FakeWbTestCase(TransactionTestCase):
+    """Fake WB API, empty Redis and worker caches for every test.
+
+    Transactions of TransactionTestCase, because executor threads write
+    synced rows to DB too.
+    """
+
+    rows = 200
+
+    def setUp(self):
+        # Concurrent syncs lock SQLite tables, ingestion logs and skips that
+        logger.disable("wb")
+        self.addCleanup(logger.enable, "wb")
+        redis_client.flushall()
+        with local_cache_lock:
+            local_cache.clear()
+        with local_pages_lock:
+            local_pages.clear()
+        self.api = FakeWbApi(rows=self.rows)
+        transport.use_fake(self.api)
+        self.addCleanup(transport.use_fake, None)
+        self.addCleanup(wait_for_background)
+
+
+def parse_chunks(chunks) -> list:
+    parser = JsonArrayParser()
+    items = []
+    for chunk in chunks:
+        items += parser.feed(chunk)
+    return items + parser.feed("", final=True)
+
+
+class JsonArrayParserTest(SimpleTestCase):
+    def test_objects_split_anywhere(self):
+        text = '[{"nmId": 1, "date": "2023-03-25"}, {"nmId": 2, "sizes": [1, 2]}]'
+        expected = [{"nmId": 1, "date": "2023-03-25"}, {"nmId": 2, "sizes": [1, 2]}]
+        for cut in range(len(text) + 1):
+            with self.subTest(cut=cut):
+                self.assertEqual(parse_chunks([text[:cut], text[cut:]]), expected)
+
+    def test_number_split_at_chunk_boundary(self):
+        self.assertEqual(parse_chunks(["[1, 34.", "5, 2]"]), [1, 34.5, 2])
+        self.assertEqual(parse_chunks(["[1e", "3]"]), [1000.0])
+        self.assertEqual(parse_chunks(["[tr", "ue, -", "7]"]), [True, -7])
+
+    def test_every_cut_of_numbers(self):
+        text = "[34.5, -1e-3, 120, null]"
+        for cut in range(len(text) + 1):
+            with self.subTest(cut=cut):
+                self.assertEqual(
+                    parse_chunks([text[:cut], text[cut:]]), [34.5, -0.001, 120, None]
+                )
+
+    def test_empty_array(self):
+        self.assertEqual(parse_chunks(["[", " ]"]), [])
+
+    def test_broken_body(self):
+        with self.assertRaises(ValueError):
+            parse_chunks(["[1, 2"])
+        with self.assertRaises(ValueError):
+            parse_chunks(["[34.x]"])
+        with self.assertRaises(ValueError):
+            parse_chunks(['{"error": "oops"}'])
+
+
+def get_products(*nm_ids) -> list:
+    return [SimpleNamespace(nm_id=nm_id) for nm_id in nm_ids]
+
+
+def get_nm_ids(products) -> list:
+    return [product.nm_id for product in products]
+
+
+class CursorTest(SimpleTestCase):
+    def test_round_trip(self):
+        cursor = encode_cursor(32, 12345678)
+        self.assertNotIn("=", cursor)
+        self.assertEqual(decode_cursor(cursor), (32, 12345678))
+
+    def test_broken_cursor(self):
+        for cursor in ("", "abc", "!!!", encode_cursor(1, "x"), "Ж"):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(QueryError):
+                    decode_cursor(cursor)
+
+    def test_pages_cover_all_products(self):
+        products = get_products(*range(10))
+        seen, cursor = [], None
+        while True:
+            page, cursor = get_cursor_page(products, cursor, 3)
+            seen += get_nm_ids(page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(range(10)))
+
+    def test_last_page_has_no_cursor(self):
+        products = get_products(1, 2, 3)
+        self.assertEqual(get_cursor_page(products, None, 3), (products, None))
+        self.assertEqual(get_cursor_page([], None, 3), ([], None))
+
+    def test_continues_after_the_same_product(self):
+        page, cursor = get_cursor_page(get_products(1, 2, 3, 4, 5, 6), None, 2)
+        self.assertEqual(get_nm_ids(page), [1, 2])
+        # Snapshot was rebuilt, two products came before the last one shown
+        page, _ = get_cursor_page(get_products(7, 8, 1, 2, 3, 4, 5, 6), cursor, 2)
+        self.assertEqual(get_nm_ids(page), [3, 4])
+
+    def test_last_product_is_gone(self):
+        _, cursor = get_cursor_page(get_products(1, 2, 3, 4, 5), None, 2)
+        page, _ = get_cursor_page(get_products(1, 3, 4, 5), cursor, 2)
+        self.assertEqual(get_nm_ids(page), [4, 5])
+
+
+class CodecTest(SimpleTestCase):
+    def get_products(self):
+        size = Size(tech_size="42", quantity_full=3, barcode="200")
+        size.add_sale(100, Sale(date="2022-06-01", quantity=1, finished_price=100))
+        return {
+            nm_id: Product(nm_id=nm_id, sizes={"200": size}, name="Футболка")
+            for nm_id in range(100)
+        }
+
+    def test_round_trip_of_every_codec_and_compressor(self):
+        value = {
+            "products": self.get_products(),
+            "pair": (1, "a"),
+            "updated_at": datetime.datetime(2022, 6, 1, 12, 30),
+        }
+        for used_codec in codec.codecs.values():
+            for compressor in codec.compressors.values():
+                with self.subTest(codec=used_codec, compressor=compressor):
+                    with mock.patch.object(codec, "compressor", compressor):
+                        blob, size = codec.encode(value, used_codec)
+                    self.assertGreater(size, codec.CACHE_COMPRESSION_MIN_SIZE)
+                    self.assertEqual(codec.decode(blob), (value, size))
+
+    def test_small_payload_is_not_compressed(self):
+        blob, size = codec.encode([1, 2, 3])
+        self.assertEqual(blob[4], codec.NoCompressor.id)
+        self.assertEqual(codec.loads(blob), [1, 2, 3])
+
+    def test_blob_of_another_schema_is_a_miss(self):
+        blob = codec.dumps(self.get_products())
+        with mock.patch.object(codec, "SCHEMA_VERSION", codec.SCHEMA_VERSION + 1):
+            with self.assertRaises(codec.CacheFormatError):
+                codec.loads(blob)
+
+    def test_blob_of_missing_compressor_is_a_miss(self):
+        blob = codec.dumps(self.get_products())
+        with mock.patch.dict(codec.compressors_by_id, clear=True):
+            with self.assertRaises(codec.CacheFormatError):
+                codec.loads(blob)
+
+    def test_broken_blobs(self):
+        for blob in [b"", b"WB", b"XX" + codec.dumps(1)[2:]]:
+            with self.subTest(blob=blob):
+                with self.assertRaises(codec.CacheFormatError):
+                    codec.loads(blob)
+
+    def test_best_installed_compressor_by_default(self):
+        with mock.patch.dict(codec.compressors):
+            codec.compressors.pop("zstd", None)
+            codec.compressors.pop("lz4", None)
+            self.assertIs(codec.get_compressor(None), codec.ZlibCompressor)
+            codec.compressors["lz4"] = codec.Lz4Compressor
+            self.assertIs(codec.get_compressor(None), codec.Lz4Compressor)
+            codec.compressors["zstd"] = codec.ZstdCompressor
+            self.assertIs(codec.get_compressor(None), codec.ZstdCompressor)
+
+
+def make_products(count, seed=1) -> list:
+    """Catalog with plenty of equal keys, so order of ties matters."""
+    rng = random.Random(seed)
+    products = []
+    for nm_id in range(count):
+        product = Product(nm_id=nm_id)
+        for tech_size in rng.sample(["S", "M", "L"], rng.randint(0, 3)):
+            product.get_size(tech_size).quantity_full = rng.randint(0, 5)
+            for _ in range(rng.randint(0, 4)):
+                product.add_order(tech_size, 100)
+            for _ in range(rng.randint(0, 2)):
+                product.add_sale(tech_size, 100)
+        products.append(product)
+    return products
+
+
+class SortOrdersTest(SimpleTestCase):
+    def test_same_order_as_sort_products(self):
+        products = make_products(500)
+        columns = build_columns(products)
+        for lambdas in (sorting_lambdas, marketplace_sorting_lambdas):
+            expected = {
+                sort_by: [p.nm_id for p in sort_products(products, sort_by, lambdas)]
+                for sort_by in lambdas
+            }
+            # NumPy path only where it is installed
+            for used_columns in [None] if columns is None else [None, columns]:
+                orders = get_sort_orders(products, lambdas, used_columns)
+                self.assertEqual(set(orders), set(lambdas))
+                for sort_by, order in orders.items():
+                    with self.subTest(
+                        sort_by=sort_by, columns=used_columns is not None
+                    ):
+                        nm_ids = [products[index].nm_id for index in order]
+                        self.assertEqual(nm_ids, expected[sort_by])
+
+
+class SearchIndexTest(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(2)
+        brands = ["Nike", "Adidas", "Зара", "Reebok"]
+        subjects = ["Футболки", "Кроссовки", "Брюки"]
+        self.products = make_products(300)
+        for product in self.products:
+            product.brand = rng.choice(brands)
+            product.subject = rng.choice(subjects)
+            product.supplier_article = f"ART-{rng.randint(0, 999)}"
+            product.name = f"{product.subject} {product.brand} {product.nm_id}"
+        self.index = SearchIndex(self.products)
+
+    def test_finds_same_products_as_search_warehouse_products(self):
+        keywords = ["", "a", "зА", "nik", "NIKE", "футболки nike", "art-1", "12"]
+        keywords += ["кроссовки", "-", "no such thing", "ike 1", 7, "\x00"]
+        for keyword in keywords:
+            with self.subTest(keyword=keyword):
+                expected = search_warehouse_products(self.products, keyword)
+                found = self.index.search(keyword)
+                self.assertEqual(
+                    sorted(self.products[index].nm_id for index in found),
+                    [product.nm_id for product in expected],
+                )
+
+    def test_better_matches_rank_higher(self):
+        product = self.products[0]
+        product.brand, product.subject, product.name = "Nike", "Брюки", "Nikelab"
+        index = SearchIndex(self.products)
+        self.assertEqual(index.search("nike")[0], EXACT)
+        self.assertEqual(index.search("nikel")[0], PREFIX)
+        self.assertEqual(index.search("ikel")[0], SUBSTRING)
+
+
+class PageCacheTest(FakeWbTestCase):
+    def get_stock_page(self):
+        request = RequestFactory().get("/stock/?sort_by=low_sales&page=2")
+        request.user = User(username="test")
+        request.api_key = ApiKey(api="x64", new_api="jwt")
+        # Past async_api_key_required, so nothing is looked up in DB
+        return async_to_sync(views.stock.__wrapped__)(request)
+
+    def test_page_outlives_rebuild_of_same_data(self):
+        self.get_stock_page()  # Builds snapshot, no ETag yet
+        first = self.get_stock_page()
+        wait_for_background()
+
+        rebuild(STOCK, "x64", "jwt")
+        stored = get_page_cache_metrics()
+        with mock.patch.object(
+            views, "render_snapshot", wraps=views.render_snapshot
+        ) as render:
+            second = self.get_stock_page()
+        self.assertEqual(second["ETag"], first["ETag"])
+        self.assertEqual(second.content, first.content)
+        render.assert_not_called()
+        self.assertEqual(
+            get_page_cache_metrics()["local_hits"], stored.get("local_hits", 0) + 1
+        )
+
+    def test_page_is_rendered_again_once_data_changed(self):
+        self.get_stock_page()
+        first = self.get_stock_page()
+
+        get_stock_products.refresh("x64")
+        self.get_stock_page()  # Outdated snapshot is served while rebuilt
+        wait_for_background()
+        with mock.patch.object(
+            views, "render_snapshot", wraps=views.render_snapshot
+        ) as render:
+            second = self.get_stock_page()
+        self.assertNotEqual(second["ETag"], first["ETag"])
+        render.assert_called_once()
+
+
+class CacheDecoratorTest(FakeWbTestCase):
+    def test_one_call_under_concurrency(self):
+        calls = []
+
+        @redis_cache_decorator()
+        def slow_total(token):
+            calls.append(token)
+            time.sleep(0.3)
+            return {"total": 42}
+
+        workers = 8
+        barrier = Barrier(workers)
+
+        def read(_):
+            barrier.wait()
+            return slow_total("x64")
+
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(read, range(workers)))
+        self.assertEqual(calls, ["x64"])
+        self.assertEqual(results, [{"total": 42}] * workers)
+        key = slow_total.get_cache_key("x64")
+        self.assertFalse(redis_client.exists(f"{key}:lease"))
+
+
+def make_response(status_code, headers=None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = b"{}"
+    return response
+
+
+class RetryTest(SimpleTestCase):
+    def setUp(self):
+        logger.disable("wb")
+        self.addCleanup(logger.enable, "wb")
+
+    def test_retry_after(self):
+        in_a_minute = time.time() + 60
+        cases = [
+            ({}, None),
+            ({"Retry-After": "5"}, 5),
+            ({"X-Ratelimit-Retry": "3", "Retry-After": "5"}, 3),
+            ({"X-Ratelimit-Remaining": "0", "X-Ratelimit-Reset": "7"}, 7),
+            ({"X-Ratelimit-Remaining": "2", "X-Ratelimit-Reset": "7"}, None),
+        ]
+        for headers, expected in cases:
+            with self.subTest(headers=headers):
+                response = make_response(429, headers)
+                self.assertEqual(get_retry_after(response), expected)
+        date = email.utils.formatdate(in_a_minute, usegmt=True)
+        seconds = get_retry_after(make_response(429, {"Retry-After": date}))
+        self.assertAlmostEqual(seconds, 60, delta=2)
+
+    def test_waits_as_long_as_wb_asks(self):
+        responses = iter(
+            [make_response(429, {"Retry-After": "20"}), make_response(200)]
+        )
+        with mock.patch("wb.services.rest_client.retry.time.sleep") as sleep:
+            response = RetryPolicy(base_delay=1).call(lambda: next(responses))
+        self.assertEqual(response.status_code, 200)
+        (delay,), _ = sleep.call_args
+        self.assertTrue(20 <= delay <= 21)
+
+    def test_gives_up_when_wait_is_too_long(self):
+        send = mock.Mock(return_value=make_response(429, {"Retry-After": "600"}))
+        with mock.patch("wb.services.rest_client.retry.time.sleep") as sleep:
+            with self.assertRaises(RetryableError):
+                RetryPolicy().call(send)
+        sleep.assert_not_called()
+        self.assertEqual(send.call_count, 1)
+
+    def test_fatal_error_is_not_retried(self):
+        send = mock.Mock(return_value=make_response(401))
+        with mock.patch("wb.services.rest_client.retry.time.sleep") as sleep:
+            with self.assertRaises(FatalError):
+                RetryPolicy().call(send)
+        sleep.assert_not_called()
+        self.assertEqual(send.call_count, 1)
+
+
+@mock.patch.dict(rate_limit.WB_RATE_LIMITS, {"statistics": (3, 60)})
+class RateLimitTest(FakeWbTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(rate_limit, "time")
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.time.return_value = 1000.0
+
+    def acquire(self, token="x64", max_wait=50):
+        self.time.sleep.reset_mock()
+        rate_limit.acquire(token, "statistics", "orders", max_wait=max_wait)
+        if not self.time.sleep.called:
+            return 0
+        (wait,), _ = self.time.sleep.call_args
+        return wait
+
+    def test_calls_queue_up_after_burst(self):
+        self.assertEqual([self.acquire() for _ in range(5)], [0, 0, 0, 20, 40])
+        with self.assertRaises(rate_limit.RateLimited):
+            self.acquire()
+        # Other tokens have buckets of their own
+        self.assertEqual(self.acquire("another"), 0)
+
+        (metrics,) = [
+            metrics
+            for bucket_id, metrics in rate_limit.get_rate_limit_metrics().items()
+            if bucket_id == rate_limit.get_bucket_id("x64", "statistics", "orders")
+        ]
+        self.assertEqual(metrics["calls"], 5)
+        self.assertEqual(metrics["rejected"], 1)
+        self.assertEqual(metrics["waiting"], 0)
+        self.assertEqual(metrics["avg_wait_seconds"], 30)
+
+    def test_bucket_refills_with_time(self):
+        for _ in range(5):
+            self.acquire()
+        # Queue of two is served by 1040, one more token is there by 1060
+        self.time.time.return_value = 1060.0
+        self.assertEqual(self.acquire(), 0)
+        self.assertEqual(self.acquire(), 20)
+
+    def test_rejected_call_takes_no_turn(self):
+        for _ in range(5):
+            self.acquire()
+        with self.assertRaises(rate_limit.RateLimited):
+            self.acquire()
+        self.assertEqual(self.acquire(max_wait=100), 60)
+
+
+class CacheFailureTest(FakeWbTestCase):
+    def setUp(self):
+        super().setUp()
+        self.results = [{"total": 1}]
+
+        @redis_cache_decorator(default=dict)
+        def get_total(token):
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.get_total = get_total
+        self.key = get_total.get_cache_key("x64")
+
+    def test_failure_keeps_stale_value(self):
+        self.assertEqual(self.get_total("x64"), {"total": 1})
+        self.results.append(RetryableError("429, Message: too many requests"))
+        self.assertFalse(self.get_total.refresh("x64"))
+        self.assertEqual(self.get_total("x64"), {"total": 1})
+        self.assertEqual(
+            redis_client.get(f"{self.key}:failed"), b"429, Message: too many requests"
+        )
+
+    def test_remembered_failure_is_not_retried(self):
+        self.results = [RetryableError("503, Message: unavailable")]
+        self.assertEqual(self.get_total("x64"), {})
+        # Would raise IndexError if WB was called again
+        self.assertEqual(self.get_total("x64"), {})
+        with self.assertRaises(WbApiError):
+            self.get_total.strict("x64")
+        self.assertFalse(redis_client.exists(self.key))
+
+
+class SnapshotLeaseTest(FakeWbTestCase):
+    def test_no_build_without_lease(self):
+        acquire_lease(get_snapshot_key(STOCK, "x64", "jwt"))
+        with mock.patch("wb.services.snapshot.wait_for_lease", return_value=False):
+            with self.assertRaises(SnapshotNotReady):
+                get_snapshot(STOCK, "x64", "jwt")
+        self.assertEqual(self.api.get_metrics(), {})
+
+    def test_lease_is_taken_again_after_owner_gave_up(self):
+        redis_key = get_snapshot_key(STOCK, "x64", "jwt")
+        owner = acquire_lease(redis_key)
+
+        def give_up(key):
+            release_lease(key, owner)
+            return True
+
+        with mock.patch("wb.services.snapshot.wait_for_lease", side_effect=give_up):
+            snapshot = get_snapshot(STOCK, "x64", "jwt")
+        self.assertTrue(snapshot.products)
+        self.assertFalse(redis_client.exists(f"{redis_key}:lease"))
+
+
+class SyncTest(FakeWbTestCase):
+    def test_window_is_not_cached_while_sync_runs_elsewhere(self):
+        acquire_lease("x64:sync:orders")
+        with mock.patch("wb.services.sync.wait_for_lease", return_value=False):
+            self.assertEqual(get_orders_window("x64"), [])
+        redis_key = get_orders_window.get_cache_key("x64")
+        self.assertFalse(redis_client.exists(f"{redis_key}:updated_at"))
+        self.assertTrue(redis_client.exists(f"{redis_key}:failed"))
+
+    def get_day(self, days_ago):
+        day = datetime.datetime.today() - datetime.timedelta(days=days_ago)
+        return day.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def sync(self, changes):
+        client = mock.Mock()
+        client.return_value.iter_changes.return_value = iter(changes)
+        with mock.patch("wb.services.sync.StatisticsApiClient", client):
+            rows = sync_statistics("x64", "orders", 14)
+        return rows, client.return_value.iter_changes
+
+    def test_changed_rows_are_merged(self):
+        first = {"srid": "a", "lastChangeDate": self.get_day(3), "quantity": 1}
+        second = {"srid": "b", "lastChangeDate": self.get_day(2), "quantity": 1}
+        rows, iter_changes = self.sync([first, second])
+        self.assertEqual(rows, [first, second])
+        iter_changes.assert_called_once_with("orders", get_window_start(14))
+
+        # Cancelled order comes again with newer lastChangeDate
+        cancelled = {**first, "lastChangeDate": self.get_day(1), "isCancel": True}
+        new = {"srid": "c", "lastChangeDate": self.get_day(1), "quantity": 2}
+        rows, iter_changes = self.sync([cancelled, new])
+        iter_changes.assert_called_once_with("orders", second["lastChangeDate"])
+        self.assertEqual(rows, [second, cancelled, new])
+        state = load_sync_state("x64:sync:orders", 14)
+        self.assertEqual(state["cursor"], new["lastChangeDate"])
+        self.assertEqual(
+            set(OrderRow.objects.values_list("row_key", flat=True)), {"a", "b", "c"}
+        )
+
+    def test_rows_leaving_window_are_dropped(self):
+        old = {"srid": "old", "lastChangeDate": self.get_day(20), "quantity": 1}
+        kept = {"srid": "kept", "lastChangeDate": self.get_day(5), "quantity": 1}
+        state = {
+            "version": SYNC_STATE_VERSION,
+            "days": 14,
+            "cursor": kept["lastChangeDate"],
+            "rows": {"old": old, "kept": kept},
+        }
+        redis_client.set("x64:sync:orders", codec.dumps(state))
+        rows, _ = self.sync([])
+        self.assertEqual(rows, [kept])
+        self.assertEqual(list(load_sync_state("x64:sync:orders", 14)["rows"]), ["kept"])
+
+    def test_window_is_stored_once(self):
+        rows = get_orders_window("x64")
+        self.assertTrue(rows)
+        self.assertFalse(redis_client.exists(get_orders_window.get_cache_key("x64")))
+        local_cache.clear()
+        calls = self.api.get_metrics()
+        self.assertEqual(get_orders_window("x64"), rows)
+        self.assertEqual(self.api.get_metrics(), calls)
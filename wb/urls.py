@@ -16,6 +16,7 @@ urlpatterns = [
     path("add/", views.add_to_cart, name="add"),
     path("cart/", views.cart, name="cart"),
     path("update_discount/", views.update_discount, name="update_discount"),
+    path("metrics/", views.metrics, name="metrics"),
 ]
 
 urlpatterns += [
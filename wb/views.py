@@ -1,51 +1,78 @@
-import concurrent.futures
+import asyncio
 import datetime
 import json
 import logging
-import pickle
-from multiprocessing.pool import ThreadPool
 from rest_framework.decorators import api_view
 
-from django.contrib.auth.decorators import login_required
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.paginator import Paginator
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
+from django.views.decorators.gzip import gzip_page
 from loguru import logger
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from _settings.settings import redis_client
 from wb.forms import ApiForm
-from wb.models import ApiKey
+from wb.models import ApiKey, OrderRow, SaleRow
+from wb.services.executor import get_executor_metrics
 from wb.services.filtering import (
-    filter_marketplace_products,
-    filter_warehouse_products,
     filtering_lambdas_marketplace,
     filtering_lambdas_warehouse,
 )
-from wb.services.json_encoder import ObjectDict
-from wb.services.marketplace import (
-    get_marketplace_objects,
-    update_marketplace_prices,
-    update_marketplace_sales,
-    update_warehouse_prices,
+from wb.services.api import (
+    API_MAX_LIMIT,
+    QueryError,
+    get_cursor_page,
+    parse_fields,
+    parse_limit,
 )
+from wb.services.json_encoder import (
+    get_product_serializer,
+    iter_page_json,
+    iter_products_json,
+)
+from wb.services.page_cache import get_page_cache_metrics
+from wb.services.pipeline import get_pipeline_metrics
+from wb.services.redis import record_access, set_price_change_to_redis
+from wb.services.reports import (
+    get_orders_summary,
+    get_summary_sizes,
+    get_today_rows,
+)
+from wb.services.rest_client.rate_limit import get_rate_limit_metrics
 from wb.services.rest_client.standard_client import StandardApiClient
-from wb.services.search import search_warehouse_products
+from wb.services.snapshot import (
+    MARKETPLACE,
+    STOCK,
+    SnapshotNotReady,
+    get_current_tag,
+    get_snapshot,
+)
 from wb.services.sorting import (
+    SortedProducts,
     get_marketplaces_sorting,
-    sort_marketplace_products,
-    sort_products,
     sorting_lambdas,
 )
-from wb.services.statistics import get_sales_statistics, get_stock_statistics
-from wb.services.tools import api_key_required
+from wb.services.statistics import get_sales_statistics
+from wb.services.tools import (
+    api_key_required,
+    async_api_key_required,
+    conditional,
+    get_query_key,
+    make_etag,
+    run_sync,
+)
 from wb.services.warehouse import (
-    add_weekly_orders,
-    add_weekly_sales,
     get_bought_products,
+    get_bought_sum,
     get_ordered_products,
-    get_stock_objects,
-    get_stock_products, attach_images,
+    get_ordered_sum,
+    get_orders_window,
+    get_sales_window,
+    get_stock_products,
+    get_weekly_payment,
 )
 
 
@@ -80,12 +107,13 @@ def update_discount(request):
     if new_discount is not None:
         success, message = new_client.update_discount(wb_id, new_discount)
         if success:
-            redis_key = f"{x64_token}:update_discount:{wb_id}"
             now = datetime.datetime.now(
                 datetime.timezone(datetime.timedelta(hours=timezone))
             )
             logger.info(f"{now}, {datetime.datetime.now()}")
-            redis_value = pickle.dumps(
+            set_price_change_to_redis(
+                x64_token,
+                wb_id,
                 {
                     "new_price": new_price,
                     "new_discount": new_discount,
@@ -93,69 +121,145 @@ def update_discount(request):
                     "modified_at": datetime.datetime.now(
                         datetime.timezone(datetime.timedelta(hours=timezone))
                     ),
-                }
+                },
             )
-            redis_client.set(
-                redis_key, redis_value, ex=60 * 60 * 24 * 14
-            )  # Keep info about price change for 14 days
             return HttpResponse(f"Установлена {new_discount}% скидка")
         return HttpResponse(message)
 
 
-@login_required
-@api_key_required
-def stock(request):
-    """Display products in stock."""
-    logger.info("View: requested stock")
-    statistics_token = ApiKey.objects.get(user=request.user.id).api
-    standard_token = ApiKey.objects.get(user=request.user.id).new_api
-
-    # Statistics have 3 requests that take 30+ seconds, so we start another thread pool here
-    # Tread doesn't support return value!
-    pool = ThreadPool(processes=1)
-    async_result = pool.apply_async(get_sales_statistics, (statistics_token,))
-    # and actually 3 more threads inside. Magic!
-
-    # So here actually we have 4 concurrent requests
-    products = get_stock_objects(statistics_token)
-    products = add_weekly_sales(statistics_token, products)
-    products = add_weekly_orders(statistics_token, products)
-    products = update_warehouse_prices(statistics_token, products)
-    products = attach_images(standard_token, products)
-    products = list(products.values())
+NOT_READY_RETRY_SECONDS = 30
 
-    sort_by = request.GET.get("sort_by")
 
-    products = sort_products(products, sort_by)
+def get_not_ready_response(error: SnapshotNotReady, as_json=False):
+    """503 while the first snapshot of token is being built by another request."""
+    logger.info(error)
+    if as_json:
+        response = JsonResponse(
+            {"error": "Data is still loading, try again later"}, status=503
+        )
+    else:
+        response = HttpResponse(
+            "Данные еще загружаются, обновите страницу через минуту", status=503
+        )
+    response["Retry-After"] = NOT_READY_RETRY_SECONDS
+    return response
 
-    filter_by = request.GET.get("filter_by")
-    if filter_by:
-        products = filter_warehouse_products(products, filter_by)
 
-    search_keyword = request.GET.get("search")
-    if search_keyword:
-        products = search_warehouse_products(products, search_keyword)
+def get_snapshot_etag(request, kind, x64_token, jwt_token):
+    tag = get_current_tag(kind, x64_token, jwt_token)
+    if tag is None:
+        return None
+    return make_etag(kind, x64_token, tag, get_query_key(request))
 
-    # Ready to paginate
-    paginator = Paginator(products, 32)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
 
-    # Get our statistics
-    data = async_result.get()
+def get_cached_etag(request, *cached_functions):
+    """ETag of page of cached values and today's rows, None until all are cached."""
+    token = request.api_key.api
+    versions = [func.get_version(token) for func in cached_functions]
+    if None in versions:
+        return None
+    return make_etag(token, timezone.localdate(), get_query_key(request), *versions)
 
-    data["data"] = page_obj
-    data = data | get_stock_statistics(products)
+
+def get_stock_etag(request):
+    tokens = request.api_key
+    return get_snapshot_etag(request, STOCK, tokens.api, tokens.new_api)
+
+
+def get_marketplace_etag(request):
+    tokens = request.api_key
+    return get_snapshot_etag(request, MARKETPLACE, tokens.api, tokens.new_api)
+
+
+def get_ordered_etag(request):
+    return get_cached_etag(
+        request, get_weekly_payment, get_ordered_sum, get_bought_sum, get_orders_window
+    )
+
+
+def get_bought_etag(request):
+    return get_cached_etag(
+        request, get_weekly_payment, get_ordered_sum, get_bought_sum, get_sales_window
+    )
+
+
+def get_summary_etag(request):
+    return get_cached_etag(
+        request,
+        get_weekly_payment,
+        get_ordered_sum,
+        get_bought_sum,
+        get_orders_window,
+        get_stock_products,
+    )
+
+
+def get_jwt_token(x64_token):
+    return ApiKey.objects.filter(api=x64_token).values_list("new_api", flat=True).last()
+
+
+def get_api_stock_etag(request):
+    token = request.GET.get("x64_token")
+    if not token:
+        return None
+    # 304 doesn't reach the view, but token is still in use
+    record_access(token)
+    return get_snapshot_etag(request, STOCK, token, get_jwt_token(token))
+
+
+def get_api_marketplace_etag(request):
+    x64_token = request.GET.get("x64_token")
+    jwt_token = request.GET.get("jwt_token")
+    if not x64_token or not jwt_token:
+        return None
+    record_access(x64_token)
+    return get_snapshot_etag(request, MARKETPLACE, x64_token, jwt_token)
+
+
+@async_api_key_required
+@conditional(get_stock_etag, cache_pages=True)
+async def stock(request):
+    """Display products in stock."""
+    logger.info("View: requested stock")
+    tokens = request.api_key
+    try:
+        snapshot = await run_sync(get_snapshot, STOCK, tokens.api, tokens.new_api)
+    except SnapshotNotReady as e:
+        return get_not_ready_response(e)
+    data = await run_sync(
+        render_snapshot, request, snapshot, filtering_lambdas_warehouse
+    )
     data["sorting_lambdas"] = sorting_lambdas
     data["filtering_lambdas"] = filtering_lambdas_warehouse
 
-    return render(
+    return await sync_to_async(render)(
         request,
         "stock.html",
         data,
     )
 
 
+def render_snapshot(request, snapshot, filtering) -> dict:
+    """Sort, filter and paginate snapshot products. Snapshot stays untouched.
+
+    May take a while on big catalogs, async views run it in a thread.
+    """
+    sort_by = request.GET.get("sort_by")
+    filter_by = request.GET.get("filter_by")
+    search_keyword = request.GET.get("search")
+    products = snapshot.get_sorted(sort_by, filter_by, filtering, search_keyword)
+
+    # Ready to paginate
+    paginator = Paginator(products, 32)
+    page_number = request.GET.get("page")
+    page_obj = paginator.get_page(page_number)
+
+    data = dict(snapshot.sales_statistics)
+    data["data"] = page_obj
+    data = data | snapshot.get_statistics(products)
+    return data
+
+
 x64_token = openapi.Parameter(
     "x64_token",
     openapi.IN_QUERY,
@@ -168,126 +272,187 @@ jwt_token = openapi.Parameter(
     description="jwt_token https://seller.wb.ru/supplier-settings/access-to-new-api",
     type=openapi.TYPE_STRING,
 )
-
-
-@swagger_auto_schema(method="get", manual_parameters=[x64_token])
+pretty = openapi.Parameter(
+    "pretty",
+    openapi.IN_QUERY,
+    description="Indent JSON, output is compact by default",
+    type=openapi.TYPE_BOOLEAN,
+)
+query_parameters = [
+    openapi.Parameter(
+        "sort_by",
+        openapi.IN_QUERY,
+        description="Same as on site: qty, sales, orders, order_now, "
+        "out_of_stock_soon, low_sales",
+        type=openapi.TYPE_STRING,
+    ),
+    openapi.Parameter(
+        "filter_by",
+        openapi.IN_QUERY,
+        description="Same as on site: all, sales, orders",
+        type=openapi.TYPE_STRING,
+    ),
+    openapi.Parameter(
+        "search",
+        openapi.IN_QUERY,
+        description="Name, article, nm_id, subject, brand or category",
+        type=openapi.TYPE_STRING,
+    ),
+    openapi.Parameter(
+        "limit",
+        openapi.IN_QUERY,
+        description=f"Page size up to {API_MAX_LIMIT}, "
+        "answer is a page with results and next_cursor",
+        type=openapi.TYPE_INTEGER,
+    ),
+    openapi.Parameter(
+        "cursor",
+        openapi.IN_QUERY,
+        description="next_cursor of the previous page",
+        type=openapi.TYPE_STRING,
+    ),
+    openapi.Parameter(
+        "fields",
+        openapi.IN_QUERY,
+        description="Comma separated product fields, e.g. nm_id,stock,price",
+        type=openapi.TYPE_STRING,
+    ),
+    pretty,
+]
+
+
+@gzip_page
+@conditional(get_api_stock_etag)
+@swagger_auto_schema(method="get", manual_parameters=[x64_token, *query_parameters])
 @api_view(http_method_names=["GET"])
 def api_stock(request):
     if "x64_token" not in request.GET:
         return JsonResponse({"error": "x64_token is not provided"})
     token = request.GET["x64_token"]
-    products = get_stock_objects(token)
-    products = add_weekly_sales(token, products)
-    products = add_weekly_orders(token, products)
-    products = update_warehouse_prices(token, products)
-    return JsonResponse(products, encoder=ObjectDict, json_dumps_params={"indent": 4})
+    record_access(token)
+    try:
+        snapshot = get_snapshot(STOCK, token, get_jwt_token(token))
+    except SnapshotNotReady as e:
+        return get_not_ready_response(e, as_json=True)
+    return get_products_response(request, snapshot, filtering_lambdas_warehouse)
+
+
+def get_products_response(request, snapshot, filtering):
+    """Products of snapshot as streamed JSON.
+
+    Without `limit` it is nm_id -> product of all products, as it always was.
+    With `limit` it is a page with "results" list and "next_cursor".
+    """
+    params = request.GET
+    try:
+        limit = parse_limit(params.get("limit"))
+        serialize = get_product_serializer(parse_fields(params.get("fields")))
+        if any(params.get(name) for name in ("sort_by", "filter_by", "search")):
+            products = snapshot.get_sorted(
+                params.get("sort_by"),
+                params.get("filter_by"),
+                filtering,
+                params.get("search"),
+            )
+        else:
+            products = SortedProducts(snapshot.products, range(len(snapshot.products)))
+        if limit is not None:
+            page, next_cursor = get_cursor_page(products, params.get("cursor"), limit)
+    except QueryError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    indent = 4 if params.get("pretty", "").lower() in ("1", "true") else None
+    if limit is None:
+        content = iter_products_json(products, indent, serialize)
+    else:
+        meta = {"count": len(products), "next_cursor": next_cursor}
+        content = iter_page_json(page, meta, indent, serialize)
+    return StreamingHttpResponse(content, content_type="application/json")
 
 
-@login_required
-@api_key_required
-def marketplace(request):
+@async_api_key_required
+@conditional(get_marketplace_etag, cache_pages=True)
+async def marketplace(request):
     """Display products in marketplace."""
     logger.info("View: requested marketplace")
-    tokens = ApiKey.objects.get(user=request.user)
+    tokens = request.api_key
     jwt_token = tokens.new_api
     x64_token = tokens.api
 
-    # Statistics have 3 requests that take 30+ seconds, so we start another thread pool here
-    # Tread doesn't support return value!
-    pool = ThreadPool(processes=1)
-    async_result = pool.apply_async(get_sales_statistics, (x64_token,))
-    # and actually 3 more threads inside. Magic!
-
-    # So here actually we have 4 concurrent requests
-    products, barcode_hashmap = get_marketplace_objects(x64_token)
-    products = update_marketplace_prices(x64_token, products)
-    products = update_marketplace_sales(jwt_token, products, barcode_hashmap)
-    products = attach_images(jwt_token, products)
-
-    products = list(products.values())
-    sort_by = request.GET.get("sort_by")
-    products = sort_marketplace_products(products, sort_by)
-
-    filter_by = request.GET.get("filter_by")
-    if filter_by:
-        products = filter_marketplace_products(products, filter_by)
-
-    search_keyword = request.GET.get("search")
-    if search_keyword:
-        products = search_warehouse_products(products, search_keyword)
-    # Ready to paginate
-    paginator = Paginator(products, 32)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
-
-    # Get our weekly revenue and sales/orders
-    data = async_result.get()
-
-    data["data"] = page_obj
-
-    data = data | get_stock_statistics(products)
+    try:
+        snapshot = await run_sync(get_snapshot, MARKETPLACE, x64_token, jwt_token)
+    except SnapshotNotReady as e:
+        return get_not_ready_response(e)
+    data = await run_sync(
+        render_snapshot, request, snapshot, filtering_lambdas_marketplace
+    )
     data["sorting_lambdas"] = get_marketplaces_sorting()
     data["filtering_lambdas"] = filtering_lambdas_marketplace
 
     data["marketplace"] = True
 
-    return render(
+    return await sync_to_async(render)(
         request,
         "stock.html",
         data,
     )
 
 
-@swagger_auto_schema(method="get", manual_parameters=[x64_token, jwt_token])
+@gzip_page
+@conditional(get_api_marketplace_etag)
+@swagger_auto_schema(
+    method="get", manual_parameters=[x64_token, jwt_token, *query_parameters]
+)
 @api_view(http_method_names=["GET"])
 def api_marketplace(request):
     if "x64_token" not in request.GET or "jwt_token" not in request.GET:
         return JsonResponse({"error": "x64_token or jwt_token are not provided"})
     x64_token = request.GET["x64_token"]
     jwt_token = request.GET["jwt_token"]
-    products, barcode_hashmap = get_marketplace_objects(x64_token)
-    products = update_marketplace_prices(x64_token, products)
-    products = update_marketplace_sales(jwt_token, products, barcode_hashmap)
-
-    return JsonResponse(products, encoder=ObjectDict, json_dumps_params={"indent": 4})
-
-
-@login_required
-@api_key_required
-def ordered(request):
-    return render_page(get_ordered_products, request)
-
-
-def render_page(function, request):
-    # Statistics have 3 requests that take 30+ seconds, so we start another thread pool here
-    # Tread doesn't support return value!
-    token = ApiKey.objects.get(user=request.user.id).api
-    pool = ThreadPool(processes=1)
-    async_result = pool.apply_async(get_sales_statistics, (token,))
-    # and actually 3 more threads inside. Magic!
-
-    data = function(token)
-    sorted_by_date = sorted(data, key=lambda x: x["date"], reverse=True)
-    paginator = Paginator(sorted_by_date, 32)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
-
-    # Get our statistics
-    data = async_result.get()
-
-    data["data"] = page_obj
+    record_access(x64_token)
+    try:
+        snapshot = get_snapshot(MARKETPLACE, x64_token, jwt_token)
+    except SnapshotNotReady as e:
+        return get_not_ready_response(e, as_json=True)
+    return get_products_response(request, snapshot, filtering_lambdas_marketplace)
+
+
+@async_api_key_required
+@conditional(get_ordered_etag, cache_pages=True)
+async def ordered(request):
+    return await render_page(OrderRow, get_ordered_products, request)
+
+
+async def render_page(model, function, request):
+    token = request.api_key.api
+    # Sales sums and sync window are independent, so they are awaited together
+    data, _ = await asyncio.gather(
+        run_sync(get_sales_statistics, token),
+        # Refreshes sync window which is mirrored to DB
+        run_sync(function, token=token, week=False, flag=0, days=14),
+    )
+    data["data"] = await run_sync(
+        get_page, get_today_rows(model, token), request.GET.get("page")
+    )
 
-    return render(
+    return await sync_to_async(render)(
         request,
         "ordered.html",
         data,
     )
 
 
-@login_required
-@api_key_required
-def bought(request):
-    return render_page(get_bought_products, request)
+def get_page(object_list, page_number, per_page=32):
+    """Page with rows loaded, templates of async views must not query DB."""
+    page_obj = Paginator(object_list, per_page).get_page(page_number)
+    page_obj.object_list = list(page_obj.object_list)
+    return page_obj
+
+
+@async_api_key_required
+@conditional(get_bought_etag, cache_pages=True)
+async def bought(request):
+    return await render_page(SaleRow, get_bought_products, request)
 
 
 @login_required
@@ -305,102 +470,34 @@ def api(request):
     return render(request, "api.html", {"form": form, "api": api})
 
 
-@login_required
-@api_key_required
-def weekly_orders_summary(request):
-    # Statistics have 3 requests that take 30+ seconds, so we start another thread pool here
-    # Tread doesn't support return value!
-    token = ApiKey.objects.get(user=request.user.id).api
-    pool = ThreadPool(processes=1)
-    async_result = pool.apply_async(get_sales_statistics, (token,))
-    # and actually 3 more threads inside. Magic!
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        logger.info("Concurrent analytics dicts")
-        future1 = executor.submit(
-            get_ordered_products, token=token, week=False, flag=0, days=14
-        )
-        future2 = executor.submit(get_stock_as_dict, request)
-        data = future1.result()
-        stock = future2.result()
+@async_api_key_required
+@conditional(get_summary_etag, cache_pages=True)
+async def weekly_orders_summary(request):
+    token = request.api_key.api
+    # Refresh sync windows which are mirrored to DB, along with sales sums
+    data, *_ = await asyncio.gather(
+        run_sync(get_sales_statistics, token),
+        run_sync(get_ordered_products, token=token, week=False, flag=0, days=14),
+        run_sync(get_stock_products, token),
+    )
     logger.info("We've got STOCK and DATA")
 
-    combined = dict()
     to_order = request.GET.get("to_order", False)
+    data["data"] = await run_sync(
+        get_summary_page, token, to_order, request.GET.get("page")
+    )
 
-    for item in data:
-
-        wb_id = item["nmId"]
-        sku = item["supplierArticle"]
-        size = item["techSize"]
-        qty = item.get("quantity", 0)
-        stock_data = stock.get(wb_id, {"stock": 0})
-
-        if wb_id not in combined:
-            combined[wb_id] = {
-                "sizes": {size: qty},
-                "total": qty,
-                "sku": sku,
-                "stock": stock_data.get("stock", 0),
-                "stock_sizes": stock_data.get("sizes", dict()),
-            }
-        else:
-            editing = combined[wb_id]  # this is pointer to object in memory
-            editing["sizes"][size] = editing["sizes"].get(size, 0) + qty
-            editing["total"] += qty
-            editing["stock_sizes"] = (stock_data.get("sizes", dict()),)
-
-    unsorted_data = tuple(combined.items())
-    sorted_data = sorted(unsorted_data, key=lambda x: x[1]["total"], reverse=True)
-    if to_order:
-        sorted_data = tuple(
-            filter(lambda x: x[1]["total"] > x[1]["stock"], sorted_data)
-        )
-    paginator = Paginator(sorted_data, 32)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
-
-    # Get our statistics
-    data = async_result.get()
-    data["data"] = page_obj
-
-    return render(
+    return await sync_to_async(render)(
         request,
         "summary.html",
         data,
     )
 
 
-def get_stock_as_dict(request):
-    """Must be rewritten with saving to DB"""
-    logger.info("Getting stock as dict")
-    token = ApiKey.objects.get(user=request.user.id).api
-    stock = get_stock_products(token)
-    stock_as_dict = dict()
-    for item in stock:
-        key = item["nmId"]  # wb_id
-        price = int(item["Price"] * ((100 - item["Discount"]) / 100))
-        data = {
-            "wb_id": item["nmId"],
-            "sku": item["supplierArticle"],
-            "price": price,
-        }
-        data = stock_as_dict.get(key, data)
-
-        data["in"] = data.get("in", 0) + item.get("inWayToClient",0)
-        data["out"] = data.get("out", 0) + item.get("inWayFromClient",0)
-        data["stock"] = data.get("stock", 0) + item.get("quantityFull",0)
-
-        sizes = data.get("sizes", dict())
-        size = item.get("techSize", 0)
-        sizes[size] = sizes.get(size, 0) + item.get("quantityFull",0)
-
-        data["sizes"] = sizes
-        stock_as_dict[key] = data
-
-    logging.warning(stock_as_dict.get(11034009, None))
-
-    return stock_as_dict
+def get_summary_page(token, to_order, page_number):
+    page_obj = Paginator(get_orders_summary(token, to_order), 32).get_page(page_number)
+    page_obj.object_list = get_summary_sizes(token, page_obj.object_list)
+    return page_obj
 
 
 @login_required
@@ -452,3 +549,18 @@ def cart(request):
         "cart.html",
         data,
     )
+
+
+@user_passes_test(lambda user: user.is_staff)
+def metrics(request):
+    """Load numbers for admins: WB rate limiter queues and waits, threads and
+    pipeline stage timings of this worker."""
+    return JsonResponse(
+        {
+            "rate_limits": get_rate_limit_metrics(),
+            "executors": get_executor_metrics(),
+            "pipelines": get_pipeline_metrics(),
+            "pages": get_page_cache_metrics(),
+        },
+        json_dumps_params={"indent": 4},
+    )